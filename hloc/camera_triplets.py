@@ -3,26 +3,104 @@ Paper: Leveraging Camera Triplets for Efficient and Accurate Structure-from-Moti
 https://ee.iisc.ac.in/cvlab/research/camtripsfm/
 """
 
-from pathlib import Path
 from collections import defaultdict
-from typing import Dict
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
 
-from tqdm import tqdm
-import pycolmap
 import networkx as nx
+import numpy as np
+import pycolmap
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+
 from . import logger
 
+
 def image_ids_to_pair_id(image_id1, image_id2):
     if image_id1 > image_id2:
         return 2147483647 * image_id2 + image_id1
     else:
         return 2147483647 * image_id1 + image_id2
 
+
 def pair_id_to_image_ids(pair_id):
     image_id2 = pair_id % 2147483647
     image_id1 = int((pair_id - image_id2) / 2147483647)
     return image_id1, image_id2
 
+
+def pair_ids_to_image_ids(pair_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized pair_id_to_image_ids."""
+    pair_ids = np.asarray(pair_ids, dtype=np.int64)
+    return pair_ids // 2147483647, pair_ids % 2147483647
+
+
+def iter_triangles_csr(
+    rows: np.ndarray, cols: np.ndarray, num_nodes: int, chunk_size: int = 1 << 22
+) -> Iterator[np.ndarray]:
+    """List the triangles of an undirected graph given by its unique edges
+    (rows[i], cols[i]), as the indices of their three edges, in chunks of about
+    chunk_size candidate wedges. The edges are oriented from the lower to the
+    higher degree node and stored in CSR order, so that each triangle is found
+    once from its lowest node, in O(m^1.5) time overall."""
+    degree = np.bincount(rows, minlength=num_nodes) + np.bincount(
+        cols, minlength=num_nodes
+    )
+    rank = np.empty(num_nodes, dtype=np.int64)
+    rank[np.lexsort((np.arange(num_nodes), degree))] = np.arange(num_nodes)
+    flip = rank[rows] > rank[cols]
+    src, dst = np.where(flip, cols, rows), np.where(flip, rows, cols)
+    edge_ids = np.lexsort((dst, src))
+    src, dst = src[edge_ids], dst[edge_ids]
+    keys = src.astype(np.int64) * num_nodes + dst
+    indptr = np.searchsorted(src, np.arange(num_nodes + 1))
+
+    # each oriented edge (u, v) forms a wedge with the following edges (u, w) of u
+    num_wedges = indptr[src + 1] - np.arange(len(src)) - 1
+    cumsum = np.cumsum(num_wedges)
+    bounds = np.searchsorted(
+        cumsum, np.arange(0, cumsum[-1] if len(cumsum) else 0, chunk_size), side="right"
+    )
+    bounds = np.unique(np.r_[bounds, len(src)])
+    start = 0
+    for end in bounds:
+        if end == start:
+            continue
+        counts = num_wedges[start:end]
+        first = np.repeat(np.arange(start, end), counts)
+        offsets = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = first + 1 + offsets
+        start = end
+        v, w = dst[first], dst[second]
+        # the closing edge is oriented either way
+        closing = []
+        for key in (v * num_nodes + w, w * num_nodes + v):
+            idx = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            closing.append(np.where(keys[idx] == key, idx, -1))
+        closing = np.maximum(*closing)
+        found = closing >= 0
+        yield edge_ids[np.stack([first[found], second[found], closing[found]], -1)]
+
+
+def score_edges_csr(
+    rows: np.ndarray, cols: np.ndarray, num_inliers: np.ndarray, num_nodes: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum and count of the relative scores of each edge over all its triplets,
+    as in score_edges, accumulated in a single pass over the triangles."""
+    num_inliers = np.asarray(num_inliers, dtype=np.float64)
+    sums = np.zeros(len(rows))
+    counts = np.zeros(len(rows), dtype=np.int64)
+    for triangles in iter_triangles_csr(rows, cols, num_nodes):
+        n = num_inliers[triangles]
+        scores = n / np.maximum(n.max(1, keepdims=True), 1)
+        sums += np.bincount(
+            triangles.ravel(), weights=scores.ravel(), minlength=len(rows)
+        )
+        counts += np.bincount(triangles.ravel(), minlength=len(rows))
+    return sums, counts
+
+
 def enumerate_triangles_nx(graph):
     """Use NetworkX's optimized triangle enumeration"""
     triangles = set()
@@ -46,7 +124,9 @@ def remove_non_tri_edges(G, verbose: bool = False):
         tri_edges.add(tuple(sorted((a, c))))
 
     # Remove edges not in any triangle
-    edges_to_remove = [tuple(sorted(e)) for e in G.edges() if tuple(sorted(e)) not in tri_edges]
+    edges_to_remove = [
+        tuple(sorted(e)) for e in G.edges() if tuple(sorted(e)) not in tri_edges
+    ]
     if verbose:
         logger.info(f"Triangle-supported edges: {len(tri_edges)}")
         logger.info(f"Edges to remove: {len(edges_to_remove)}")
@@ -65,9 +145,12 @@ def score_edges(graph, inlier_counts, verbose: bool = False):
     edge_scores_cnt = defaultdict(int)
     triangles = enumerate_triangles_nx(graph)
 
-    for (a, b, c) in tqdm(triangles, desc="Scoring triplets", disable=not verbose):
-
-        eab, ebc, eac = image_ids_to_pair_id(a, b), image_ids_to_pair_id(b, c), image_ids_to_pair_id(a, c)
+    for a, b, c in tqdm(triangles, desc="Scoring triplets", disable=not verbose):
+        eab, ebc, eac = (
+            image_ids_to_pair_id(a, b),
+            image_ids_to_pair_id(b, c),
+            image_ids_to_pair_id(a, c),
+        )
         # get inliers
         nab = inlier_counts.get(eab, 0)
         nbc = inlier_counts.get(ebc, 0)
@@ -82,7 +165,11 @@ def score_edges(graph, inlier_counts, verbose: bool = False):
             edge_scores_cnt[e] += 1
 
     # final averages
-    edge_score = {e: edge_scores_sum[e] / edge_scores_cnt[e] for e in inlier_counts.keys() if edge_scores_cnt[e] > 0}
+    edge_score = {
+        e: edge_scores_sum[e] / edge_scores_cnt[e]
+        for e in inlier_counts.keys()
+        if edge_scores_cnt[e] > 0
+    }
 
     return edge_score
 
@@ -109,53 +196,91 @@ def adaptive_threshold(graph, min_score=0.5):
     # Adaptive threshold formula from paper
     tau = min_score * (1 - dmax / num_nodes) + (dmax / num_nodes)
 
-    logger.info(f"Adaptive threshold: τ = {tau:.4f} (dmax={dmax}, |V|={num_nodes}, m={min_score})")
+    logger.info(
+        f"Adaptive threshold: τ = {tau:.4f} "
+        f"(dmax={dmax}, |V|={num_nodes}, m={min_score})"
+    )
 
     return tau
 
 
-def apply_camera_triplet_pruning(database_path: Path, image_ids: Dict[str, int], camera_triplet_threshold: float, verbose: bool = False):
-    # hypterparams
-    min_inlier_score = 15  # don't add edges (image pairs) to the graph with num_inliers below this number
-
+def view_graph_from_database(
+    database_path: Path, image_ids: Dict[str, int], min_num_inliers: int = 15
+):
+    """Graph of the images with an edge for each verified pair with at least
+    min_num_inliers, weighted by its number of inliers. Also returns the inlier
+    counts of all pairs."""
     with pycolmap.Database.open(database_path) as db:
         inlier_counts = db.read_two_view_geometry_num_inliers()
-    id_to_name = {image_id: image_name for image_name, image_id in image_ids.items()}
 
     G = nx.Graph()
-    G.add_nodes_from(id_to_name.keys())  # image_ids
+    G.add_nodes_from(image_ids.values())  # image_ids
     for pair_id, num_inliers in zip(*inlier_counts):
         image_id1, image_id2 = pair_id_to_image_ids(pair_id)
-        if num_inliers >= min_inlier_score:
-            G.add_edge(image_id1, image_id2)
+        if num_inliers >= min_num_inliers:
+            G.add_edge(image_id1, image_id2, weight=num_inliers)
+    return G, inlier_counts
+
+
+def apply_camera_triplet_pruning(
+    database_path: Path,
+    image_ids: Dict[str, int],
+    camera_triplet_threshold: float,
+    verbose: bool = False,
+):
+    """Delete the inlier matches of the pairs whose triplet score is below the
+    adaptive threshold of their connected component. Edges that are not part of
+    any triplet are kept. The triangles are listed once on the CSR view graph
+    and the deletions are batched."""
+    # hypterparams
+    # don't add edges (image pairs) to the graph with num_inliers below this number
+    min_inlier_score = 15
 
-    # Find all connected components
-    components = list(nx.connected_components(G))
+    with pycolmap.Database.open(database_path) as db:
+        pair_ids, num_inliers = db.read_two_view_geometry_num_inliers()
+    ids1, ids2 = pair_ids_to_image_ids(pair_ids)
+    num_inliers = np.asarray(num_inliers)
+    valid = (num_inliers >= min_inlier_score) & (ids1 != ids2)
+    ids1, ids2, num_inliers = ids1[valid], ids2[valid], num_inliers[valid]
+
+    nodes = np.unique(
+        np.concatenate(
+            [np.fromiter(image_ids.values(), np.int64, len(image_ids)), ids1, ids2]
+        )
+    )
+    num_nodes = len(nodes)
+    rows, cols = np.searchsorted(nodes, ids1), np.searchsorted(nodes, ids2)
+    sums, counts = score_edges_csr(rows, cols, num_inliers, num_nodes)
+    in_triangle = counts > 0
     if verbose:
-        logger.info(f"Found {len(components)} connected components")
-    # Sort by size (largest first)
-    components_sorted = sorted(components, key=len, reverse=True)
-
-    # Print component sizes
+        logger.info(f"Triangle-supported edges: {in_triangle.sum()}")
+        logger.info(f"Edges to remove: {len(rows) - in_triangle.sum()}")
+
+    # adaptive threshold of each component, from the degrees of the triangle edges
+    adjacency = sp.coo_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(num_nodes, num_nodes)
+    )
+    num_components, labels = connected_components(adjacency, directed=False)
     if verbose:
-        for i, comp in enumerate(components_sorted[:10]):  # Show top 10
-            logger.info(f"  Component {i + 1}: {len(comp)} nodes")
-
-    # Create subgraphs
-    component_graphs = [G.subgraph(comp).copy() for comp in components_sorted if len(comp) > 0]
-    for component in component_graphs:
-        remove_non_tri_edges(component)
-        inlier_dict = {pair_id: num_inliers for pair_id, num_inliers in zip(*inlier_counts)}
-        edge_scores = score_edges(component, inlier_dict)
-
-        tau = adaptive_threshold(component, min_score=camera_triplet_threshold)
-        num_removed_edges = 0
-        with pycolmap.Database.open(database_path) as db:
-            for pair_id, score in tqdm(edge_scores.items(), disable=not verbose):
-                image_id1, image_id2 = pair_id_to_image_ids(pair_id)
-                if score < tau:
-                    db.delete_inlier_matches(image_id1, image_id2)
-                    num_removed_edges += 1
+        logger.info(f"Found {num_components} connected components")
+    sizes = np.bincount(labels, minlength=num_components)
+    degree = np.bincount(rows[in_triangle], minlength=num_nodes) + np.bincount(
+        cols[in_triangle], minlength=num_nodes
+    )
+    dmax = np.zeros(num_components, dtype=np.int64)
+    np.maximum.at(dmax, labels, degree)
+    tau = camera_triplet_threshold * (1 - dmax / sizes) + dmax / sizes
+
+    edge_scores = np.divide(sums, counts, out=np.zeros_like(sums), where=in_triangle)
+    remove = in_triangle & (edge_scores < tau[labels[rows]])
+    with pycolmap.Database.open(database_path) as db:
+        with pycolmap.DatabaseTransaction(db):
+            for image_id1, image_id2 in zip(
+                ids1[remove].tolist(), ids2[remove].tolist()
+            ):
+                db.delete_inlier_matches(image_id1, image_id2)
     if verbose:
-        logger.info(f"{num_removed_edges} edges with scores lower than {tau=} {camera_triplet_threshold=} removed")
-
+        logger.info(
+            f"{remove.sum()} edges with scores lower than the adaptive "
+            f"thresholds {camera_triplet_threshold=} removed"
+        )
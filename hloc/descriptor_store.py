@@ -0,0 +1,131 @@
+import argparse
+import json
+from pathlib import Path
+from typing import List, Union
+
+import h5py
+import numpy as np
+
+from . import logger
+from .utils.io import list_h5_names
+from .utils.whitening import dequantize, read_whitening, write_whitening
+
+
+class DescriptorStore:
+    """Global descriptors stored as one contiguous row-major matrix in a raw
+    binary file, with the image names in a separate text table. The matrix is
+    memory-mapped, so opening the store costs a few syscalls regardless of the
+    number of images, and new images are appended in place."""
+
+    meta_file = "meta.json"
+    matrix_file = "descriptors.bin"
+    names_file = "names.txt"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        meta = json.loads((self.path / self.meta_file).read_text())
+        self.dim = meta["dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        names = (self.path / self.names_file).read_text().split("\n")
+        names = [n for n in names if len(n) > 0]
+        # the matrix is written before the names, ignore incomplete appends
+        num_rows = (self.path / self.matrix_file).stat().st_size // self.row_bytes
+        self.names = names[: min(len(names), num_rows)]
+        self.name2idx = {n: i for i, n in enumerate(self.names)}
+        self.map_matrix()
+
+    def map_matrix(self):
+        if len(self.names) > 0:
+            self.matrix = np.memmap(
+                self.path / self.matrix_file,
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self.names), self.dim),
+            )
+        else:
+            self.matrix = np.zeros((0, self.dim), dtype=self.dtype)
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * self.dtype.itemsize
+
+    @staticmethod
+    def is_store(path: Union[Path, str]) -> bool:
+        return (Path(path) / DescriptorStore.meta_file).exists()
+
+    @classmethod
+    def create(cls, path: Path, dim: int, dtype: str = "float16"):
+        path = Path(path)
+        path.mkdir(exist_ok=True, parents=True)
+        meta = {"dim": dim, "dtype": np.dtype(dtype).name}
+        (path / cls.meta_file).write_text(json.dumps(meta))
+        (path / cls.matrix_file).write_bytes(b"")
+        (path / cls.names_file).write_text("")
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name2idx
+
+    def append(self, names: List[str], desc: np.ndarray):
+        assert len(names) == len(desc) and desc.shape[1] == self.dim
+        if any("\n" in n or n in self.name2idx for n in names):
+            raise ValueError("Image names must be new and cannot contain newlines.")
+        with open(self.path / self.matrix_file, "r+b") as f:
+            # drop the rows of a previously interrupted append
+            f.truncate(len(self) * self.row_bytes)
+            f.seek(0, 2)
+            f.write(np.ascontiguousarray(desc, dtype=self.dtype).tobytes())
+        with open(self.path / self.names_file, "a") as f:
+            f.write("".join(n + "\n" for n in names))
+        self.name2idx.update({n: len(self.names) + i for i, n in enumerate(names)})
+        self.names = self.names + list(names)
+        self.map_matrix()
+
+    def get(self, names: List[str]) -> np.ndarray:
+        if names == self.names:
+            return self.matrix
+        return self.matrix[np.array([self.name2idx[n] for n in names], dtype=int)]
+
+
+def main(
+    descriptors: Union[Path, List[Path]],
+    output: Path,
+    dtype: str = "float16",
+    key: str = "global_descriptor",
+    batch_size: int = 10000,
+) -> DescriptorStore:
+    """Export (or append to) a store the descriptors of HDF5 files."""
+    if isinstance(descriptors, (Path, str)):
+        descriptors = [descriptors]
+    store = DescriptorStore(output) if DescriptorStore.is_store(output) else None
+    num_added = 0
+    for path in descriptors:
+        names = [n for n in list_h5_names(path) if store is None or n not in store]
+        with h5py.File(str(path), "r", libver="latest") as fd:
+            for i in range(0, len(names), batch_size):
+                batch = names[i : i + batch_size]
+                desc = dequantize(np.stack([fd[n][key].__array__() for n in batch]))
+                if store is None:
+                    store = DescriptorStore.create(output, desc.shape[1], dtype)
+                store.append(batch, desc)
+                num_added += len(batch)
+    if store is None:
+        raise ValueError(f"Could not find any descriptor in {descriptors}.")
+    # keep the projection of descriptors reduced with whiten_descriptors
+    whitening = read_whitening(descriptors[0])
+    if whitening is not None:
+        write_whitening(store.path, whitening)
+    logger.info(f"Added {num_added} descriptors, the store has {len(store)}.")
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--descriptors", type=Path, nargs="+", required=True)
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--dtype", type=str, default="float16")
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -1,15 +1,18 @@
 import argparse
 import pickle
+import threading
 from collections import defaultdict
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+import h5py
 import numpy as np
 import pycolmap
 from tqdm import tqdm
 
 from . import logger
-from .utils.io import get_keypoints, get_matches, write_poses
+from .utils.io import get_keypoints, get_matches, map_ordered, read_matches, write_poses
 from .utils.parsers import parse_image_lists, parse_retrieval
 
 
@@ -50,6 +53,29 @@ def do_covisibility_clustering(
     return clusters
 
 
+class ThreadLocalFiles:
+    """HDF5 files opened once per thread, since h5py handles should not be
+    shared across threads."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.handles = []
+        self.lock = threading.Lock()
+
+    def get(self, path: Path) -> h5py.File:
+        files = self.local.__dict__.setdefault("files", {})
+        if path not in files:
+            files[path] = h5py.File(str(path), "r", libver="latest")
+            with self.lock:
+                self.handles.append(files[path])
+        return files[path]
+
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+        self.handles = []
+
+
 class QueryLocalizer:
     def __init__(self, reconstruction, config=None):
         self.reconstruction = reconstruction
@@ -77,9 +103,13 @@ def pose_from_cluster(
     db_ids: List[int],
     features_path: Path,
     matches_path: Path,
+    files: Optional[ThreadLocalFiles] = None,
     **kwargs,
 ):
-    kpq = get_keypoints(features_path, qname)
+    if files is None:
+        kpq = get_keypoints(features_path, qname)
+    else:
+        kpq = files.get(features_path)[qname]["keypoints"].__array__()
     kpq += 0.5  # COLMAP coordinates
 
     kp_idx_to_3D = defaultdict(list)
@@ -94,7 +124,10 @@ def pose_from_cluster(
             [p.point3D_id if p.has_point3D() else -1 for p in image.points2D]
         )
 
-        matches, _ = get_matches(matches_path, qname, image.name)
+        if files is None:
+            matches, _ = get_matches(matches_path, qname, image.name)
+        else:
+            matches, _ = read_matches(files.get(matches_path), qname, image.name)
         matches = matches[points3D_ids[matches[:, 1]] != -1]
         num_matches += len(matches)
         for idx, m in matches:
@@ -127,6 +160,60 @@ def pose_from_cluster(
     return ret, log
 
 
+def localize_query(
+    localizer: QueryLocalizer,
+    task: Tuple[str, pycolmap.Camera, List[int]],
+    features_path: Path,
+    matches_path: Path,
+    covisibility_clustering: bool = False,
+    files: Optional[ThreadLocalFiles] = None,
+):
+    """Localize a query from its retrieved database images. Only reads the
+    reconstruction, so queries can be localized concurrently."""
+    qname, qcam, db_ids = task
+    reference_sfm = localizer.reconstruction
+    if covisibility_clustering:
+        clusters = do_covisibility_clustering(db_ids, reference_sfm)
+        best_inliers = 0
+        best_cluster = None
+        logs_clusters = []
+        for i, cluster_ids in enumerate(clusters):
+            ret, log = pose_from_cluster(
+                localizer,
+                qname,
+                qcam,
+                cluster_ids,
+                features_path,
+                matches_path,
+                files=files,
+            )
+            if ret is not None and ret["num_inliers"] > best_inliers:
+                best_cluster = i
+                best_inliers = ret["num_inliers"]
+            logs_clusters.append(log)
+        pose = None
+        if best_cluster is not None:
+            ret = logs_clusters[best_cluster]["PnP_ret"]
+            pose = ret["cam_from_world"]
+        log = {
+            "db": db_ids,
+            "best_cluster": best_cluster,
+            "log_clusters": logs_clusters,
+            "covisibility_clustering": covisibility_clustering,
+        }
+    else:
+        ret, log = pose_from_cluster(
+            localizer, qname, qcam, db_ids, features_path, matches_path, files=files
+        )
+        if ret is not None:
+            pose = ret["cam_from_world"]
+        else:
+            closest = reference_sfm.images[db_ids[0]]
+            pose = closest.cam_from_world()
+        log["covisibility_clustering"] = covisibility_clustering
+    return pose, log
+
+
 def main(
     reference_sfm: Union[Path, pycolmap.Reconstruction],
     queries: Path,
@@ -138,7 +225,11 @@ def main(
     covisibility_clustering: bool = False,
     prepend_camera_name: bool = False,
     config: Dict = None,
+    num_workers: int = 0,
 ):
+    """With num_workers > 0, the queries are localized by a pool of threads
+    that share the reconstruction, each with its own feature and match file
+    handles. The poses and logs are written in the order of the queries."""
     assert retrieval.exists(), retrieval
     assert features.exists(), features
     assert matches.exists(), matches
@@ -161,8 +252,8 @@ def main(
         "retrieval": retrieval,
         "loc": {},
     }
-    logger.info("Starting localization...")
-    for qname, qcam in tqdm(queries):
+    tasks = []
+    for qname, qcam in queries:
         if qname not in retrieval_dict:
             logger.warning(f"No images retrieved for query image {qname}. Skipping...")
             continue
@@ -173,40 +264,36 @@ def main(
                 logger.warning(f"Image {n} was retrieved but not in database")
                 continue
             db_ids.append(db_name_to_id[n])
+        tasks.append((qname, qcam, db_ids))
 
-        if covisibility_clustering:
-            clusters = do_covisibility_clustering(db_ids, reference_sfm)
-            best_inliers = 0
-            best_cluster = None
-            logs_clusters = []
-            for i, cluster_ids in enumerate(clusters):
-                ret, log = pose_from_cluster(
-                    localizer, qname, qcam, cluster_ids, features, matches
-                )
-                if ret is not None and ret["num_inliers"] > best_inliers:
-                    best_cluster = i
-                    best_inliers = ret["num_inliers"]
-                logs_clusters.append(log)
-            if best_cluster is not None:
-                ret = logs_clusters[best_cluster]["PnP_ret"]
-                cam_from_world[qname] = ret["cam_from_world"]
-            logs["loc"][qname] = {
-                "db": db_ids,
-                "best_cluster": best_cluster,
-                "log_clusters": logs_clusters,
-                "covisibility_clustering": covisibility_clustering,
-            }
-        else:
-            ret, log = pose_from_cluster(
-                localizer, qname, qcam, db_ids, features, matches
-            )
-            if ret is not None:
-                cam_from_world[qname] = ret["cam_from_world"]
-            else:
-                closest = reference_sfm.images[db_ids[0]]
-                cam_from_world[qname] = closest.cam_from_world()
-            log["covisibility_clustering"] = covisibility_clustering
+    logger.info("Starting localization...")
+    files = ThreadLocalFiles() if num_workers > 0 else None
+    results_iter = map_ordered(
+        partial(
+            localize_query,
+            localizer,
+            features_path=features,
+            matches_path=matches,
+            covisibility_clustering=covisibility_clustering,
+            files=files,
+        ),
+        tasks,
+        num_workers,
+        use_threads=True,
+    )
+    try:
+        # the results are collected in the order of the queries, for any num_workers
+        for (qname, _, _), (pose, log) in tqdm(
+            zip(tasks, results_iter), total=len(tasks)
+        ):
+            if pose is not None:
+                cam_from_world[qname] = pose
             logs["loc"][qname] = log
+    finally:
+        # wait for the queries in flight before closing their handles
+        results_iter.close()
+        if files is not None:
+            files.close()
 
     logger.info(f"Localized {len(cam_from_world)} / {len(queries)} images.")
     logger.info(f"Writing poses to {results}...")
@@ -231,5 +318,6 @@ if __name__ == "__main__":
     parser.add_argument("--ransac_thresh", type=float, default=12.0)
     parser.add_argument("--covisibility_clustering", action="store_true")
     parser.add_argument("--prepend_camera_name", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=0)
     args = parser.parse_args()
     main(**args.__dict__)
@@ -1,6 +1,8 @@
 import argparse
 import pprint
-from collections import Counter, defaultdict
+import signal
+from collections import Counter, OrderedDict, defaultdict
+from functools import partial
 from itertools import chain
 from pathlib import Path
 from types import SimpleNamespace
@@ -15,10 +17,16 @@ from tqdm import tqdm
 
 from . import logger, matchers
 from .extract_features import read_image, resize_image
-from .match_features import find_unique_new_pairs
+from .match_features import (
+    WorkQueue,
+    find_existing_pairs,
+    find_unique_new_pairs,
+    iter_new_pairs,
+)
 from .utils.base_model import dynamic_load
 from .utils.io import list_h5_names
-from .utils.parsers import names_to_pair, parse_retrieval
+from .utils.pair_sources import PairSource, as_pair_source
+from .utils.parsers import names_to_pair
 
 # Default usage:
 # dense_conf = confs['loftr']
@@ -117,12 +125,106 @@ confs = {
 }
 
 
+# Storage of the raw dense correspondences (keypoints0, keypoints1, scores).
+# Can be overridden with a "storage" entry in the matcher conf.
+# - keypoints: None (as predicted), "float32", "float16" (only for small
+#   images, the precision drops to 1px above 2048px) or "uint16" (fixed-point
+#   with subpixel_step)
+# - scores: None (as predicted), "float32" or "float16"
+# - compression: None or "lzf" (chunked, with byte shuffling)
+default_storage_conf = {
+    "keypoints": None,
+    "scores": None,
+    "subpixel_step": 1 / 16,  # resolution of uint16 keypoints (in px)
+    "compression": None,
+}
+
+
+def write_dense_dataset(grp, key, data, dtype, conf, step=None):
+    if dtype is not None:
+        data = data.astype(dtype)
+    kwargs = {}
+    if conf["compression"] is not None and data.size > 0:
+        kwargs = dict(chunks=True, compression=conf["compression"], shuffle=True)
+    dset = grp.create_dataset(key, data=data, **kwargs)
+    if step is not None:
+        dset.attrs["step"] = step
+    return dset
+
+
+def write_dense_matches(grp, kpts0, kpts1, scores, conf):
+    """Write dense correspondences with the requested precision.
+    Returns the number of bytes before and after encoding."""
+    dsets = []
+    for key, kpts in (("keypoints0", kpts0), ("keypoints1", kpts1)):
+        step = None
+        if conf["keypoints"] == "uint16":
+            # shift by 0.5 since kpts in COLMAP convention can be >= -0.5
+            step = conf["subpixel_step"]
+            max_coord = kpts.max() + 0.5 if kpts.size > 0 else 0
+            if max_coord / step > np.iinfo(np.uint16).max:
+                step = float(max_coord / np.iinfo(np.uint16).max)
+            kpts = np.round((np.clip(kpts, -0.5, None) + 0.5) / step)
+        dsets.append(write_dense_dataset(grp, key, kpts, conf["keypoints"], conf, step))
+    dsets.append(write_dense_dataset(grp, "scores", scores, conf["scores"], conf))
+    raw_bytes = kpts0.nbytes + kpts1.nbytes + scores.nbytes
+    return raw_bytes, sum(d.id.get_storage_size() for d in dsets)
+
+
+def read_dense_dataset(dset):
+    data = dset.__array__()
+    if "step" in dset.attrs:
+        data = data.astype(np.float32) * np.float32(dset.attrs["step"]) - 0.5
+    elif data.dtype == np.float16:
+        data = data.astype(np.float32)
+    return data
+
+
+def read_dense_matches(grp):
+    kpts0 = read_dense_dataset(grp["keypoints0"])
+    kpts1 = read_dense_dataset(grp["keypoints1"])
+    scores = read_dense_dataset(grp["scores"])
+    return kpts0, kpts1, scores
+
+
 def to_cpts(kpts, ps):
     if ps > 0.0:
         kpts = np.round(np.round((kpts + 0.5) / ps) * ps - 0.5, 2)
     return [tuple(cpt) for cpt in kpts]
 
 
+def nn_assign(tree: Optional[KDTree], kpts: np.ndarray, max_error: float):
+    if tree is None or len(kpts) == 0:
+        return np.full(len(kpts), -1)
+    dist, kpt_ids = tree.query(kpts, workers=-1)
+    kpt_ids[dist > max_error] = -1
+    return kpt_ids
+
+
+class KDTreeCache:
+    """LRU cache of KD-trees over the fixed keypoints of each image,
+    such that images shared by many pairs are indexed only once."""
+
+    def __init__(self, keypoints: Dict[str, np.ndarray], max_size: int = 512):
+        self.keypoints = keypoints
+        self.max_size = max_size
+        self.trees = OrderedDict()
+
+    def __getitem__(self, name: str) -> Optional[KDTree]:
+        if name in self.trees:
+            self.trees.move_to_end(name)
+            return self.trees[name]
+        kpts = self.keypoints[name]
+        tree = KDTree(np.asarray(kpts)) if len(kpts) > 0 else None
+        self.trees[name] = tree
+        if len(self.trees) > self.max_size:
+            self.trees.popitem(last=False)
+        return tree
+
+    def query(self, name: str, kpts: np.ndarray, max_error: float):
+        return nn_assign(self[name], kpts, max_error)
+
+
 def assign_keypoints(
     kpts: np.ndarray,
     other_cpts: Union[List[Tuple], np.ndarray],
@@ -136,10 +238,7 @@ def assign_keypoints(
         # Without update this is just a NN search
         if len(other_cpts) == 0 or len(kpts) == 0:
             return np.full(len(kpts), -1)
-        dist, kpt_ids = KDTree(np.array(other_cpts)).query(kpts)
-        valid = dist <= max_error
-        kpt_ids[~valid] = -1
-        return kpt_ids
+        return nn_assign(KDTree(np.array(other_cpts)), kpts, max_error)
     else:
         ps = cell_size if cell_size is not None else max_error
         ps = max(ps, max_error)
@@ -282,6 +381,252 @@ class ImagePairDataset(torch.utils.data.Dataset):
         return image0, image1, scale0, scale1, name0, name1
 
 
+class KeypointAggregator:
+    """Aggregate the dense matches of each image into a set of keypoints.
+
+    Pairs are sorted such that images are finalised early, at which point
+    their bins are converted to keypoints and written to feature_path.
+    In streaming mode, the dense matches of pairs that need to be reassigned
+    to the top-k keypoints are held in memory until both images are final.
+    """
+
+    def __init__(
+        self,
+        conf: Dict,
+        pairs: List[Tuple[str, str]],
+        feature_path: Path,
+        required_queries: Optional[Set[str]] = None,
+        max_kps: Optional[int] = None,
+        cpdict: Dict[str, Iterable] = defaultdict(list),
+        bindict: Dict[str, List[Counter]] = defaultdict(list),
+    ):
+        if required_queries is None:
+            required_queries = set(sum(pairs, ()))
+            # default: do not overwrite existing features in feature_path!
+            required_queries -= set(list_h5_names(feature_path))
+
+        # if an entry in cpdict is provided as np.ndarray we assume it is fixed
+        required_queries -= set(
+            [k for k, v in cpdict.items() if isinstance(v, np.ndarray)]
+        )
+
+        # sort pairs for reduced RAM
+        pairs_per_q = Counter(list(chain(*pairs)))
+        pairs_score = [min(pairs_per_q[i], pairs_per_q[j]) for i, j in pairs]
+        self.pairs = [p for _, p in sorted(zip(pairs_score, pairs))]
+
+        self.conf = conf
+        self.feature_path = feature_path
+        self.required_queries = required_queries
+        self.max_kps = max_kps
+        self.cpdict = cpdict
+        self.bindict = bindict
+        self.pairs_per_q = pairs_per_q
+        self.n_kps = 0
+        self.pending = {}
+        self.pending_per_name = defaultdict(list)
+        # pairs written before the keypoints of one of their images are final
+        self.written_per_name = defaultdict(list)
+        self.trees = KDTreeCache(cpdict)
+
+        if len(required_queries) > 0:
+            logger.info(f"Aggregating keypoints for {len(required_queries)} images.")
+
+    def assign(self, name0, name1, kpts0, kpts1, scores):
+        conf, cpdict, bindict = self.conf, self.cpdict, self.bindict
+
+        # Aggregate local features
+        update0 = name0 in self.required_queries
+        update1 = name1 in self.required_queries
+
+        # in localization we do not want to bin the query kp
+        # assumes that the query is name0!
+        if update0 and not update1 and self.max_kps is None:
+            max_error0 = cell_size0 = 0.0
+        else:
+            max_error0 = conf["max_error"]
+            cell_size0 = conf["cell_size"]
+
+        # Get match ids and extend query keypoints (cpdict)
+        mkp_ids0 = assign_keypoints(
+            kpts0,
+            cpdict[name0],
+            max_error0,
+            update0,
+            bindict[name0],
+            scores,
+            cell_size0,
+        )
+        mkp_ids1 = assign_keypoints(
+            kpts1,
+            cpdict[name1],
+            conf["max_error"],
+            update1,
+            bindict[name1],
+            scores,
+            conf["cell_size"],
+        )
+
+        # Build matches from assignments
+        assert kpts0.shape[0] == scores.shape[0]
+        return kpids_to_matches0(mkp_ids0, mkp_ids1, scores)
+
+    def finish_pair(self, name0, name1) -> List[str]:
+        """Count the pair as processed and finalise its completed images."""
+        finished = []
+        for name in (name0, name1):
+            self.pairs_per_q[name] -= 1
+            if self.pairs_per_q[name] > 0 or name not in self.required_queries:
+                continue
+            self.finalize(name)
+            finished.append(name)
+        return finished
+
+    def is_final(self, name) -> bool:
+        return name not in self.required_queries or self.pairs_per_q[name] <= 0
+
+    def finalize(self, name):
+        # Convert bins to kps and store them
+        cpdict, bindict = self.cpdict, self.bindict
+        kp_score = [c.most_common(1)[0][1] for c in bindict[name]]
+        cpdict[name] = [c.most_common(1)[0][0] for c in bindict[name]]
+        cpdict[name] = np.array(cpdict[name], dtype=np.float32)
+
+        # Select top-k query kps by score (reassign matches later)
+        if self.max_kps:
+            top_k = min(self.max_kps, cpdict[name].shape[0])
+            top_k = np.argsort(kp_score)[::-1][:top_k]
+            cpdict[name] = cpdict[name][top_k]
+            kp_score = np.array(kp_score)[top_k]
+
+        # Write query keypoints
+        with h5py.File(self.feature_path, "a") as kfd:
+            if name in kfd:
+                del kfd[name]
+            kgrp = kfd.create_group(name)
+            kgrp.create_dataset("keypoints", data=cpdict[name])
+            kgrp.create_dataset("score", data=kp_score)
+            self.n_kps += cpdict[name].shape[0]
+        del bindict[name]
+        self.pairs_per_q[name] = 0
+
+    def stream(self, name0, name1, kpts0, kpts1, scores):
+        """Aggregate a pair and return the matches that are now final."""
+        matches0, scores0 = self.assign(name0, name1, kpts0, kpts1, scores)
+        finished = self.finish_pair(name0, name1)
+        if self.max_kps is None:
+            for name in (name0, name1):
+                if not self.is_final(name):
+                    self.written_per_name[name].append((name0, name1))
+            for name in finished:
+                self.written_per_name.pop(name, None)
+            return [((name0, name1), matches0, scores0)]
+
+        # Invalidate matches that are far from the selected bins once known
+        self.pending[name0, name1] = (kpts0, kpts1, scores)
+        self.pending_per_name[name0].append((name0, name1))
+        self.pending_per_name[name1].append((name0, name1))
+        candidates = [(name0, name1)]
+        for name in finished:
+            candidates += self.pending_per_name.pop(name, [])
+        return self.reassign(candidates)
+
+    def reassign(self, pairs):
+        ready = []
+        for name0, name1 in pairs:
+            if (name0, name1) not in self.pending:
+                continue
+            if not (self.is_final(name0) and self.is_final(name1)):
+                continue
+            kpts0, kpts1, scores = self.pending.pop((name0, name1))
+            max_error = self.conf["max_error"]
+            mkp_ids0 = self.trees.query(name0, kpts0, max_error)
+            mkp_ids1 = self.trees.query(name1, kpts1, max_error)
+            matches0, scores0 = kpids_to_matches0(mkp_ids0, mkp_ids1, scores)
+            ready.append(((name0, name1), matches0, scores0))
+        return ready
+
+    def flush(self) -> Tuple[List, List[Tuple[str, str]]]:
+        """Return the pending matches whose images are final and, e.g. after
+        an interruption, the pairs already written with an image that is not.
+        Such images are not written, so the next run aggregates them again
+        from all their pairs, which must then be matched again."""
+        ready = self.reassign(list(self.pending))
+        self.pending.clear()
+        self.pending_per_name.clear()
+        incomplete = set()
+        for name in self.required_queries:
+            if not self.is_final(name):
+                incomplete.update(self.written_per_name.pop(name, []))
+        return ready, sorted(incomplete)
+
+    def log_summary(self):
+        if len(self.required_queries) > 0:
+            avg_kp_per_image = round(self.n_kps / len(self.required_queries), 1)
+            logger.info(
+                f"Finished assignment, found {avg_kp_per_image} "
+                f"keypoints/image (avg.), total {self.n_kps}."
+            )
+
+
+def postprocess_dense(kpts0, kpts1, scores, scale0, scale1):
+    # Rescale keypoints and move to cpu
+    kpts0 = scale_keypoints(kpts0 + 0.5, scale0) - 0.5
+    kpts1 = scale_keypoints(kpts1 + 0.5, scale1) - 0.5
+    kpts0 = kpts0.cpu().numpy()
+    kpts1 = kpts1.cpu().numpy()
+    if scores is not None:
+        scores = scores.cpu().numpy()
+    else:
+        scores = np.ones((len(kpts1),), dtype=np.float32)
+    return kpts0, kpts1, scores
+
+
+def dense_writer_fn(inp, fd: h5py.File, conf: Dict, stats: Counter):
+    (name0, name1), pred = inp
+    kpts0, kpts1, scores = postprocess_dense(*pred)
+
+    # Write matches and matching scores in hloc format
+    pair = names_to_pair(name0, name1)
+    if pair in fd:
+        del fd[pair]
+    grp = fd.create_group(pair)
+
+    # Write dense matching output
+    raw_bytes, stored_bytes = write_dense_matches(grp, kpts0, kpts1, scores, conf)
+    stats.update(pairs=1, raw=raw_bytes, stored=stored_bytes)
+
+
+def write_streamed_matches(fd: h5py.File, matches):
+    for (name0, name1), matches0, scores0 in matches:
+        pair = names_to_pair(name0, name1)
+        if pair in fd:
+            del fd[pair]
+        grp = fd.create_group(pair)
+        grp.create_dataset("matches0", data=matches0)
+        grp.create_dataset("matching_scores0", data=scores0)
+
+
+def streaming_writer_fn(inp, fd: h5py.File, aggregator: KeypointAggregator):
+    (name0, name1), pred = inp
+    kpts0, kpts1, scores = postprocess_dense(*pred)
+    write_streamed_matches(fd, aggregator.stream(name0, name1, kpts0, kpts1, scores))
+
+
+def log_storage_stats(stats: Counter):
+    if stats["pairs"] == 0:
+        return
+    raw, stored = stats["raw"] / stats["pairs"], stats["stored"] / stats["pairs"]
+    logger.info(
+        f"Stored dense matches with {stored / 1e3:.1f} kB/pair "
+        f"({raw / 1e3:.1f} kB/pair before encoding, "
+        f"ratio {raw / max(stored, 1):.2f})."
+    )
+
+
+stop = False  # set by the signal handler to interrupt the matching loop
+
+
 @torch.no_grad()
 def match_dense(
     conf: Dict,
@@ -289,7 +634,12 @@ def match_dense(
     image_dir: Path,
     match_path: Path,  # out
     existing_refs: Optional[List] = [],
+    queue_size: int = 8,
+    aggregator: Optional[KeypointAggregator] = None,
 ):
+    """Run the dense matcher on all pairs. By default, the raw dense matches
+    are written to match_path. If an aggregator is given, they are instead
+    aggregated on the fly and only the assigned matches are written."""
     device = "cuda" if torch.cuda.is_available() else "cpu"
     Model = dynamic_load(matchers, conf["model"]["name"])
     model = Model(conf["model"]).eval().to(device)
@@ -299,49 +649,83 @@ def match_dense(
         dataset, num_workers=16, batch_size=1, shuffle=False
     )
 
+    # matchers with a per-image encoder cache need the image names as keys
+    encoder_cache = getattr(model, "encoder_cache", None)
+
     logger.info("Performing dense matching...")
     with h5py.File(str(match_path), "a") as fd:
-        for data in tqdm(loader, smoothing=0.1):
-            # load image-pair data
-            image0, image1, scale0, scale1, (name0,), (name1,) = data
-            scale0, scale1 = scale0[0].numpy(), scale1[0].numpy()
-            image0, image1 = image0.to(device), image1.to(device)
-
-            # match semi-dense
-            # for consistency with pairs_from_*: refine kpts of image0
-            if name0 in existing_refs:
-                # special case: flip to enable refinement in query image
-                pred = model({"image0": image1, "image1": image0})
-                pred = {
-                    **pred,
-                    "keypoints0": pred["keypoints1"],
-                    "keypoints1": pred["keypoints0"],
-                }
-            else:
-                # usual case
-                pred = model({"image0": image0, "image1": image1})
-
-            # Rescale keypoints and move to cpu
-            kpts0, kpts1 = pred["keypoints0"], pred["keypoints1"]
-            kpts0 = scale_keypoints(kpts0 + 0.5, scale0) - 0.5
-            kpts1 = scale_keypoints(kpts1 + 0.5, scale1) - 0.5
-            kpts0 = kpts0.cpu().numpy()
-            kpts1 = kpts1.cpu().numpy()
-            if "scores" in pred:
-                scores = pred["scores"].cpu().numpy()
-            else:
-                scores = np.ones((len(kpts1),), dtype=np.float32)
-
-            # Write matches and matching scores in hloc format
-            pair = names_to_pair(name0, name1)
-            if pair in fd:
-                del fd[pair]
-            grp = fd.create_group(pair)
-
-            # Write dense matching output
-            grp.create_dataset("keypoints0", data=kpts0)
-            grp.create_dataset("keypoints1", data=kpts1)
-            grp.create_dataset("scores", data=scores)
+        # A single writer thread owns the file handle: rescaling, the copy to
+        # cpu and the HDF5 writes overlap with the inference of the next pair.
+        # The queue is bounded to keep at most queue_size predictions alive.
+        storage_conf = {**default_storage_conf, **conf.get("storage", {})}
+        stats = Counter()
+        if aggregator is None:
+            writer_fn = partial(dense_writer_fn, fd=fd, conf=storage_conf, stats=stats)
+        else:
+            writer_fn = partial(streaming_writer_fn, fd=fd, aggregator=aggregator)
+        writer_queue = WorkQueue(writer_fn, 1, queue_size)
+        try:
+            for data in tqdm(loader, smoothing=0.1):
+                # load image-pair data
+                image0, image1, scale0, scale1, (name0,), (name1,) = data
+                scale0, scale1 = scale0[0].numpy(), scale1[0].numpy()
+                image0, image1 = image0.to(device), image1.to(device)
+
+                # match semi-dense
+                # for consistency with pairs_from_*: refine kpts of image0
+                if name0 in existing_refs:
+                    # special case: flip to enable refinement in query image
+                    inp = {"image0": image1, "image1": image0}
+                    if encoder_cache is not None:
+                        inp.update(name0=name1, name1=name0)
+                    pred = model(inp)
+                    pred = {
+                        **pred,
+                        "keypoints0": pred["keypoints1"],
+                        "keypoints1": pred["keypoints0"],
+                    }
+                else:
+                    # usual case
+                    inp = {"image0": image0, "image1": image1}
+                    if encoder_cache is not None:
+                        inp.update(name0=name0, name1=name1)
+                    pred = model(inp)
+
+                writer_queue.put(
+                    (
+                        (name0, name1),
+                        (
+                            pred["keypoints0"],
+                            pred["keypoints1"],
+                            pred.get("scores"),
+                            scale0,
+                            scale1,
+                        ),
+                    )
+                )
+                del pred
+                if stop:
+                    logger.info("Dense matching interrupted.")
+                    break
+        finally:
+            # flush the pending pairs before the file is closed
+            writer_queue.join()
+            if aggregator is not None:
+                ready, incomplete = aggregator.flush()
+                write_streamed_matches(fd, ready)
+                for name0, name1 in incomplete:
+                    del fd[names_to_pair(name0, name1)]
+                if len(incomplete) > 0:
+                    logger.info(
+                        f"Dropped the matches of {len(incomplete)} pairs "
+                        "with partially aggregated images."
+                    )
+    if aggregator is None:
+        log_storage_stats(stats)
+    else:
+        aggregator.log_summary()
+    if encoder_cache is not None:
+        logger.info(f"Finished dense matching with {encoder_cache}.")
     del model, loader
 
 
@@ -398,102 +782,22 @@ def aggregate_matches(
     cpdict: Dict[str, Iterable] = defaultdict(list),
     bindict: Dict[str, List[Counter]] = defaultdict(list),
 ):
-    if required_queries is None:
-        required_queries = set(sum(pairs, ()))
-        # default: do not overwrite existing features in feature_path!
-        required_queries -= set(list_h5_names(feature_path))
-
-    # if an entry in cpdict is provided as np.ndarray we assume it is fixed
-    required_queries -= set([k for k, v in cpdict.items() if isinstance(v, np.ndarray)])
-
-    # sort pairs for reduced RAM
-    pairs_per_q = Counter(list(chain(*pairs)))
-    pairs_score = [min(pairs_per_q[i], pairs_per_q[j]) for i, j in pairs]
-    pairs = [p for _, p in sorted(zip(pairs_score, pairs))]
-
-    if len(required_queries) > 0:
-        logger.info(f"Aggregating keypoints for {len(required_queries)} images.")
-    n_kps = 0
+    aggregator = KeypointAggregator(
+        conf, pairs, feature_path, required_queries, max_kps, cpdict, bindict
+    )
     with h5py.File(str(match_path), "a") as fd:
-        for name0, name1 in tqdm(pairs, smoothing=0.1):
+        for name0, name1 in tqdm(aggregator.pairs, smoothing=0.1):
             pair = names_to_pair(name0, name1)
             grp = fd[pair]
-            kpts0 = grp["keypoints0"].__array__()
-            kpts1 = grp["keypoints1"].__array__()
-            scores = grp["scores"].__array__()
-
-            # Aggregate local features
-            update0 = name0 in required_queries
-            update1 = name1 in required_queries
-
-            # in localization we do not want to bin the query kp
-            # assumes that the query is name0!
-            if update0 and not update1 and max_kps is None:
-                max_error0 = cell_size0 = 0.0
-            else:
-                max_error0 = conf["max_error"]
-                cell_size0 = conf["cell_size"]
-
-            # Get match ids and extend query keypoints (cpdict)
-            mkp_ids0 = assign_keypoints(
-                kpts0,
-                cpdict[name0],
-                max_error0,
-                update0,
-                bindict[name0],
-                scores,
-                cell_size0,
-            )
-            mkp_ids1 = assign_keypoints(
-                kpts1,
-                cpdict[name1],
-                conf["max_error"],
-                update1,
-                bindict[name1],
-                scores,
-                conf["cell_size"],
-            )
-
-            # Build matches from assignments
-            matches0, scores0 = kpids_to_matches0(mkp_ids0, mkp_ids1, scores)
+            kpts0, kpts1, scores = read_dense_matches(grp)
 
-            assert kpts0.shape[0] == scores.shape[0]
+            matches0, scores0 = aggregator.assign(name0, name1, kpts0, kpts1, scores)
             grp.create_dataset("matches0", data=matches0)
             grp.create_dataset("matching_scores0", data=scores0)
 
-            # Convert bins to kps if finished, and store them
-            for name in (name0, name1):
-                pairs_per_q[name] -= 1
-                if pairs_per_q[name] > 0 or name not in required_queries:
-                    continue
-                kp_score = [c.most_common(1)[0][1] for c in bindict[name]]
-                cpdict[name] = [c.most_common(1)[0][0] for c in bindict[name]]
-                cpdict[name] = np.array(cpdict[name], dtype=np.float32)
-
-                # Select top-k query kps by score (reassign matches later)
-                if max_kps:
-                    top_k = min(max_kps, cpdict[name].shape[0])
-                    top_k = np.argsort(kp_score)[::-1][:top_k]
-                    cpdict[name] = cpdict[name][top_k]
-                    kp_score = np.array(kp_score)[top_k]
-
-                # Write query keypoints
-                with h5py.File(feature_path, "a") as kfd:
-                    if name in kfd:
-                        del kfd[name]
-                    kgrp = kfd.create_group(name)
-                    kgrp.create_dataset("keypoints", data=cpdict[name])
-                    kgrp.create_dataset("score", data=kp_score)
-                    n_kps += cpdict[name].shape[0]
-                del bindict[name]
-
-    if len(required_queries) > 0:
-        avg_kp_per_image = round(n_kps / len(required_queries), 1)
-        logger.info(
-            f"Finished assignment, found {avg_kp_per_image} "
-            f"keypoints/image (avg.), total {n_kps}."
-        )
-    return cpdict
+            aggregator.finish_pair(name0, name1)
+    aggregator.log_summary()
+    return aggregator.cpdict
 
 
 def assign_matches(
@@ -501,47 +805,87 @@ def assign_matches(
     match_path: Path,
     keypoints: Union[List[Path], Dict[str, np.array]],
     max_error: float,
+    cache_size: int = 512,
 ):
     if isinstance(keypoints, list):
-        keypoints = load_keypoints({}, keypoints, kpts_as_bin=set([]))
+        keypoints, _ = load_keypoints({}, keypoints, quantize=set())
     assert len(set(sum(pairs, ())) - set(keypoints.keys())) == 0
-    with h5py.File(str(match_path), "a") as fd:
-        for name0, name1 in tqdm(pairs):
-            pair = names_to_pair(name0, name1)
-            grp = fd[pair]
-            kpts0 = grp["keypoints0"].__array__()
-            kpts1 = grp["keypoints1"].__array__()
-            scores = grp["scores"].__array__()
+    trees = KDTreeCache(keypoints, cache_size)
 
-            # NN search across cell boundaries
-            mkp_ids0 = assign_keypoints(kpts0, keypoints[name0], max_error)
-            mkp_ids1 = assign_keypoints(kpts1, keypoints[name1], max_error)
+    # group the pairs by their first image to query its tree once per group
+    pairs_per_name0 = defaultdict(list)
+    for name0, name1 in pairs:
+        pairs_per_name0[name0].append(name1)
 
-            matches0, scores0 = kpids_to_matches0(mkp_ids0, mkp_ids1, scores)
+    with h5py.File(str(match_path), "a") as fd, tqdm(total=len(pairs)) as pbar:
+        for name0, names1 in pairs_per_name0.items():
+            grps = [fd[names_to_pair(name0, name1)] for name1 in names1]
+            dense = [read_dense_matches(grp) for grp in grps]
 
-            # overwrite matches0 and matching_scores0
-            del grp["matches0"], grp["matching_scores0"]
-            grp.create_dataset("matches0", data=matches0)
-            grp.create_dataset("matching_scores0", data=scores0)
+            # NN search across cell boundaries
+            kpts0 = np.concatenate([kpts0 for kpts0, _, _ in dense])
+            splits = np.cumsum([len(kpts0) for kpts0, _, _ in dense])[:-1]
+            mkp_ids0 = np.split(trees.query(name0, kpts0, max_error), splits)
+            for name1, grp, (_, kpts1, scores), ids0 in zip(
+                names1, grps, dense, mkp_ids0
+            ):
+                mkp_ids1 = trees.query(name1, kpts1, max_error)
+                matches0, scores0 = kpids_to_matches0(ids0, mkp_ids1, scores)
+
+                # overwrite matches0 and matching_scores0
+                del grp["matches0"], grp["matching_scores0"]
+                grp.create_dataset("matches0", data=matches0)
+                grp.create_dataset("matching_scores0", data=scores0)
+                pbar.update()
+
+
+def drop_dense_matches(match_path: Path, num_pairs: int):
+    """Remove the raw dense correspondences once the matches are assigned.
+    HDF5 does not reclaim the space of deleted datasets, so the file is
+    rewritten with only the assigned matches."""
+    dense_keys = {"keypoints0", "keypoints1", "scores"}
+    size_before = match_path.stat().st_size
+    tmp_path = match_path.with_name(match_path.name + ".tmp")
+    with h5py.File(str(match_path), "r") as fd, h5py.File(str(tmp_path), "w") as fo:
+
+        def visit_fn(name, obj):
+            key = name.split("/")[-1]
+            if isinstance(obj, h5py.Dataset) and key not in dense_keys:
+                fo.require_group(obj.parent.name)
+                fd.copy(obj, fo[obj.parent.name])
+
+        fd.visititems(visit_fn)
+    tmp_path.replace(match_path)
+    size_after = match_path.stat().st_size
+    logger.info(
+        f"Dropped dense correspondences: {size_before / 1e6:.1f} MB "
+        f"-> {size_after / 1e6:.1f} MB "
+        f"({(size_before - size_after) / max(num_pairs, 1) / 1e3:.1f} kB/pair)."
+    )
 
 
 @torch.no_grad()
 def match_and_assign(
     conf: Dict,
-    pairs_path: Path,
+    pairs_path: Union[Path, PairSource],
     image_dir: Path,
     match_path: Path,  # out
     feature_path_q: Path,  # out
     feature_paths_refs: Optional[List[Path]] = [],
     max_kps: Optional[int] = 8192,
     overwrite: bool = False,
+    keep_dense: bool = True,
+    streaming: bool = False,
 ) -> Path:
     for path in feature_paths_refs:
         if not path.exists():
             raise FileNotFoundError(f"Reference feature file {path}.")
-    pairs = parse_retrieval(pairs_path)
-    pairs = [(q, r) for q, rs in pairs.items() for r in rs]
-    pairs = find_unique_new_pairs(pairs, None if overwrite else match_path)
+    pairs = as_pair_source(pairs_path)
+    if pairs.unique:
+        existing = set() if overwrite else find_existing_pairs(match_path)
+        pairs = list(iter_new_pairs(pairs, existing))
+    else:
+        pairs = find_unique_new_pairs(pairs, None if overwrite else match_path)
     required_queries = set(chain.from_iterable(pairs))
 
     name2ref = {
@@ -563,8 +907,37 @@ def match_and_assign(
         logger.info("All pairs exist. Skipping dense matching.")
         return
 
+    if streaming:
+        # aggregate the matches as they come out of the model, without
+        # writing the dense matches to disk
+        cpdict, bindict = load_keypoints(
+            conf, feature_paths_refs, quantize=required_queries
+        )
+        aggregator = KeypointAggregator(
+            conf,
+            pairs,
+            feature_path_q,
+            required_queries=required_queries,
+            max_kps=max_kps,
+            cpdict=cpdict,
+            bindict=bindict,
+        )
+        match_dense(
+            conf,
+            aggregator.pairs,
+            image_dir,
+            match_path,
+            existing_refs=existing_refs,
+            aggregator=aggregator,
+        )
+        return
+
     # extract semi-dense matches
     match_dense(conf, pairs, image_dir, match_path, existing_refs=existing_refs)
+    if stop:
+        # the pairs without matches0 are matched again by the next run
+        logger.info("Skipping the assignment of interrupted dense matches.")
+        return
 
     logger.info("Assigning matches...")
 
@@ -590,11 +963,14 @@ def match_and_assign(
         logger.info(f'Reassign matches with max_error={conf["max_error"]}.')
         assign_matches(pairs, match_path, cpdict, max_error=conf["max_error"])
 
+    if not keep_dense:
+        drop_dense_matches(match_path, len(pairs))
+
 
 @torch.no_grad()
 def main(
     conf: Dict,
-    pairs: Path,
+    pairs: Union[Path, PairSource],
     image_dir: Path,
     export_dir: Optional[Path] = None,
     matches: Optional[Path] = None,  # out
@@ -602,6 +978,8 @@ def main(
     features_ref: Optional[Path] = None,
     max_kps: Optional[int] = 8192,
     overwrite: bool = False,
+    keep_dense: bool = True,
+    streaming: bool = False,
 ) -> Path:
     logger.info(
         "Extracting semi-dense features with configuration:" f"\n{pprint.pformat(conf)}"
@@ -624,6 +1002,8 @@ def main(
             )
         features_q = Path(export_dir, f'{features}{conf["output"]}.h5')
         if matches is None:
+            if isinstance(pairs, PairSource):
+                raise ValueError("Provide the matches path for a pair source.")
             matches = Path(export_dir, f'{conf["output"]}_{pairs.stem}.h5')
 
     if features_ref is None:
@@ -636,13 +1016,31 @@ def main(
         raise TypeError(str(features_ref))
 
     match_and_assign(
-        conf, pairs, image_dir, matches, features_q, features_ref, max_kps, overwrite
+        conf,
+        pairs,
+        image_dir,
+        matches,
+        features_q,
+        features_ref,
+        max_kps,
+        overwrite,
+        keep_dense,
+        streaming,
     )
 
     return features_q, matches
 
 
 if __name__ == "__main__":
+
+    def signal_handler(sig, frame):
+        global stop
+        stop = True
+        logger.info(f"Terminating due to signal {sig}.")
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--pairs", type=Path, required=True)
     parser.add_argument("--image_dir", type=Path, required=True)
@@ -652,6 +1050,7 @@ if __name__ == "__main__":
         "--features", type=str, default="feats_" + confs["loftr"]["output"]
     )
     parser.add_argument("--conf", type=str, default="loftr", choices=list(confs.keys()))
+    parser.add_argument("--streaming", action="store_true")
     args = parser.parse_args()
     main(
         confs[args.conf],
@@ -660,4 +1059,5 @@ if __name__ == "__main__":
         args.export_dir,
         args.matches,
         args.features,
+        streaming=args.streaming,
     )
@@ -3,10 +3,11 @@ import signal
 import argparse
 import pprint
 from functools import partial
+from itertools import chain
 from pathlib import Path
 from queue import Queue
 from threading import Thread
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import h5py
 import torch
@@ -14,7 +15,8 @@ from tqdm import tqdm
 
 from . import logger, matchers
 from .utils.base_model import dynamic_load
-from .utils.parsers import names_to_pair, names_to_pair_old, parse_retrieval
+from .utils.pair_sources import PairSource, as_pair_source
+from .utils.parsers import names_to_pair, names_to_pair_old
 
 """
 A set of standard configurations that can be directly selected from the command
@@ -95,8 +97,11 @@ confs = {
 
 
 class WorkQueue:
-    def __init__(self, work_fn, num_threads=1):
-        self.queue = Queue(num_threads)
+    def __init__(self, work_fn, num_threads=1, maxsize=None):
+        # the queue is bounded so that producers block instead of piling up
+        # predictions (possibly on the GPU) when the consumers are slower
+        self.queue = Queue(num_threads if maxsize is None else maxsize)
+        self.error = None
         self.threads = [
             Thread(target=self.thread_fn, args=(work_fn,)) for _ in range(num_threads)
         ]
@@ -108,17 +113,42 @@ class WorkQueue:
             self.queue.put(None)
         for thread in self.threads:
             thread.join()
+        if self.error is not None:
+            raise self.error
 
     def thread_fn(self, work_fn):
         item = self.queue.get()
         while item is not None:
-            work_fn(item)
+            # keep draining after a failure so that the producer never blocks
+            if self.error is None:
+                try:
+                    work_fn(item)
+                except Exception as error:
+                    self.error = error
             item = self.queue.get()
 
     def put(self, data):
+        if self.error is not None:
+            raise self.error
         self.queue.put(data)
 
 
+def read_pair_features(name0, name1, feature_path_q, feature_path_r):
+    data = {}
+    with h5py.File(feature_path_q, "r") as fd:
+        grp = fd[name0]
+        for k, v in grp.items():
+            data[k + "0"] = torch.from_numpy(v.__array__()).float()
+        # some matchers might expect an image but only use its size
+        data["image0"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
+    with h5py.File(feature_path_r, "r") as fd:
+        grp = fd[name1]
+        for k, v in grp.items():
+            data[k + "1"] = torch.from_numpy(v.__array__()).float()
+        data["image1"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
+    return data
+
+
 class FeaturePairsDataset(torch.utils.data.Dataset):
     def __init__(self, pairs, feature_path_q, feature_path_r):
         self.pairs = pairs
@@ -127,24 +157,34 @@ class FeaturePairsDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         name0, name1 = self.pairs[idx]
-        data = {}
-        with h5py.File(self.feature_path_q, "r") as fd:
-            grp = fd[name0]
-            for k, v in grp.items():
-                data[k + "0"] = torch.from_numpy(v.__array__()).float()
-            # some matchers might expect an image but only use its size
-            data["image0"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-        with h5py.File(self.feature_path_r, "r") as fd:
-            grp = fd[name1]
-            for k, v in grp.items():
-                data[k + "1"] = torch.from_numpy(v.__array__()).float()
-            data["image1"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-        return data
+        return read_pair_features(
+            name0, name1, self.feature_path_q, self.feature_path_r
+        )
 
     def __len__(self):
         return len(self.pairs)
 
 
+class FeaturePairsStream(torch.utils.data.IterableDataset):
+    """Features of the new pairs of a lazy pair source, with their names.
+    Each DataLoader worker only generates its own shard of the blocks."""
+
+    def __init__(self, pairs: PairSource, existing, feature_path_q, feature_path_r):
+        self.pairs = pairs
+        self.existing = existing
+        self.feature_path_q = feature_path_q
+        self.feature_path_r = feature_path_r
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        shard = chain.from_iterable(self.pairs.shard(worker_id, num_workers))
+        for name0, name1 in iter_new_pairs(shard, self.existing):
+            yield (name0, name1), read_pair_features(
+                name0, name1, self.feature_path_q, self.feature_path_r
+            )
+
+
 def writer_fn(inp, match_path):
     pair, pred = inp
     with h5py.File(str(match_path), "a", libver="latest") as fd:
@@ -160,7 +200,7 @@ def writer_fn(inp, match_path):
 
 def main(
     conf: Dict,
-    pairs: Path,
+    pairs: Union[Path, PairSource],
     features: Union[Path, str],
     export_dir: Optional[Path] = None,
     matches: Optional[Path] = None,
@@ -180,6 +220,8 @@ def main(
             )
         features_q = Path(export_dir, features + ".h5")
         if matches is None:
+            if isinstance(pairs, PairSource):
+                raise ValueError("Provide the matches path for a pair source.")
             matches = Path(export_dir, f'{features}_{conf["output"]}_{pairs.stem}.h5')
 
     if features_ref is None:
@@ -189,6 +231,11 @@ def main(
     return matches
 
 
+def has_matches(fd: h5py.File, pair: str) -> bool:
+    """Groups of interrupted dense matching only hold the dense matches."""
+    return pair in fd and "matches0" in fd[pair]
+
+
 def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
     """Avoid to recompute duplicates to save time."""
     pairs = set()
@@ -202,10 +249,10 @@ def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
             pairs_filtered = []
             for i, j in pairs:
                 if (
-                    names_to_pair(i, j) in fd
-                    or names_to_pair(j, i) in fd
-                    or names_to_pair_old(i, j) in fd
-                    or names_to_pair_old(j, i) in fd
+                    has_matches(fd, names_to_pair(i, j))
+                    or has_matches(fd, names_to_pair(j, i))
+                    or has_matches(fd, names_to_pair_old(i, j))
+                    or has_matches(fd, names_to_pair_old(j, i))
                 ):
                     continue
                 pairs_filtered.append((i, j))
@@ -214,12 +261,45 @@ def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
     logger.info('find_unique_new_pairs finished without iteration.')
     return pairs
 
+
+def find_existing_pairs(match_path: Path) -> Set[str]:
+    """Keys of the pairs of a match file that have matches, in the new or old
+    format."""
+    existing = set()
+    if match_path is None or not match_path.exists():
+        return existing
+    with h5py.File(str(match_path), "r", libver="latest") as fd:
+        for key, grp in fd.items():
+            if "matches0" in grp:
+                existing.add(key)
+            else:
+                existing.update(
+                    f"{key}/{key1}" for key1, g in grp.items() if "matches0" in g
+                )
+    return existing
+
+
+def iter_new_pairs(
+    pairs: Iterable[Tuple[str, str]], existing: Set[str]
+) -> Iterator[Tuple[str, str]]:
+    """Lazily skip the pairs that already are in a match file, in any order."""
+    for i, j in pairs:
+        if len(existing) > 0 and (
+            names_to_pair(i, j) in existing
+            or names_to_pair(j, i) in existing
+            or names_to_pair_old(i, j) in existing
+            or names_to_pair_old(j, i) in existing
+        ):
+            continue
+        yield i, j
+
+
 stop = False  # when importing package
 
 @torch.no_grad()
 def match_from_paths(
     conf: Dict,
-    pairs_path: Path,
+    pairs_path: Union[Path, PairSource],
     match_path: Path,
     feature_path_q: Path,
     feature_path_ref: Path,
@@ -235,10 +315,14 @@ def match_from_paths(
         raise FileNotFoundError(f"Reference feature file {feature_path_ref}.")
     match_path.parent.mkdir(exist_ok=True, parents=True)
 
-    assert pairs_path.exists(), pairs_path
+    # lazy sources of unique pairs are streamed, without materializing them
+    streamed = isinstance(pairs_path, PairSource) and pairs_path.unique
+    if not isinstance(pairs_path, PairSource):
+        assert pairs_path.exists(), pairs_path
 
     # if running in a slurm environment, get job id
-    is_slurm = "SLURM_JOB_ID" in os.environ
+    # the remaining pairs are only cached for pair files
+    is_slurm = "SLURM_JOB_ID" in os.environ and not isinstance(pairs_path, PairSource)
     if is_slurm:
         slurm_id = os.environ["SLURM_JOB_ID"]
         pairs_cache_path = pairs_path.with_name(f"{slurm_id}_pairs.txt")
@@ -249,35 +333,51 @@ def match_from_paths(
             pairs_path = pairs_cache_path
             overwrite = True  # skip duplicates checking
 
-    pairs = parse_retrieval(pairs_path)
-    pairs = [(q, r) for q, rs in pairs.items() for r in rs]
-    pairs = find_unique_new_pairs(pairs, None if overwrite else match_path)
-    if len(pairs) == 0:
-        logger.info('Skipping the matching.')
-        return
+    if streamed:
+        existing = set() if overwrite else find_existing_pairs(match_path)
+        dataset = FeaturePairsStream(
+            pairs_path, existing, feature_path_q, feature_path_ref
+        )
+        total = len(pairs_path)
+    else:
+        pairs = as_pair_source(pairs_path)
+        pairs = find_unique_new_pairs(pairs, None if overwrite else match_path)
+        if len(pairs) == 0:
+            logger.info('Skipping the matching.')
+            return
+        dataset = FeaturePairsDataset(pairs, feature_path_q, feature_path_ref)
+        total = len(pairs)
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     Model = dynamic_load(matchers, conf["model"]["name"])
     model = Model(conf["model"]).eval().to(device)
 
-    dataset = FeaturePairsDataset(pairs, feature_path_q, feature_path_ref)
     loader = torch.utils.data.DataLoader(
         dataset, num_workers=5, batch_size=1, shuffle=False, pin_memory=True
     )
     writer_queue = WorkQueue(partial(writer_fn, match_path=match_path), 5)
 
+    if streamed:
+        # the pairs come from the workers in no particular order
+        batches = ((tuple(n[0] for n in names), data) for names, data in loader)
+    else:
+        batches = zip(pairs, loader)
+
     logger.info(f'Starting matching loop {stop}')
-    for idx, data in enumerate(tqdm(loader, smoothing=0.1)):
-        data = {
-            k: v if k.startswith("image") else v.to(device, non_blocking=True)
-            for k, v in data.items()
-        }
-        pred = model(data)
-        pair = names_to_pair(*pairs[idx])
-        writer_queue.put((pair, pred))
-        if stop:
-            break
-    writer_queue.join()
+    try:
+        for idx, (pair, data) in enumerate(
+            tqdm(batches, total=total, smoothing=0.1)
+        ):
+            data = {
+                k: v if k.startswith("image") else v.to(device, non_blocking=True)
+                for k, v in data.items()
+            }
+            pred = model(data)
+            writer_queue.put((names_to_pair(*pair), pred))
+            if stop:
+                break
+    finally:
+        writer_queue.join()
 
     if is_slurm:
         if stop:
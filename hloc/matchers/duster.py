@@ -1,4 +1,5 @@
 import sys
+from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
@@ -23,12 +24,83 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # model hub: https://huggingface.co/Realcat/imatchui_checkpoint
 MODEL_REPO_ID = "Realcat/imatchui_checkpoints"
 
+class EncoderCache:
+    """LRU cache of per-image ViT encoder tokens with a byte budget.
+
+    The cache is installed in place of `_encode_image_pairs` of a CroCo-based
+    network, so that the rest of its forward (decoder and heads) is untouched.
+    Images are registered by name before each forward and identified by value
+    in the batches built by dust3r, since the collation copies the tensors.
+    Entries are keyed by image name and network input size.
+    """
+
+    def __init__(self, net, max_bytes):
+        self.net = net
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = self.misses = 0
+        self.current = []
+        self._encode_image_pairs = net._encode_image_pairs
+        net._encode_image_pairs = self.encode_image_pairs
+
+    def register(self, names, images):
+        self.current = list(zip(names, images))
+
+    def find_key(self, image):
+        for name, ref in self.current:
+            if ref.shape == image.shape and torch.equal(ref, image):
+                return (name, tuple(image.shape[-2:]))
+        return None
+
+    def encode(self, image, true_shape):
+        key = self.find_key(image)
+        if key is not None and key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        feat, pos, _ = self.net._encode_image(image[None], true_shape[None])
+        if key is not None:
+            self.add(key, (feat, pos))
+        return feat, pos
+
+    def add(self, key, value):
+        size = sum(x.numel() * x.element_size() for x in value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, (feat, pos) = self.entries.popitem(last=False)
+            self.num_bytes -= feat.numel() * feat.element_size()
+            self.num_bytes -= pos.numel() * pos.element_size()
+
+    def encode_image_pairs(self, img1, img2, true_shape1, true_shape2):
+        out1 = [self.encode(i, s) for i, s in zip(img1, true_shape1)]
+        out2 = [self.encode(i, s) for i, s in zip(img2, true_shape2)]
+        feat1, pos1 = (torch.cat(x) for x in zip(*out1))
+        feat2, pos2 = (torch.cat(x) for x in zip(*out2))
+        return feat1, feat2, pos1, pos2
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __repr__(self):
+        return (
+            f"EncoderCache({len(self.entries)} images, "
+            f"{self.num_bytes / 2**20:.1f}/{self.max_bytes / 2**20:.1f} MiB, "
+            f"hit rate {100 * self.hit_rate():.1f}%)"
+        )
+
+
 class Duster(BaseModel):
     default_conf = {
         "name": "Duster3r",
         "model_name": "duster_vit_large.pth",
         "max_keypoints": 3000,
         "vit_patch_size": 16,
+        "encoder_cache_bytes": 2**30,  # 0 disables the encoder cache
     }
 
     def _init(self, conf):
@@ -42,8 +114,19 @@ class Duster(BaseModel):
         self.net = AsymmetricCroCo3DStereo.from_pretrained(model_path).to(
             device
         )
+        self._init_encoder_cache(conf)
         logger.info("Loaded Dust3r model")
 
+    def _init_encoder_cache(self, conf):
+        self.encoder_cache = None
+        if conf["encoder_cache_bytes"]:
+            self.encoder_cache = EncoderCache(self.net, conf["encoder_cache_bytes"])
+
+    def _register_images(self, data, img0, img1):
+        # match_dense provides the image names when the cache is enabled
+        if self.encoder_cache is not None and "name0" in data:
+            self.encoder_cache.register((data["name0"], data["name1"]), (img0, img1))
+
     def preprocess(self, img):
         # the super-class already makes sure that img0,img1 have
         # same resolution and that h == w
@@ -73,6 +156,7 @@ class Duster(BaseModel):
 
         img0 = (img0 - mean.view(1, 3, 1, 1)) / std.view(1, 3, 1, 1)
         img1 = (img1 - mean.view(1, 3, 1, 1)) / std.view(1, 3, 1, 1)
+        self._register_images(data, img0[0], img1[0])
 
         images = [
             {"img": img0, "idx": 0, "instance": 0},
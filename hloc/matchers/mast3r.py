@@ -36,6 +36,7 @@ class Mast3r(Duster):
         "model_name": "mast3r/MASt3R_ViTLarge_BaseDecoder_512_catmlpdpt_metric.pth",
         "max_keypoints": 2000,
         "vit_patch_size": 16,
+        "encoder_cache_bytes": 2**30,  # 0 disables the encoder cache
     }
 
     def _init(self, conf):
@@ -45,6 +46,7 @@ class Mast3r(Duster):
             filename=self.conf["model_name"],
         )
         self.net = AsymmetricMASt3R.from_pretrained(model_path).to(DEVICE)
+        self._init_encoder_cache(conf)
         logger.info("Loaded Mast3r model")
 
     def _forward(self, data):
@@ -54,6 +56,7 @@ class Mast3r(Duster):
 
         img0 = (img0 - mean.view(1, 3, 1, 1)) / std.view(1, 3, 1, 1)
         img1 = (img1 - mean.view(1, 3, 1, 1)) / std.view(1, 3, 1, 1)
+        self._register_images(data, img0[0], img1[0])
 
         images = [
             {"img": img0, "idx": 0, "instance": 0},
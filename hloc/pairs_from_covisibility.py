@@ -1,50 +1,158 @@
 import argparse
+import time
 from collections import defaultdict
 from pathlib import Path
+from typing import Dict, List, Tuple
 
 import numpy as np
-from tqdm import tqdm
+import scipy.sparse as sp
 
 from . import logger
-from .utils.read_write_model import read_model
+from .reconstruction_cache import ReconstructionCache
+from .utils.read_write_model import read_images_binary, read_images_text, read_model
 
 
-def main(model, output, num_matched):
-    logger.info("Reading the COLMAP model...")
-    cameras, images, points3D = read_model(model)
+def read_observations(
+    model: Path, use_pycolmap: bool = False, use_cache: bool = False
+) -> Dict:
+    """Map the name of each registered image to the ids of its observed 3D
+    points. Only the images are parsed since the tracks are redundant."""
+    model = Path(model)
+    if use_cache:
+        return ReconstructionCache.load(model).observations()
+    if use_pycolmap:
+        import pycolmap
+
+        reconstruction = pycolmap.Reconstruction(model)
+        return {
+            image.name: np.array(
+                [p.point3D_id for p in image.points2D if p.has_point3D()], int
+            )
+            for _, image in sorted(reconstruction.images.items())
+        }
+    if (model / "images.bin").exists():
+        images = read_images_binary(model / "images.bin")
+    elif (model / "images.txt").exists():
+        images = read_images_text(model / "images.txt")
+    else:
+        _, images, _ = read_model(model)
+    return {
+        image.name: image.point3D_ids[image.point3D_ids != -1]
+        for image in images.values()
+    }
+
+
+def incidence_matrix(observations: Dict) -> sp.csr_matrix:
+    """Sparse image x point matrix counting the observations of each point."""
+    point3D_ids = list(observations.values())
+    rows = np.repeat(np.arange(len(point3D_ids)), [len(p) for p in point3D_ids])
+    cols = np.concatenate([np.zeros(0, int)] + point3D_ids)
+    # compact the point ids, which can be sparse after bundle adjustment
+    _, cols = np.unique(cols, return_inverse=True)
+    data = np.ones(len(rows), dtype=np.int32)
+    shape = (len(point3D_ids), cols.max() + 1 if len(cols) else 0)
+    return sp.csr_matrix((data, (rows, cols)), shape=shape)
+
+
+def topk_covisible(
+    incidence: sp.csr_matrix, num_matched: int, block_size: int = 1024
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Row and column indices of the top num_matched most covisible images
+    of each image, ordered by decreasing number of common points and then
+    by index. The covisibility A·Aᵀ is computed for blocks of rows so that
+    only a block of the dense-ish product is held in memory."""
+    incidence_t = incidence.T.tocsc()
+    all_rows, all_cols = [], []
+    for start in range(0, incidence.shape[0], block_size):
+        covis = (incidence[start : start + block_size] @ incidence_t).tocoo()
+        rows, cols, counts = covis.row + start, covis.col, covis.data
+        valid = (rows != cols) & (counts > 0)
+        rows, cols, counts = rows[valid], cols[valid], counts[valid]
+        order = np.lexsort((cols, -counts, rows))
+        rows, cols = rows[order], cols[order]
+        # rank of each entry within its row
+        row_starts = np.searchsorted(rows, rows, side="left")
+        keep = np.arange(len(rows)) - row_starts < num_matched
+        all_rows.append(rows[keep])
+        all_cols.append(cols[keep])
+    return np.concatenate(all_rows), np.concatenate(all_cols)
+
+
+def covisibility_pairs(
+    observations: Dict, num_matched: int, block_size: int = 1024
+) -> List[Tuple[str, str]]:
+    names = list(observations.keys())
+    rows, cols = topk_covisible(incidence_matrix(observations), num_matched, block_size)
+    no_covis = np.setdiff1d(np.arange(len(names)), rows)
+    for i in no_covis:
+        logger.info(f"Image {names[i]} does not have any covisibility.")
+    names = np.array(names, dtype=object)
+    return list(zip(names[rows], names[cols]))
 
-    logger.info("Extracting image pairs from covisibility info...")
-    pairs = []
-    for image_id, image in tqdm(images.items()):
-        matched = image.point3D_ids != -1
-        points3D_covis = image.point3D_ids[matched]
 
+def covisibility_pairs_reference(model: Path, num_matched: int):
+    """The original loop over the tracks of all observed points, kept to
+    validate and benchmark covisibility_pairs. Returns the pairs and the
+    number of common points of each pair."""
+    _, images, points3D = read_model(model)
+    pairs, counts = [], []
+    for image_id, image in images.items():
         covis = defaultdict(int)
-        for point_id in points3D_covis:
+        for point_id in image.point3D_ids[image.point3D_ids != -1]:
             for image_covis_id in points3D[point_id].image_ids:
                 if image_covis_id != image_id:
                     covis[image_covis_id] += 1
-
-        if len(covis) == 0:
-            logger.info(f"Image {image_id} does not have any covisibility.")
-            continue
-
         covis_ids = np.array(list(covis.keys()))
         covis_num = np.array([covis[i] for i in covis_ids])
+        top = np.argsort(-covis_num, kind="stable")[:num_matched]
+        pairs += [(image.name, images[covis_ids[i]].name) for i in top]
+        counts += covis_num[top].tolist()
+    return pairs, counts
+
+
+def benchmark(model: Path, num_matched: int, block_size: int = 1024):
+    """Time both implementations and check that they select, for each image,
+    the same number of common points. Images with tied counts can be paired
+    with a different image at the cut-off, so the counts are compared."""
+    start = time.time()
+    ref_pairs, ref_counts = covisibility_pairs_reference(model, num_matched)
+    ref_time = time.time() - start
+
+    start = time.time()
+    observations = read_observations(model)
+    incidence = incidence_matrix(observations)
+    pairs = covisibility_pairs(observations, num_matched, block_size)
+    new_time = time.time() - start
 
-        if len(covis_ids) <= num_matched:
-            top_covis_ids = covis_ids[np.argsort(-covis_num)]
-        else:
-            # get covisible image ids with top k number of common matches
-            ind_top = np.argpartition(covis_num, -num_matched)
-            ind_top = ind_top[-num_matched:]  # unsorted top k
-            ind_top = ind_top[np.argsort(-covis_num[ind_top])]
-            top_covis_ids = [covis_ids[i] for i in ind_top]
-            assert covis_num[ind_top[0]] == np.max(covis_num)
+    num_common = (incidence @ incidence.T).todok()
+    name2idx = {n: i for i, n in enumerate(observations)}
+    per_image, ref_per_image = defaultdict(list), defaultdict(list)
+    for (i, j), c in zip(ref_pairs, ref_counts):
+        ref_per_image[i].append(c)
+    for i, j in pairs:
+        per_image[i].append(num_common[name2idx[i], name2idx[j]])
+    equivalent = per_image == ref_per_image
+    logger.info(
+        f"Reference: {ref_time:.3f}s, sparse: {new_time:.3f}s "
+        f"({ref_time / new_time:.1f}x), "
+        f"{'equivalent' if equivalent else 'DIFFERENT'} outputs."
+    )
+    return equivalent, ref_time, new_time
 
-        for i in top_covis_ids:
-            pair = (image.name, images[i].name)
-            pairs.append(pair)
+
+def main(
+    model,
+    output,
+    num_matched,
+    use_pycolmap: bool = False,
+    block_size: int = 1024,
+    use_cache: bool = False,
+):
+    logger.info("Reading the COLMAP model...")
+    observations = read_observations(model, use_pycolmap, use_cache)
+
+    logger.info("Extracting image pairs from covisibility info...")
+    pairs = covisibility_pairs(observations, num_matched, block_size)
 
     logger.info(f"Found {len(pairs)} pairs.")
     with open(output, "w") as f:
@@ -56,5 +164,16 @@ if __name__ == "__main__":
     parser.add_argument("--model", required=True, type=Path)
     parser.add_argument("--output", required=True, type=Path)
     parser.add_argument("--num_matched", required=True, type=int)
-    args = parser.parse_args()
-    main(**args.__dict__)
+    parser.add_argument("--use_pycolmap", action="store_true")
+    parser.add_argument("--block_size", type=int, default=1024)
+    parser.add_argument("--use_cache", action="store_true")
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare to the reference implementation instead of writing pairs.",
+    )
+    args = parser.parse_args().__dict__
+    if args.pop("benchmark"):
+        benchmark(args["model"], args["num_matched"], args["block_size"])
+    else:
+        main(**args)
@@ -5,16 +5,17 @@ from typing import List, Optional, Union
 
 from . import logger
 from .utils.io import list_h5_names
+from .utils.pair_sources import ExhaustivePairs
 from .utils.parsers import parse_image_lists
 
 
 def main(
-    output: Path,
+    output: Optional[Path],
     image_list: Optional[Union[Path, List[str]]] = None,
     features: Optional[Path] = None,
     ref_list: Optional[Union[Path, List[str]]] = None,
     ref_features: Optional[Path] = None,
-):
+) -> ExhaustivePairs:
     if image_list is not None:
         if isinstance(image_list, (str, Path)):
             names_q = parse_image_lists(image_list)
@@ -41,16 +42,12 @@ def main(
         self_matching = True
         names_ref = names_q
 
-    pairs = []
-    for i, n1 in enumerate(names_q):
-        for j, n2 in enumerate(names_ref):
-            if self_matching and j <= i:
-                continue
-            pairs.append((n1, n2))
-
+    pairs = ExhaustivePairs(names_q, None if self_matching else names_ref)
     logger.info(f"Found {len(pairs)} pairs.")
-    with open(output, "w") as f:
-        f.write("\n".join(" ".join([i, j]) for i, j in pairs))
+    # the pairs can be passed directly to the matching and reconstruction
+    if output is not None:
+        pairs.write(output)
+    return pairs
 
 
 if __name__ == "__main__":
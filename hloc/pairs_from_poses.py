@@ -1,17 +1,19 @@
 import argparse
 from pathlib import Path
+from typing import Iterator, Optional, Tuple
 
 import numpy as np
 import scipy.spatial
 
 from . import logger
-from .pairs_from_retrieval import pairs_from_score_matrix
+from .pairs_from_retrieval import format_pairs, pairs_from_score_matrix
+from .reconstruction_cache import ReconstructionCache
 from .utils.read_write_model import read_images_binary
 
 DEFAULT_ROT_THRESH = 30  # in degrees
 
 
-def get_pairwise_distances(images):
+def get_camera_centers_and_axes(images):
     ids = np.array(list(images.keys()))
     Rs = []
     ts = []
@@ -28,34 +30,114 @@ def get_pairwise_distances(images):
     Rs = Rs.transpose(0, 2, 1)
     ts = -(Rs @ ts[:, :, None])[:, :, 0]
 
-    dist = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(ts))
-
     # Instead of computing the angle between two camera orientations,
     # we compute the angle between the principal axes, as two images rotated
     # around their principal axis still observe the same scene.
     axes = Rs[:, :, -1]
-    dots = np.einsum("mi,ni->mn", axes, axes, optimize=True)
-    dR = np.rad2deg(np.arccos(np.clip(dots, -1.0, 1.0)))
+    return ids, ts, axes
 
-    return ids, dist, dR
 
+def axes_angles(axes0, axes1):
+    dots = np.einsum("...i,...i->...", axes0, axes1)
+    return np.rad2deg(np.arccos(np.clip(dots, -1.0, 1.0)))
 
-def main(model, output, num_matched, rotation_threshold=DEFAULT_ROT_THRESH):
-    logger.info("Reading the COLMAP model...")
-    images = read_images_binary(model / "images.bin")
 
-    logger.info(f"Obtaining pairwise distances between {len(images)} images...")
-    ids, dist, dR = get_pairwise_distances(images)
-    scores = -dist
+def get_pairwise_distances(images):
+    ids, ts, axes = get_camera_centers_and_axes(images)
+    dist = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(ts))
+    dR = axes_angles(axes[:, None], axes[None])
+    return ids, dist, dR
 
-    invalid = dR >= rotation_threshold
-    np.fill_diagonal(invalid, True)
-    pairs = pairs_from_score_matrix(scores, invalid, num_matched)
-    pairs = [(images[ids[i]].name, images[ids[j]].name) for i, j in pairs]
 
-    logger.info(f"Found {len(pairs)} pairs.")
+def pairs_from_kdtree(
+    centers: np.ndarray,
+    axes: np.ndarray,
+    num_matched: int,
+    rotation_threshold: float = DEFAULT_ROT_THRESH,
+    max_distance: Optional[float] = None,
+    chunk_size: int = 4096,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield, for chunks of images, the indices of the num_matched closest
+    images whose principal axes differ by less than rotation_threshold.
+    Only the nearest centers are retrieved from a KD-tree, and the query is
+    repeated with twice as many neighbors for the images that do not have
+    enough candidates passing the rotation test, so memory is O(N·k)."""
+    num = len(centers)
+    tree = scipy.spatial.cKDTree(centers)
+    upper_bound = np.inf if max_distance is None else max_distance
+    for start in range(0, num, chunk_size):
+        pending = np.arange(start, min(start + chunk_size, num))
+        k = min(2 * num_matched + 1, num)
+        rows, cols = [], []
+        while len(pending) > 0:
+            _, idx = tree.query(
+                centers[pending], k, distance_upper_bound=upper_bound, workers=-1
+            )
+            idx = idx.reshape(len(pending), k)
+            found = idx < num  # missing neighbors have index num
+            idx = np.where(found, idx, 0)
+            valid = found & (idx != pending[:, None])
+            valid &= axes_angles(axes[pending, None], axes[idx]) < rotation_threshold
+            rank = np.cumsum(valid, 1)
+            done = (rank[:, -1] >= num_matched) | ~found[:, -1] | (k == num)
+            select = valid[done] & (rank[done] <= num_matched)
+            r, c = np.where(select)
+            rows.append(pending[done][r])
+            cols.append(idx[done][r, c])
+            pending = pending[~done]
+            k = min(2 * k, num)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        order = np.argsort(rows, kind="stable")
+        yield rows[order], cols[order]
+
+
+def main(
+    model,
+    output,
+    num_matched,
+    rotation_threshold=DEFAULT_ROT_THRESH,
+    max_distance: Optional[float] = None,
+    dense: bool = False,
+    use_cache: bool = False,
+):
+    logger.info("Reading the COLMAP model...")
+    if use_cache:
+        images = ReconstructionCache.load(model).to_images(with_points2D=False)
+    else:
+        images = read_images_binary(model / "images.bin")
+
+    if dense:
+        logger.info(f"Obtaining pairwise distances between {len(images)} images...")
+        ids, dist, dR = get_pairwise_distances(images)
+        scores = -dist
+
+        invalid = dR >= rotation_threshold
+        if max_distance is not None:
+            invalid |= dist > max_distance
+        np.fill_diagonal(invalid, True)
+        pairs = pairs_from_score_matrix(scores, invalid, num_matched)
+        pairs = [(images[ids[i]].name, images[ids[j]].name) for i, j in pairs]
+
+        logger.info(f"Found {len(pairs)} pairs.")
+        with open(output, "w") as f:
+            f.write("\n".join(" ".join(p) for p in pairs))
+        return
+
+    logger.info(f"Finding the nearest neighbors of {len(images)} images...")
+    ids, centers, axes = get_camera_centers_and_axes(images)
+    names = np.array([images[i].name for i in ids])
+    num_pairs = 0
     with open(output, "w") as f:
-        f.write("\n".join(" ".join(p) for p in pairs))
+        for rows, cols in pairs_from_kdtree(
+            centers, axes, num_matched, rotation_threshold, max_distance
+        ):
+            if len(rows) == 0:
+                continue
+            f.write(
+                ("\n" if num_pairs > 0 else "") + format_pairs(names[rows], names[cols])
+            )
+            num_pairs += len(rows)
+    logger.info(f"Found {num_pairs} pairs.")
 
 
 if __name__ == "__main__":
@@ -64,5 +146,10 @@ if __name__ == "__main__":
     parser.add_argument("--output", required=True, type=Path)
     parser.add_argument("--num_matched", required=True, type=int)
     parser.add_argument("--rotation_threshold", default=DEFAULT_ROT_THRESH, type=float)
+    parser.add_argument("--max_distance", type=float)
+    parser.add_argument("--use_cache", action="store_true")
+    parser.add_argument(
+        "--dense", action="store_true", help="Use the N x N distance matrices."
+    )
     args = parser.parse_args()
     main(**args.__dict__)
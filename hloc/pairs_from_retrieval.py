@@ -1,15 +1,19 @@
 import argparse
+from collections import defaultdict
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 import h5py
 import numpy as np
 import torch
 import collections.abc as collections
 
 from . import logger
+from .descriptor_store import DescriptorStore
+from .utils.ann import IVFIndex
 from .utils.parsers import parse_image_lists
 from .utils.read_write_model import read_images_binary
 from .utils.io import list_h5_names
+from .utils.whitening import apply_whitening, dequantize, read_whitening
 
 
 def parse_names(prefix, names, names_all):
@@ -38,11 +42,39 @@ def get_descriptors(names, path, name2idx=None, key="global_descriptor"):
         with h5py.File(str(path), "r", libver="latest") as fd:
             desc = [fd[n][key].__array__() for n in names]
     else:
-        desc = []
-        for n in names:
-            with h5py.File(str(path[name2idx[n]]), "r", libver="latest") as fd:
-                desc.append(fd[n][key].__array__())
-    return torch.from_numpy(np.stack(desc, 0)).float()
+        # open each file once and read all its images
+        desc = [None] * len(names)
+        ids_per_file = defaultdict(list)
+        for i, n in enumerate(names):
+            ids_per_file[name2idx[n]].append(i)
+        for j, ids in ids_per_file.items():
+            with h5py.File(str(path[j]), "r", libver="latest") as fd:
+                for i in ids:
+                    desc[i] = fd[names[i]][key].__array__()
+    return torch.from_numpy(dequantize(np.stack(desc, 0))).float()
+
+
+def whiten_queries(query_desc: torch.Tensor, db_descriptors):
+    """Project the query descriptors with the PCA-whitening that was used to
+    reduce the database descriptors, if any (see whiten_descriptors)."""
+    whitening = read_whitening(db_descriptors)
+    if whitening is None:
+        return query_desc
+    if query_desc.shape[1] != whitening["pca_projection"].shape[0]:
+        return query_desc  # already reduced
+    logger.info("Applying the PCA-whitening of the database to the queries.")
+    return torch.from_numpy(apply_whitening(query_desc.numpy(), whitening)).float()
+
+
+def topk_pairs(scores: torch.Tensor, num_select: int,
+               min_score: Optional[float] = None):
+    """Row and column indices of the top-k finite scores of each row."""
+    if min_score is not None:
+        scores.masked_fill_(scores < min_score, float("-inf"))
+    topk = torch.topk(scores, min(num_select, scores.shape[1]), dim=1)
+    indices = topk.indices.cpu().numpy()
+    rows, cols = np.where(topk.values.isfinite().cpu().numpy())
+    return rows, indices[rows, cols]
 
 
 def pairs_from_score_matrix(scores: torch.Tensor,
@@ -53,35 +85,119 @@ def pairs_from_score_matrix(scores: torch.Tensor,
     if isinstance(scores, np.ndarray):
         scores = torch.from_numpy(scores)
     invalid = torch.from_numpy(invalid).to(scores.device)
-    if min_score is not None:
-        invalid |= scores < min_score
     scores.masked_fill_(invalid, float("-inf"))
+    return list(zip(*topk_pairs(scores, num_select, min_score)))
+
+
+def mask_self_matches(scores: torch.Tensor, self_ids: np.ndarray, offset: int = 0):
+    """Exclude the database images that are the queries themselves.
+    self_ids is the database index of each query (-1 if not in it) and
+    offset the index of the first database column of scores."""
+    rows = np.where((self_ids >= offset)
+                    & (self_ids < offset + scores.shape[1]))[0]
+    cols = self_ids[rows] - offset
+    scores[torch.from_numpy(rows), torch.from_numpy(cols)] = float("-inf")
+
+
+def get_self_ids(query_names, db_names) -> np.ndarray:
+    name2id = {n: i for i, n in enumerate(db_names)}
+    return np.array([name2id.get(n, -1) for n in query_names], dtype=np.int64)
+
+
+def format_pairs(names0: np.ndarray, names1: np.ndarray) -> str:
+    return "\n".join(np.char.add(np.char.add(names0, " "), names1))
 
-    topk = torch.topk(scores, num_select, dim=1)
-    indices = topk.indices.cpu().numpy()
-    valid = topk.values.isfinite().cpu().numpy()
 
-    pairs = []
-    for i, j in zip(*np.where(valid)):
-        pairs.append((i, indices[i, j]))
-    return pairs
+def topk_blockwise(query_desc: torch.Tensor, self_ids: np.ndarray, db_names,
+                   load_db_desc: Callable, num_select: int,
+                   query_chunk_size: int, db_chunk_size: int,
+                   min_score: Optional[float] = None, device="cpu"):
+    """Exact top-k retrieval streaming both the queries and the database in
+    chunks, such that the peak memory does not depend on the database size.
+    The running top-k of each query is merged with the top-k of each chunk."""
+    query_splits = torch.split(query_desc, query_chunk_size)
+    self_splits = np.split(
+        self_ids, np.cumsum([len(q) for q in query_splits])[:-1])
+    values = [torch.zeros((len(q), 0)) for q in query_splits]
+    indices = [torch.zeros((len(q), 0), dtype=torch.long) for q in query_splits]
+    for start in range(0, len(db_names), db_chunk_size):
+        db_desc = load_db_desc(db_names[start:start + db_chunk_size]).to(device)
+        for i, (query_desc_split, self_ids_split) in enumerate(
+                zip(query_splits, self_splits)):
+            sim = torch.einsum(
+                "id,jd->ij", query_desc_split.to(device), db_desc)
+
+            # Avoid self-matching
+            mask_self_matches(sim, self_ids_split, start)
+            if min_score is not None:
+                sim.masked_fill_(sim < min_score, float("-inf"))
+            topk = torch.topk(sim, min(num_select, sim.shape[1]), dim=1)
+
+            # merge with the results of the previous chunks
+            merged_values = torch.cat([values[i], topk.values.cpu()], 1)
+            merged_indices = torch.cat(
+                [indices[i], topk.indices.cpu() + start], 1)
+            topk = torch.topk(
+                merged_values, min(num_select, merged_values.shape[1]), dim=1)
+            values[i] = topk.values
+            indices[i] = torch.gather(merged_indices, 1, topk.indices)
+        del db_desc
+    return torch.cat(values), torch.cat(indices)
+
+
+def pairs_from_index(index: IVFIndex, query_desc: torch.Tensor, query_names,
+                     num_matched: int, nprobe: int,
+                     min_score: Optional[float] = None):
+    # retrieve one more image in case the query is itself in the database
+    scores, indices = index.search(query_desc.numpy(), num_matched + 1, nprobe)
+    self_ids = get_self_ids(query_names, index.names)
+    valid = (indices != -1) & (indices != self_ids[:, None])
+    if min_score is not None:
+        valid &= scores >= min_score
+    valid &= np.cumsum(valid, 1) <= num_matched
+    rows, cols = np.where(valid)
+    return rows, indices[rows, cols]
 
 
 def main(descriptors: Path, output: Path, num_matched: int,
          query_prefix=None, query_list=None,
          db_prefix=None, db_list=None, db_model=None, db_descriptors=None,
-         chunk_size: int = -1, min_score: float=0):
+         chunk_size: int = -1, min_score: float=0,
+         db_index: Optional[Path] = None, nprobe: int = 16,
+         db_chunk_size: int = -1):
     logger.info("Extracting image pairs from a retrieval database.")
 
+    if db_index is not None:
+        # approximate search, the database is defined by the index
+        index = IVFIndex.load(db_index)
+        query_names = parse_names(
+            query_prefix, query_list, list_h5_names(descriptors))
+        query_desc = get_descriptors(query_names, descriptors)
+        if db_descriptors is not None:
+            query_desc = whiten_queries(query_desc, db_descriptors)
+        rows, cols = pairs_from_index(
+            index, query_desc, query_names, num_matched, nprobe, min_score)
+        logger.info(f"Found {len(rows)} pairs.")
+        with output.open("w") as f:
+            f.write(format_pairs(
+                np.array(query_names)[rows], index.names[cols]))
+        return
+
     # We handle multiple reference feature files.
     # We only assume that names are unique among them and map names to files.
     if db_descriptors is None:
         db_descriptors = descriptors
     if isinstance(db_descriptors, (Path, str)):
         db_descriptors = [db_descriptors]
-    name2db = {n: i for i, p in enumerate(db_descriptors)
-               for n in list_h5_names(p)}
-    db_names_h5 = list(name2db.keys())
+    # Descriptors exported with descriptor_store are memory-mapped at once.
+    db_store = None
+    if len(db_descriptors) == 1 and DescriptorStore.is_store(db_descriptors[0]):
+        db_store = DescriptorStore(db_descriptors[0])
+        db_names_h5 = db_store.names
+    else:
+        name2db = {n: i for i, p in enumerate(db_descriptors)
+                   for n in list_h5_names(p)}
+        db_names_h5 = list(name2db.keys())
     query_names_h5 = list_h5_names(descriptors)
 
     if db_model:
@@ -93,27 +209,50 @@ def main(descriptors: Path, output: Path, num_matched: int,
         raise ValueError("Could not find any database image.")
     query_names = parse_names(query_prefix, query_list, query_names_h5)
 
+    def load_db_desc(names):
+        names = list(names)
+        if db_store is None:
+            return get_descriptors(names, db_descriptors, name2db)
+        return torch.from_numpy(np.asarray(db_store.get(names))).float()
+
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    db_desc = get_descriptors(db_names, db_descriptors, name2db)
-    db_desc = db_desc.to(device)
     query_desc = get_descriptors(query_names, descriptors)
+    query_desc = whiten_queries(query_desc, db_descriptors[0])
+    chunk_size = chunk_size if chunk_size > 0 else len(query_names)
+
+    # Map the names to integer ids once, queries to their database index
+    self_ids = get_self_ids(query_names, db_names)
+    query_names, db_names = np.array(query_names), np.array(db_names)
+
+    if db_chunk_size > 0:
+        # only one chunk of the database is loaded at a time
+        scores, indices = topk_blockwise(
+            query_desc, self_ids, db_names, load_db_desc, num_matched,
+            chunk_size, db_chunk_size, min_score, device)
+        rows, cols = np.where(scores.isfinite().numpy())
+        logger.info(f"Found {len(rows)} pairs.")
+        with output.open("w") as f:
+            f.write(format_pairs(
+                query_names[rows], db_names[indices.numpy()[rows, cols]]))
+        return
+
+    db_desc = load_db_desc(db_names).to(device)
 
     num_pairs = 0
-    chunk_size = chunk_size if chunk_size > 0 else len(query_names)
     with output.open("w") as f:
-        query_name_splits = [query_names[i:i + chunk_size] for i in range(0, len(query_names), chunk_size)]
-        query_splits = torch.split(query_desc, chunk_size)
-        for i, (names, query_desc_split) in enumerate(zip(query_name_splits, query_splits)):
+        for i, start in enumerate(range(0, len(query_names), chunk_size)):
             if i != 0:
                 f.write("\n")
-            sim = torch.einsum("id,jd->ij", query_desc_split.to(device), db_desc)
+            end = start + chunk_size
+            sim = torch.einsum(
+                "id,jd->ij", query_desc[start:end].to(device), db_desc)
 
             # Avoid self-matching
-            self = np.array(names)[:, None] == np.array(db_names)[None]
-            pairs = pairs_from_score_matrix(sim, self, num_matched, min_score=min_score)
-            pairs = [(names[i], db_names[j]) for i, j in pairs]
-            num_pairs += len(pairs)
-            f.write("\n".join(" ".join([i, j]) for i, j in pairs))
+            mask_self_matches(sim, self_ids[start:end])
+            rows, cols = topk_pairs(sim, num_matched, min_score=min_score)
+            num_pairs += len(rows)
+            f.write(format_pairs(
+                query_names[start:end][rows], db_names[cols]))
 
     logger.info(f"Found {num_pairs} pairs.")
 
@@ -131,5 +270,8 @@ if __name__ == "__main__":
     parser.add_argument("--db_descriptors", type=Path)
     parser.add_argument("--chunk_size", type=int, default=-1)
     parser.add_argument("--min_score", type=float, default=0)
+    parser.add_argument("--db_index", type=Path)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--db_chunk_size", type=int, default=-1)
     args = parser.parse_args()
     main(**args.__dict__)
@@ -0,0 +1,193 @@
+import argparse
+import collections.abc as collections
+from collections import defaultdict
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import logger
+from .pairs_from_retrieval import get_descriptors
+from .utils.io import list_h5_names
+from .utils.pair_sources import PairList
+from .utils.parsers import parse_image_lists
+
+
+def parse_timestamp(name: str) -> Optional[float]:
+    """Timestamp from a file name like cam0/1579176245862497024.png (4Seasons)
+    or rear/1418132416737115.jpg (RobotCar)."""
+    try:
+        return float(Path(name).stem)
+    except ValueError:
+        return None
+
+
+def sort_sequences(
+    names: List[str], use_timestamps: bool = False, by_directory: bool = True
+) -> List[Tuple[List[str], Optional[np.ndarray]]]:
+    """Split the images into sequences, one per directory (e.g. camera), and
+    order the frames by name or timestamp. Returns the frames and timestamps
+    of each sequence."""
+    groups = defaultdict(list)
+    for name in names:
+        groups[str(Path(name).parent) if by_directory else ""].append(name)
+    sequences = []
+    for _, frames in sorted(groups.items()):
+        if not use_timestamps:
+            sequences.append((sorted(frames), None))
+            continue
+        timestamps = [parse_timestamp(n) for n in frames]
+        missing = [n for n, t in zip(frames, timestamps) if t is None]
+        if len(missing) > 0:
+            raise ValueError(f"Could not parse the timestamp of images {missing[:5]}.")
+        order = np.argsort(timestamps, kind="stable")
+        sequences.append(
+            ([frames[i] for i in order], np.array(timestamps, dtype=np.float64)[order])
+        )
+    return sequences
+
+
+def temporal_pairs(
+    num_frames: int,
+    window: int,
+    timestamps: Optional[np.ndarray] = None,
+    max_time_gap: Optional[float] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices of each frame and its next `window` frames, optionally only
+    those at most max_time_gap later. The number of pairs is O(N·window)."""
+    i = np.repeat(np.arange(num_frames), window)
+    j = i + np.tile(np.arange(1, window + 1), num_frames)
+    valid = j < num_frames
+    i, j = i[valid], j[valid]
+    if max_time_gap is not None:
+        if timestamps is None:
+            raise ValueError("A time gap requires the timestamps of the frames.")
+        valid = timestamps[j] - timestamps[i] <= max_time_gap
+        i, j = i[valid], j[valid]
+    return i, j
+
+
+def loop_closure_pairs(
+    desc: np.ndarray,
+    sequence_ids: np.ndarray,
+    frame_ids: np.ndarray,
+    num_loop: int,
+    min_frame_gap: int,
+    stride: int = 1,
+    min_score: Optional[float] = None,
+    chunk_size: int = 1024,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Retrieve for every stride-th frame its num_loop most similar frames,
+    excluding the frames of the same sequence that are closer in time than
+    min_frame_gap, which are already covered by the temporal window."""
+    queries = np.arange(0, len(desc), stride)
+    rows, cols = [], []
+    for start in range(0, len(queries), chunk_size):
+        q = queries[start : start + chunk_size]
+        sim = desc[q] @ desc.T
+        neighbors = (sequence_ids[q, None] == sequence_ids[None]) & (
+            np.abs(frame_ids[q, None] - frame_ids[None]) < min_frame_gap
+        )
+        sim[neighbors] = -np.inf
+        sim[np.arange(len(q)), q] = -np.inf
+        if min_score is not None:
+            sim[sim < min_score] = -np.inf
+        k = min(num_loop, sim.shape[1])
+        top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+        r, c = np.where(np.isfinite(np.take_along_axis(sim, top, 1)))
+        rows.append(q[r])
+        cols.append(top[r, c])
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def main(
+    output: Path,
+    image_list: Optional[Union[Path, List[str]]] = None,
+    features: Optional[Path] = None,
+    window: int = 5,
+    use_timestamps: bool = False,
+    max_time_gap: Optional[float] = None,
+    by_directory: bool = True,
+    descriptors: Optional[Path] = None,
+    num_loop: int = 2,
+    loop_stride: int = 1,
+    loop_min_frame_gap: Optional[int] = None,
+    loop_min_score: Optional[float] = None,
+) -> PairList:
+    if image_list is not None:
+        if isinstance(image_list, (str, Path)):
+            names = parse_image_lists(image_list)
+        elif isinstance(image_list, collections.Iterable):
+            names = list(image_list)
+        else:
+            raise ValueError(f"Unknown type for image list: {image_list}")
+    elif features is not None:
+        names = list_h5_names(features)
+    elif descriptors is not None:
+        names = list_h5_names(descriptors)
+    else:
+        raise ValueError("Provide either a list of images or a feature file.")
+
+    sequences = sort_sequences(names, use_timestamps, by_directory)
+    names, sequence_ids, frame_ids = [], [], []
+    pairs = set()
+    for seq_id, (frames, timestamps) in enumerate(sequences):
+        i, j = temporal_pairs(len(frames), window, timestamps, max_time_gap)
+        offset = len(names)
+        pairs |= set(zip((i + offset).tolist(), (j + offset).tolist()))
+        names += frames
+        sequence_ids.append(np.full(len(frames), seq_id))
+        frame_ids.append(np.arange(len(frames)))
+    num_temporal = len(pairs)
+    logger.info(
+        f"Found {num_temporal} temporal pairs in {len(sequences)} sequences "
+        f"of {len(names)} images."
+    )
+
+    if descriptors is not None and num_loop > 0:
+        if loop_min_frame_gap is None:
+            loop_min_frame_gap = 2 * window
+        desc = get_descriptors(names, descriptors).numpy()
+        rows, cols = loop_closure_pairs(
+            desc,
+            np.concatenate(sequence_ids),
+            np.concatenate(frame_ids),
+            num_loop,
+            loop_min_frame_gap,
+            loop_stride,
+            loop_min_score,
+        )
+        # keep a single direction of symmetric loop closures
+        pairs |= set(
+            zip(np.minimum(rows, cols).tolist(), np.maximum(rows, cols).tolist())
+        )
+        logger.info(f"Found {len(pairs) - num_temporal} loop closure pairs.")
+
+    pairs = PairList([(names[i], names[j]) for i, j in sorted(pairs)])
+    logger.info(f"Found {len(pairs)} pairs.")
+    if output is not None:
+        pairs.write(output)
+    return pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--image_list", type=Path)
+    parser.add_argument("--features", type=Path)
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--use_timestamps", action="store_true")
+    parser.add_argument("--max_time_gap", type=float)
+    parser.add_argument(
+        "--no_directories",
+        dest="by_directory",
+        action="store_false",
+        help="Treat all the images as a single sequence.",
+    )
+    parser.add_argument("--descriptors", type=Path)
+    parser.add_argument("--num_loop", type=int, default=2)
+    parser.add_argument("--loop_stride", type=int, default=1)
+    parser.add_argument("--loop_min_frame_gap", type=int)
+    parser.add_argument("--loop_min_score", type=float)
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -0,0 +1,303 @@
+import argparse
+import multiprocessing
+import sqlite3
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import networkx as nx
+import numpy as np
+import pycolmap
+
+from . import logger
+from .camera_triplets import view_graph_from_database
+from .triangulation import OutputCapture, run_triangulation
+from .utils.geometry import ransac_umeyama_alignment
+from .utils.io import map_ordered
+from .utils.read_write_model import (
+    Image,
+    read_cameras_binary,
+    read_images_binary,
+    rotmat2qvec,
+    write_model,
+)
+
+
+def partition_view_graph(
+    graph: nx.Graph, max_cluster_size: int, seed: int = 0
+) -> List[Set[int]]:
+    """Split the view graph into clusters of at most max_cluster_size images.
+    The communities of each connected component are greedily merged along
+    their strongest connections, and communities that are too large are
+    bisected with Kernighan-Lin."""
+    communities = []
+    stack = [c for c in nx.connected_components(graph) if len(c) > 1]
+    while len(stack) > 0:
+        nodes = stack.pop()
+        if len(nodes) <= max_cluster_size:
+            communities.append(set(nodes))
+            continue
+        subgraph = graph.subgraph(nodes)
+        parts = nx.community.louvain_communities(subgraph, weight="weight", seed=seed)
+        if len(parts) == 1:
+            parts = nx.community.kernighan_lin_bisection(
+                subgraph, weight="weight", seed=seed
+            )
+        stack += [set(p) for p in parts]
+
+    # merge the communities along the heaviest edges while they are small enough
+    community_of = {n: i for i, c in enumerate(communities) for n in c}
+    weights = {}
+    for i, j, w in graph.edges(data="weight", default=1):
+        ci, cj = community_of.get(i), community_of.get(j)
+        if ci is not None and cj is not None and ci != cj:
+            key = (min(ci, cj), max(ci, cj))
+            weights[key] = weights.get(key, 0) + w
+    parent = list(range(len(communities)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (ci, cj), _ in sorted(weights.items(), key=lambda x: -x[1]):
+        ri, rj = find(ci), find(cj)
+        if ri != rj and len(communities[ri]) + len(communities[rj]) <= max_cluster_size:
+            parent[rj] = ri
+            communities[ri] |= communities[rj]
+    clusters = [communities[i] for i in range(len(communities)) if find(i) == i]
+    return sorted(clusters, key=len, reverse=True)
+
+
+def expand_clusters(
+    graph: nx.Graph, clusters: List[Set[int]], overlap: float
+) -> List[Set[int]]:
+    """Add to each cluster the overlap * size outside images that are the
+    most strongly connected to it, such that the models of neighboring
+    clusters share images and can be aligned."""
+    expanded = []
+    for cluster in clusters:
+        scores = {}
+        for node in cluster:
+            for neighbor, data in graph[node].items():
+                if neighbor not in cluster:
+                    scores[neighbor] = scores.get(neighbor, 0) + data.get("weight", 1)
+        num_added = int(np.ceil(overlap * len(cluster)))
+        added = sorted(scores, key=lambda n: -scores[n])[:num_added]
+        expanded.append(cluster | set(added))
+    return expanded
+
+
+def reconstruct_cluster(
+    database_path: Path,
+    image_dir: Path,
+    options: Dict[str, Any],
+    cluster: Tuple[Path, List[str]],
+) -> Optional[Path]:
+    """Reconstruct the images of a cluster in a separate process. The mapper
+    only loads these images and their correspondences from the database.
+    Returns the path of the largest model."""
+    output_path, image_names = cluster
+    output_path.mkdir(parents=True, exist_ok=True)
+    options = {**options, "image_names": image_names}
+    with OutputCapture(False):
+        reconstructions = pycolmap.incremental_mapping(
+            database_path, image_dir, output_path, options=options
+        )
+    if len(reconstructions) == 0:
+        return None
+    index = max(reconstructions, key=lambda i: reconstructions[i].num_reg_images())
+    return output_path / str(index)
+
+
+def camera_centers(images: Dict[int, Image]) -> Dict[int, np.ndarray]:
+    return {i: -image.qvec2rotmat().T @ image.tvec for i, image in images.items()}
+
+
+def transform_images(
+    images: Dict[int, Image], scale: float, R: np.ndarray, t: np.ndarray
+) -> Dict[int, Image]:
+    """Apply the similarity x' = scale * R @ x + t to the world frame."""
+    transformed = {}
+    for i, image in images.items():
+        R_new = image.qvec2rotmat() @ R.T
+        t_new = scale * image.tvec - R_new @ t
+        transformed[i] = image._replace(qvec=rotmat2qvec(R_new), tvec=t_new)
+    return transformed
+
+
+def merge_cluster_models(
+    model_paths: List[Path], min_common_images: int = 3, max_error: float = 0.05
+) -> Tuple[Dict, Dict[int, Image]]:
+    """Align the models to the largest one, in decreasing order of shared
+    images with the merged model, from the camera centers of the shared
+    images. max_error is relative to the extent of the merged model. The
+    shared images keep the pose of the model that was merged first. Models
+    that cannot be aligned with enough inliers are skipped."""
+    models = []
+    for path in model_paths:
+        models.append(
+            (
+                read_cameras_binary(path / "cameras.bin"),
+                read_images_binary(path / "images.bin"),
+            )
+        )
+    models = sorted(models, key=lambda m: -len(m[1]))
+    cameras, images = dict(models[0][0]), dict(models[0][1])
+    remaining = models[1:]
+    while len(remaining) > 0:
+        common = [len(set(m[1]) & set(images)) for m in remaining]
+        best = int(np.argmax(common))
+        if common[best] < min_common_images:
+            logger.warning(
+                f"Could not merge {len(remaining)} cluster models sharing fewer "
+                f"than {min_common_images} images with the merged model."
+            )
+            break
+        model_cameras, model_images = remaining.pop(best)
+        shared = sorted(set(model_images) & set(images))
+        src = camera_centers({i: model_images[i] for i in shared})
+        dst = camera_centers({i: images[i] for i in shared})
+        src = np.stack([src[i] for i in shared])
+        dst = np.stack([dst[i] for i in shared])
+        extent = np.median(np.linalg.norm(dst - np.median(dst, 0), axis=1))
+        transform, inliers = ransac_umeyama_alignment(
+            src, dst, max_error * max(extent, 1e-6)
+        )
+        # a fit on too few shared images would merge the model at a wrong pose
+        min_inliers = max(3, min_common_images // 3)
+        if transform is None or inliers.sum() < min_inliers:
+            logger.warning(
+                f"Skipped a model of {len(model_images)} images with only "
+                f"{inliers.sum()}/{len(shared)} inlier shared images."
+            )
+            continue
+        scale, R, t = transform
+        logger.info(
+            f"Merged a model of {len(model_images)} images with "
+            f"{inliers.sum()}/{len(shared)} inlier shared images."
+        )
+        for i, image in transform_images(model_images, scale, R, t).items():
+            images.setdefault(i, image)
+        for i, camera in model_cameras.items():
+            cameras.setdefault(i, camera)
+    return cameras, images
+
+
+def get_image_names(database_path: Path) -> Dict[int, str]:
+    db = sqlite3.connect(str(database_path))
+    names = dict(db.execute("SELECT image_id, name FROM images;"))
+    db.close()
+    return names
+
+
+def run_partitioned_reconstruction(
+    models_path: Path,
+    database_path: Path,
+    image_dir: Path,
+    max_cluster_size: int = 1000,
+    overlap: float = 0.2,
+    num_workers: Optional[int] = None,
+    min_num_inliers: int = 15,
+    verbose: bool = False,
+    options: Optional[Dict[str, Any]] = None,
+    refine: bool = True,
+) -> Optional[pycolmap.Reconstruction]:
+    """Divide-and-conquer SfM: partition the verified view graph into
+    overlapping clusters, reconstruct the clusters in parallel processes,
+    align their models using the shared images, and triangulate the merged
+    poses over the full database. The processes are spawned, so a calling
+    script needs an if __name__ == "__main__" guard."""
+    models_path.mkdir(exist_ok=True, parents=True)
+    id_to_name = get_image_names(database_path)
+    image_ids = {name: i for i, name in id_to_name.items()}
+    graph, _ = view_graph_from_database(database_path, image_ids, min_num_inliers)
+    clusters = partition_view_graph(graph, max_cluster_size)
+    clusters = expand_clusters(graph, clusters, overlap)
+    logger.info(
+        f"Partitioned {len(id_to_name)} images into {len(clusters)} clusters "
+        f"of sizes {[len(c) for c in clusters]}."
+    )
+
+    if num_workers is None:
+        num_workers = min(len(clusters), multiprocessing.cpu_count())
+    num_workers = max(min(num_workers, len(clusters)), 1)
+    options = {
+        "num_threads": max(multiprocessing.cpu_count() // num_workers, 1),
+        **(options or {}),
+    }
+    tasks = [
+        (models_path / f"cluster_{i}", sorted(id_to_name[n] for n in cluster))
+        for i, cluster in enumerate(clusters)
+    ]
+    logger.info(f"Reconstructing the clusters with {num_workers} processes...")
+    model_paths = list(
+        map_ordered(
+            partial(reconstruct_cluster, database_path, image_dir, options),
+            tasks,
+            num_workers,
+        )
+    )
+    model_paths = [p for p in model_paths if p is not None]
+    if len(model_paths) == 0:
+        logger.error("Could not reconstruct any cluster!")
+        return None
+
+    cameras, images = merge_cluster_models(model_paths)
+    images = {
+        i: image._replace(xys=np.zeros((0, 2)), point3D_ids=np.zeros(0, int))
+        for i, image in images.items()
+    }
+    poses_path = models_path / "merged_poses"
+    poses_path.mkdir(exist_ok=True)
+    write_model(cameras, images, {}, poses_path)
+    reconstruction = run_triangulation(
+        models_path / "merged",
+        database_path,
+        image_dir,
+        pycolmap.Reconstruction(poses_path),
+        verbose,
+    )
+    if refine:
+        logger.info("Refining the merged model...")
+        with OutputCapture(verbose):
+            pycolmap.bundle_adjustment(reconstruction)
+        reconstruction.write(models_path / "merged")
+    return reconstruction
+
+
+def main(
+    sfm_dir: Path,
+    image_dir: Path,
+    max_cluster_size: int = 1000,
+    overlap: float = 0.2,
+    num_workers: Optional[int] = None,
+    verbose: bool = False,
+) -> Optional[pycolmap.Reconstruction]:
+    database = sfm_dir / "database.db"
+    assert database.exists(), database
+    reconstruction = run_partitioned_reconstruction(
+        sfm_dir / "models_partitioned",
+        database,
+        image_dir,
+        max_cluster_size,
+        overlap,
+        num_workers,
+        verbose=verbose,
+    )
+    if reconstruction is not None:
+        logger.info(f"Reconstruction statistics:\n{reconstruction.summary()}")
+    return reconstruction
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sfm_dir", type=Path, required=True)
+    parser.add_argument("--image_dir", type=Path, required=True)
+    parser.add_argument("--max_cluster_size", type=int, default=1000)
+    parser.add_argument("--overlap", type=float, default=0.2)
+    parser.add_argument("--num_workers", type=int)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -2,7 +2,7 @@ import argparse
 import multiprocessing
 import shutil
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 from itertools import chain
 
 import pycolmap
@@ -17,6 +17,9 @@ from .triangulation import (
     parse_option_args,
 )
 from .camera_triplets import apply_camera_triplet_pruning
+from .partitioned_reconstruction import run_partitioned_reconstruction
+from .utils.pair_sources import PairSource
+from .utils.stages import StageTracker
 
 
 def create_empty_db(database_path: Path):
@@ -118,6 +121,12 @@ def run_reconstruction(
         return None
     logger.info(f"Reconstructed {len(reconstructions)} model(s).")
 
+    return largest_reconstruction(reconstructions)
+
+
+def largest_reconstruction(
+    reconstructions: Dict[int, pycolmap.Reconstruction]
+) -> pycolmap.Reconstruction:
     largest_index = None
     largest_num_images = 0
     for index, rec in reconstructions.items():
@@ -133,10 +142,26 @@ def run_reconstruction(
     return reconstructions[largest_index]
 
 
+def read_largest_reconstruction(models_path: Path) -> Optional[pycolmap.Reconstruction]:
+    """The model written by the last mapping, the largest if there are several.
+    The mapping clears models_path, so a merged model can only come from it."""
+    if (models_path / "merged").exists():
+        return pycolmap.Reconstruction(models_path / "merged")
+    reconstructions = {
+        int(path.name): pycolmap.Reconstruction(path)
+        for path in models_path.iterdir()
+        if path.is_dir() and path.name.isdigit()
+    }
+    if len(reconstructions) == 0:
+        logger.error("No model was reconstructed in the previous run!")
+        return None
+    return largest_reconstruction(reconstructions)
+
+
 def main(
     sfm_dir: Path,
     image_dir: Path,
-    pairs: Path,
+    pairs: Union[Path, PairSource],
     features: Path,
     matches: Path,
     camera_mode: pycolmap.CameraMode = pycolmap.CameraMode.AUTO,
@@ -152,22 +177,44 @@ def main(
     input_path: Optional[Path] = None,
     mapper_options: Optional[Dict[str, Any]] = None,
     camera_triplet_threshold: float = -1,
+    track_stages: bool = True,
+    max_cluster_size: Optional[int] = None,
 ) -> pycolmap.Reconstruction:
+    """With track_stages, the fingerprint of the inputs of each stage is
+    recorded in sfm_dir/stages.json and a re-run only runs the stages whose
+    inputs, or those of a previous stage, changed since. With
+    max_cluster_size, larger scenes are reconstructed as clusters of at most
+    this many images, in parallel, whose models are merged."""
     assert features.exists(), features
-    assert pairs.exists(), pairs
+    assert isinstance(pairs, PairSource) or pairs.exists(), pairs
     assert matches.exists(), matches
 
     sfm_dir.mkdir(parents=True, exist_ok=True)
     logger.info(f"Writing COLMAP logs to {sfm_dir / 'colmap.LOG.*'}")
     pycolmap.logging.set_log_destination(pycolmap.logging.INFO, sfm_dir / "colmap.LOG.")
     database = sfm_dir / 'database.db'
-    if database.exists():
-        logger.info('The database already exists. Skipping import.')
-        image_ids = get_image_ids(database)
-    else:
+    stages = StageTracker(sfm_dir / "stages.json", track_stages)
+    is_empty = not database.exists()
+    # a database that was not created with stage tracking is kept as is
+    keep_database = not is_empty and not (track_stages and stages.path.exists())
+    if is_empty:
+        stages.reset()
         create_empty_db(database)
+    elif keep_database:
+        logger.info('The database already exists. Skipping import.')
 
-    if do_import_images:
+    image_ids = get_image_ids(database)
+    if do_import_images and stages.needs_run(
+        "images",
+        [database],
+        image_dir=image_dir,
+        images=sorted(image_list or [p.name for p in image_dir.iterdir()]),
+        camera_mode=camera_mode,
+        options=image_options,
+    ):
+        if not is_empty and not keep_database:
+            # the image ids change, all the following stages are run again
+            create_empty_db(database)
         if image_list:
             image_list_shared = [image_name for image_name in image_list if image_name.split("/")[0] != "others"]
             image_list_individual = [image_name for image_name in image_list if image_name.split("/")[0] == "others"]
@@ -179,28 +226,80 @@ def main(
             import_images(image_dir, database, camera_mode, image_list, image_options)
 
         image_ids = get_image_ids(database)
-    if do_import_features:
+        stages.done("images")
+    if do_import_features and stages.needs_run(
+        "features", [database], features=features
+    ):
         with pycolmap.Database.open(database) as db:
+            if not keep_database:
+                db.clear_keypoints()
             import_features(image_ids, db, features)
-    if do_import_matches:
+        stages.done("features")
+    if do_import_matches and stages.needs_run(
+        "matches",
+        [database],
+        pairs=pairs,
+        matches=matches,
+        min_match_score=min_match_score,
+        skip_geometric_verification=skip_geometric_verification,
+    ):
         with pycolmap.Database.open(database) as db:
+            if not keep_database:
+                db.clear_matches()
+                db.clear_two_view_geometries()
             import_matches(image_ids, db, pairs, matches,
                            min_match_score, skip_geometric_verification)
-    if not skip_geometric_verification:
+        stages.done("matches")
+    if not skip_geometric_verification and stages.needs_run(
+        "verification", [database], pairs=pairs
+    ):
+        if not keep_database:
+            with pycolmap.Database.open(database) as db:
+                db.clear_two_view_geometries()
         estimation_and_geometric_verification(database, pairs, verbose)
+        stages.done("verification")
 
     if camera_triplet_threshold > 0:
         models_path = sfm_dir / f"models_{camera_triplet_threshold}"
         old_database = database
         database = old_database.parent / f"database_{camera_triplet_threshold}.db"
-        shutil.copy(old_database, database)
-        apply_camera_triplet_pruning(database, image_ids, camera_triplet_threshold, verbose)
+        if stages.needs_run("pruning", [database], threshold=camera_triplet_threshold):
+            shutil.copy(old_database, database)
+            apply_camera_triplet_pruning(
+                database, image_ids, camera_triplet_threshold, verbose
+            )
+            stages.done("pruning")
     else:
         models_path = sfm_dir / "models"
 
-    reconstruction = run_reconstruction(
-        models_path, database, image_dir, verbose, pipeline_options, input_path,
-    )
+    if stages.needs_run(
+        "mapping",
+        [models_path],
+        database=database.name,
+        options=pipeline_options,
+        input_path=input_path,
+        max_cluster_size=max_cluster_size,
+    ):
+        # the models of a previous mapping would be read as the result otherwise
+        if input_path is not None and models_path.resolve() in (
+            [input_path.resolve()] + list(input_path.resolve().parents)
+        ):
+            raise ValueError(f"The input model {input_path} is in {models_path}.")
+        if models_path.exists():
+            shutil.rmtree(models_path)
+        if max_cluster_size and len(image_ids) > max_cluster_size:
+            reconstruction = run_partitioned_reconstruction(
+                models_path, database, image_dir, max_cluster_size,
+                verbose=verbose, options=pipeline_options,
+            )
+        else:
+            reconstruction = run_reconstruction(
+                models_path, database, image_dir, verbose, pipeline_options, input_path,
+            )
+        if reconstruction is not None:
+            stages.done("mapping")
+    else:
+        reconstruction = read_largest_reconstruction(models_path)
     if reconstruction is not None:
         logger.info(
             f"Reconstruction statistics:\n{reconstruction.summary()}"
@@ -245,6 +344,13 @@ if __name__ == "__main__":
     parser.add_argument("--camera_triplet_threshold", default=-1, type=float,
                         help="Pruning matches based on camera triplets, helps with ambiguous pairs (doppelgangers)")
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--max_cluster_size",
+        type=int,
+        help="Reconstruct larger scenes as parallel clusters of this size",
+    )
+    parser.add_argument("--no_track_stages", dest="track_stages", action="store_false",
+                        help="Run all the stages instead of those whose inputs changed")
 
     parser.add_argument('--image_options', nargs='+', default=[],
                         help='List of key=value from {}'.format(
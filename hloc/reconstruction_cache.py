@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from . import logger
+from .utils.read_write_model import (
+    Camera,
+    Image,
+    Point3D,
+    detect_model_format,
+    read_model,
+)
+from .utils.stages import file_fingerprint
+
+
+def model_fingerprint(model: Path, use_hash: bool = False) -> Dict:
+    """Size and modification time of the model files, and optionally their
+    SHA-1, which is robust to copies that do not preserve the mtime."""
+    model = Path(model)
+    ext = ".bin" if detect_model_format(model, ".bin") else ".txt"
+    fingerprint = {}
+    for name in ("cameras", "images", "points3D"):
+        path = model / (name + ext)
+        fingerprint[path.name] = file_fingerprint(path, use_hash)
+    return fingerprint
+
+
+def default_cache_path(model: Path) -> Path:
+    """A directory of the user cache specific to the model, such that the
+    model directory is never written to."""
+    root = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    model = Path(model).resolve()
+    key = hashlib.sha1(str(model).encode()).hexdigest()[:16]
+    return root / "hloc" / "reconstructions" / f"{model.name}-{key}"
+
+
+class ReconstructionCache:
+    """Columnar copy of a COLMAP model as a directory of .npy files that are
+    memory-mapped when loaded, so opening it takes milliseconds and several
+    processes share the same pages. The 2D points of the images and the
+    tracks of the 3D points are stored as CSR arrays, indexed by offsets.
+    The cache path is a symlink to the current version of the directory."""
+
+    meta_file = "meta.json"
+    version = 1
+    arrays = (
+        "camera_ids",
+        "camera_models",
+        "camera_sizes",
+        "camera_params",
+        "camera_num_params",
+        "image_ids",
+        "image_names",
+        "image_camera_ids",
+        "qvecs",
+        "tvecs",
+        "points2D_offsets",
+        "xys",
+        "point3D_ids",
+        "points3D_ids",
+        "xyz",
+        "rgb",
+        "errors",
+        "track_offsets",
+        "track_image_ids",
+        "track_point2D_idxs",
+    )
+
+    def __init__(self, path: Path):
+        # resolve the symlink once such that a rebuild does not mix versions
+        self.path = Path(path).resolve()
+        self.meta = json.loads((self.path / self.meta_file).read_text())
+        for key in self.arrays:
+            setattr(self, key, np.load(self.path / f"{key}.npy", mmap_mode="r"))
+        self.name2idx = {n: i for i, n in enumerate(self.image_names.tolist())}
+
+    @classmethod
+    def build(cls, model: Path, path: Path, use_hash: bool = False):
+        logger.info(f"Building a reconstruction cache for {model}.")
+        fingerprint = model_fingerprint(model, use_hash)
+        cameras, images, points3D = read_model(model)
+        cameras = [cameras[i] for i in sorted(cameras)]
+        images = [images[i] for i in sorted(images)]
+        points3D = [points3D[i] for i in sorted(points3D)]
+        max_params = max([len(c.params) for c in cameras], default=0)
+
+        def offsets(arrays):
+            return np.cumsum([0] + [len(a) for a in arrays], dtype=np.int64)
+
+        def stack(arrays, shape, dtype):
+            if len(arrays) == 0:
+                return np.zeros(shape, dtype)
+            return np.concatenate(arrays).astype(dtype).reshape(shape)
+
+        data = dict(
+            camera_ids=np.array([c.id for c in cameras], np.int64),
+            camera_models=np.array([c.model for c in cameras], str),
+            camera_sizes=np.array([(c.width, c.height) for c in cameras], np.int64),
+            camera_params=np.array(
+                [np.pad(c.params, (0, max_params - len(c.params))) for c in cameras],
+                np.float64,
+            ).reshape(len(cameras), max_params),
+            camera_num_params=np.array([len(c.params) for c in cameras], np.int64),
+            image_ids=np.array([i.id for i in images], np.int64),
+            image_names=np.array([i.name for i in images], str),
+            image_camera_ids=np.array([i.camera_id for i in images], np.int64),
+            qvecs=np.array([i.qvec for i in images], np.float64).reshape(-1, 4),
+            tvecs=np.array([i.tvec for i in images], np.float64).reshape(-1, 3),
+            points2D_offsets=offsets([i.point3D_ids for i in images]),
+            xys=stack([i.xys for i in images], (-1, 2), np.float64),
+            point3D_ids=stack([i.point3D_ids for i in images], (-1,), np.int64),
+            points3D_ids=np.array([p.id for p in points3D], np.int64),
+            xyz=np.array([p.xyz for p in points3D], np.float64).reshape(-1, 3),
+            rgb=np.array([p.rgb for p in points3D], np.uint8).reshape(-1, 3),
+            errors=np.array([p.error for p in points3D], np.float64),
+            track_offsets=offsets([p.image_ids for p in points3D]),
+            track_image_ids=stack([p.image_ids for p in points3D], (-1,), np.int32),
+            track_point2D_idxs=stack(
+                [p.point2D_idxs for p in points3D], (-1,), np.int32
+            ),
+        )
+        # write to a new directory and atomically switch the symlink to it, so
+        # that readers and concurrent builders never see a partial cache
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(prefix=path.name + ".", dir=path.parent))
+        for key, array in data.items():
+            np.save(tmp_path / f"{key}.npy", array)
+        meta = {
+            "version": cls.version,
+            "model": str(Path(model).resolve()),
+            "fingerprint": fingerprint,
+        }
+        (tmp_path / cls.meta_file).write_text(json.dumps(meta, indent=2))
+        previous = path.resolve() if path.is_symlink() else None
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)  # a cache written by a previous version of hloc
+        link = tmp_path.with_name(tmp_path.name + ".link")  # unique as tmp_path
+        link.symlink_to(tmp_path.name, target_is_directory=True)
+        os.replace(link, path)
+        # the memory maps of the readers of the previous version remain valid
+        if previous is not None and previous != tmp_path.resolve():
+            shutil.rmtree(previous, ignore_errors=True)
+        return cls(path)
+
+    @classmethod
+    def load(
+        cls, model: Path, path: Optional[Path] = None, use_hash: bool = False
+    ) -> "ReconstructionCache":
+        """Open the cache of a model, (re)building it if the model changed.
+        By default the cache is stored in the user cache directory."""
+        path = default_cache_path(model) if path is None else Path(path)
+        if (path / cls.meta_file).exists():
+            meta = json.loads((path / cls.meta_file).read_text())
+            fingerprint = model_fingerprint(model, use_hash)
+            if meta["version"] == cls.version and meta["fingerprint"] == fingerprint:
+                return cls(path)
+            logger.info("The reconstruction cache is outdated.")
+        return cls.build(model, path, use_hash)
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def observations(self) -> Dict[str, np.ndarray]:
+        """The ids of the 3D points observed by each image."""
+        offsets = self.points2D_offsets.tolist()
+        return {
+            name: self.point3D_ids[i:j][self.point3D_ids[i:j] != -1]
+            for name, i, j in zip(self.image_names.tolist(), offsets[:-1], offsets[1:])
+        }
+
+    def to_cameras(self) -> Dict[int, Camera]:
+        return {
+            i: Camera(i, model, int(w), int(h), params[:n].copy())
+            for i, model, (w, h), params, n in zip(
+                self.camera_ids.tolist(),
+                self.camera_models.tolist(),
+                self.camera_sizes,
+                self.camera_params,
+                self.camera_num_params.tolist(),
+            )
+        }
+
+    def to_images(self, with_points2D: bool = True) -> Dict[int, Image]:
+        offsets = self.points2D_offsets.tolist()
+        qvecs, tvecs = np.array(self.qvecs), np.array(self.tvecs)
+        images = {}
+        for k, (i, name, camera_id) in enumerate(
+            zip(
+                self.image_ids.tolist(),
+                self.image_names.tolist(),
+                self.image_camera_ids.tolist(),
+            )
+        ):
+            start, end = (offsets[k], offsets[k + 1]) if with_points2D else (0, 0)
+            images[i] = Image(
+                i,
+                qvecs[k],
+                tvecs[k],
+                camera_id,
+                name,
+                np.array(self.xys[start:end]),
+                np.array(self.point3D_ids[start:end]),
+            )
+        return images
+
+    def to_points3D(self) -> Dict[int, Point3D]:
+        offsets = self.track_offsets.tolist()
+        image_ids = np.array(self.track_image_ids, np.int64)
+        point2D_idxs = np.array(self.track_point2D_idxs, np.int64)
+        rgb = np.array(self.rgb, np.int64)
+        xyz = np.array(self.xyz)
+        return {
+            i: Point3D(
+                i,
+                xyz[k],
+                rgb[k],
+                np.array(error),
+                image_ids[offsets[k] : offsets[k + 1]],
+                point2D_idxs[offsets[k] : offsets[k + 1]],
+            )
+            for k, (i, error) in enumerate(
+                zip(self.points3D_ids.tolist(), self.errors.tolist())
+            )
+        }
+
+    def to_model(self):
+        """The same cameras, images, and points3D as read_model."""
+        return self.to_cameras(), self.to_images(), self.to_points3D()
+
+
+def main(model: Path, output: Optional[Path] = None, use_hash: bool = False):
+    cache = ReconstructionCache.load(model, output, use_hash)
+    logger.info(
+        f"Reconstruction cache at {cache.path} with {len(cache)} images "
+        f"and {len(cache.points3D_ids)} points."
+    )
+    return cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, type=Path)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--use_hash", action="store_true")
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -0,0 +1,85 @@
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from . import logger
+from .pairs_from_retrieval import get_descriptors, parse_names
+from .utils.ann import IVFIndex
+from .utils.io import list_h5_names
+
+
+def benchmark(
+    index: IVFIndex,
+    query_desc: np.ndarray,
+    db_desc: np.ndarray,
+    k: int,
+    nprobes: List[int] = [1, 4, 16, 64],
+):
+    """Compare the recall@k and the latency of the index to exact search.
+    The database indices of the index must be the rows of db_desc."""
+    query_desc = query_desc.astype(np.float32)
+    db_desc = db_desc.astype(np.float32)
+    start = time.time()
+    sim = query_desc @ db_desc.T
+    exact = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+    exact_time = (time.time() - start) / len(query_desc)
+    logger.info(f"Exact search: {1e3 * exact_time:.3f} ms/query.")
+    results = []
+    for nprobe in nprobes:
+        start = time.time()
+        _, indices = index.search(query_desc, k, nprobe)
+        latency = (time.time() - start) / len(query_desc)
+        recall = np.mean(
+            [len(np.intersect1d(i, e)) / k for i, e in zip(indices, exact)]
+        )
+        results.append((nprobe, recall, latency))
+        logger.info(
+            f"nprobe={nprobe}: recall@{k}={recall:.3f}, "
+            f"{1e3 * latency:.3f} ms/query ({exact_time / latency:.1f}x)."
+        )
+    return results
+
+
+def main(
+    descriptors: Path,
+    output: Path,
+    num_lists: int = 1024,
+    num_subspaces: Optional[int] = None,
+    db_prefix=None,
+    db_list=None,
+    benchmark_queries: Optional[Path] = None,
+    benchmark_k: int = 10,
+):
+    logger.info("Building a retrieval index from global descriptors.")
+    db_names = parse_names(db_prefix, db_list, list_h5_names(descriptors))
+    if len(db_names) == 0:
+        raise ValueError("Could not find any database image.")
+    db_desc = get_descriptors(db_names, descriptors).numpy()
+
+    index = IVFIndex.build(db_desc, db_names, num_lists, num_subspaces)
+    output.parent.mkdir(exist_ok=True, parents=True)
+    index.save(output)
+    logger.info(f"Indexed {len(index)} images in {index.num_lists} lists.")
+
+    if benchmark_queries is not None:
+        query_names = list_h5_names(benchmark_queries)
+        query_desc = get_descriptors(query_names, benchmark_queries).numpy()
+        benchmark(index, query_desc, db_desc, benchmark_k)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--descriptors", type=Path, required=True)
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--num_lists", type=int, default=1024)
+    parser.add_argument("--num_subspaces", type=int)
+    parser.add_argument("--db_prefix", type=str, nargs="+")
+    parser.add_argument("--db_list", type=Path)
+    parser.add_argument("--benchmark_queries", type=Path)
+    parser.add_argument("--benchmark_k", type=int, default=10)
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -0,0 +1,353 @@
+import argparse
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from . import logger
+from .descriptor_store import DescriptorStore
+from .pairs_from_retrieval import get_descriptors
+from .utils.ann import IVFIndex
+from .utils.io import list_h5_names
+from .utils.whitening import apply_whitening, read_whitening
+
+
+class EmptyDatabaseError(RuntimeError):
+    pass
+
+
+class RetrievalDatabase:
+    """Database descriptors held in memory, or only an IVF index if given.
+    The sources are HDF5 global feature files or a descriptor store, and
+    reload() appends the images that were added to them since."""
+
+    def __init__(
+        self,
+        descriptors: Union[Path, List[Path]],
+        index: Optional[Path] = None,
+        nprobe: int = 16,
+    ):
+        if isinstance(descriptors, (Path, str)):
+            descriptors = [descriptors]
+        self.sources = [Path(p) for p in descriptors]
+        self.whitening = read_whitening(self.sources[0])
+        self.index = IVFIndex.load(index) if index is not None else None
+        self.nprobe = nprobe
+        self.names = []
+        self.name2id = {}
+        self.name2source = {}
+        self.stores = {}  # one handle per descriptor store, reopened on reload
+        self.desc = None
+        self.dim = None
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.reload()
+
+    def read_source(self, path: Path, names: List[str]) -> np.ndarray:
+        if path in self.stores:
+            return np.asarray(self.stores[path].get(names), dtype=np.float32)
+        return get_descriptors(names, path).numpy()
+
+    def read_new(self):
+        names, desc, sources = [], [], []
+        for path in self.sources:
+            if DescriptorStore.is_store(path):
+                self.stores[path] = DescriptorStore(path)
+                available = self.stores[path].names
+            else:
+                available = list_h5_names(path)
+            new = [n for n in available if n not in self.name2id]
+            if len(new) > 0:
+                desc.append(self.read_source(path, new))
+            names += new
+            sources += [path] * len(new)
+        return names, desc, sources
+
+    def reload(self) -> int:
+        """Load the images that are not yet in the database."""
+        with self.reload_lock:
+            return self._reload()
+
+    def _reload(self) -> int:
+        # the search is only blocked while the new entries are merged
+        names, desc, sources = self.read_new()
+        if len(names) == 0:
+            return 0
+        desc = np.concatenate(desc)
+        with self.lock:
+            if self.index is not None:
+                # the dense descriptors are not kept next to the index
+                indexed = set(self.index.names.tolist())
+                keep = [i for i, n in enumerate(names) if n not in indexed]
+                if len(keep) > 0:
+                    self.index.add(desc[keep], [names[i] for i in keep])
+            # extend the descriptors first for readers that do not lock
+            elif self.desc is None:
+                self.desc = desc
+            else:
+                self.desc = np.concatenate([self.desc, desc])
+            self.dim = desc.shape[1]
+            offset = len(self.names)
+            self.names = self.names + names
+            self.name2source.update(zip(names, sources))
+            self.name2id.update({n: offset + i for i, n in enumerate(names)})
+        logger.info(f"Loaded {len(names)} images, the database has {len(self)}.")
+        return len(names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get_descriptors(self, names: List[str]) -> np.ndarray:
+        """The descriptors of database images, read again from their source
+        if only the index is held in memory."""
+        if self.desc is not None:
+            return self.desc[[self.name2id[n] for n in names]]
+        return np.concatenate(
+            [self.read_source(self.name2source[n], [n]) for n in names]
+        )
+
+    def prepare_queries(self, query: np.ndarray) -> np.ndarray:
+        """Whiten the queries if needed and check that they can be searched,
+        since a batch of queries fails as a whole."""
+        query = np.atleast_2d(query).astype(np.float32)
+        if self.dim is None:
+            raise EmptyDatabaseError("The database is empty.")
+        if query.ndim != 2 or len(query) == 0:
+            raise ValueError(f"Expected a non-empty query matrix, got {query.shape}.")
+        if self.whitening is not None:
+            if query.shape[1] == self.whitening["pca_projection"].shape[0]:
+                query = apply_whitening(query, self.whitening)
+        if query.shape[1] != self.dim:
+            raise ValueError(
+                f"The queries have dimension {query.shape[1]} instead of {self.dim}."
+            )
+        return query
+
+    def search(self, query: np.ndarray, k: int):
+        with self.lock:
+            if len(self.names) == 0:
+                raise EmptyDatabaseError("The database is empty.")
+            if self.index is not None:
+                scores, ids = self.index.search(query, k, self.nprobe)
+                names = self.index.names
+            else:
+                sim = query @ self.desc.T
+                k = min(k, sim.shape[1])
+                ids = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(sim, ids, 1)
+                order = np.argsort(-scores, axis=1)
+                ids = np.take_along_axis(ids, order, 1)
+                scores = np.take_along_axis(scores, order, 1)
+                names = self.names
+        return scores, [[names[j] for j in row if j != -1] for row in ids]
+
+
+class BatchedSearcher:
+    """Group concurrent requests into batches that are searched at once.
+    A batch is closed when it has max_batch queries or after max_wait s."""
+
+    def __init__(
+        self, database: RetrievalDatabase, max_batch: int = 64, max_wait=0.005
+    ):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def search(self, query: np.ndarray, k: int, exclude: List[List[str]]):
+        item = {"query": query, "k": k, "exclude": exclude}
+        item["done"] = threading.Event()
+        self.queue.put(item)
+        item["done"].wait()
+        if "error" in item:
+            raise item["error"]
+        return item["result"]
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while sum(len(i["query"]) for i in items) < self.max_batch:
+                timeout = max(deadline - time.time(), 0)
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            try:
+                self.process(items)
+            except Exception as error:
+                for item in items:
+                    item["error"] = error
+            for item in items:
+                item["done"].set()
+
+    def process(self, items):
+        query = np.concatenate([i["query"] for i in items])
+        # retrieve more results to remove the excluded images afterwards
+        num_extra = max((len(e) for i in items for e in i["exclude"]), default=0)
+        k = max(i["k"] for i in items) + num_extra
+        scores, names = self.database.search(query, k)
+        offset = 0
+        for item in items:
+            results = []
+            for i, exclude in enumerate(item["exclude"]):
+                row = [
+                    (n, float(s))
+                    for n, s in zip(names[offset + i], scores[offset + i])
+                    if n not in exclude
+                ]
+                results.append(row[: item["k"]])
+            item["result"] = results
+            offset += len(item["query"])
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API:
+    - POST /search {"names": [...] or "descriptors": [[...]], "k": 10}
+      returns {"results": [[[name, score], ...], ...]}, one list per query.
+      Queries given by names do not retrieve themselves.
+    - POST /reload loads the images added to the database sources.
+    - GET /status returns the size of the database."""
+
+    def reply(self, code: int, data: Dict):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, {"num_images": len(self.server.database)})
+        else:
+            self.reply(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/search":
+                self.reply(200, {"results": self.server.search(request)})
+            elif self.path == "/reload":
+                self.reply(200, {"num_added": self.server.database.reload()})
+            else:
+                self.reply(404, {"error": f"Unknown path {self.path}."})
+        except EmptyDatabaseError as error:
+            self.reply(503, {"error": str(error)})
+        except (KeyError, ValueError) as error:
+            self.reply(400, {"error": str(error)})
+        except Exception as error:
+            logger.exception("Failed to process a request.")
+            self.reply(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class RetrievalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        database: RetrievalDatabase,
+        query_descriptors: Optional[Path] = None,
+        max_batch: int = 64,
+        max_wait: float = 0.005,
+    ):
+        super().__init__(address, RequestHandler)
+        self.database = database
+        self.query_descriptors = query_descriptors
+        self.searcher = BatchedSearcher(database, max_batch, max_wait)
+
+    def get_query_descriptors(self, names: List[str]) -> np.ndarray:
+        desc = []
+        for name in names:
+            if name in self.database.name2id:
+                desc.append(self.database.get_descriptors([name])[0])
+            elif self.query_descriptors is not None:
+                desc.append(get_descriptors([name], self.query_descriptors)[0])
+            else:
+                raise KeyError(f"Unknown image {name}.")
+        return np.stack(desc)
+
+    def search(self, request: Dict):
+        k = int(request.get("k", 10))
+        if "names" in request:
+            names = request["names"]
+            desc = self.get_query_descriptors(names)
+            exclude = [[n] for n in names]
+        elif "descriptors" in request:
+            desc = np.array(request["descriptors"], dtype=np.float32)
+            exclude = request.get("exclude", [[] for _ in range(len(desc))])
+        else:
+            raise ValueError("Provide either query names or descriptors.")
+        desc = self.database.prepare_queries(desc)
+        if k < 1:
+            raise ValueError(f"Invalid number of results k={k}.")
+        if len(exclude) != len(desc) or not all(isinstance(e, list) for e in exclude):
+            raise ValueError("Provide one list of excluded names per query.")
+        return self.searcher.search(desc, k, exclude)
+
+
+def start_service(
+    database: RetrievalDatabase, host: str = "127.0.0.1", port: int = 0, **kwargs
+) -> RetrievalServer:
+    """Serve in a background thread, port=0 picks a free port."""
+    server = RetrievalServer((host, port), database, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Retrieval service listening on {host}:{server.server_port}.")
+    return server
+
+
+def query_service(url: str, path: str = "/search", **request) -> Dict:
+    """Send a request to a running service, e.g.
+    query_service("http://127.0.0.1:8765", names=["query/1.jpg"], k=20)."""
+    data = json.dumps(request).encode()
+    req = urllib.request.Request(
+        url + path, data=data, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def main(
+    descriptors: List[Path],
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    query_descriptors: Optional[Path] = None,
+    db_index: Optional[Path] = None,
+    nprobe: int = 16,
+    max_batch: int = 64,
+):
+    database = RetrievalDatabase(descriptors, db_index, nprobe)
+    server = RetrievalServer(
+        (host, port), database, query_descriptors, max_batch=max_batch
+    )
+    logger.info(f"Retrieval service listening on {host}:{port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--descriptors", type=Path, nargs="+", required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--query_descriptors", type=Path)
+    parser.add_argument("--db_index", type=Path)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--max_batch", type=int, default=64)
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -1,15 +1,31 @@
 import argparse
+import copy
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import pycolmap
 from tqdm import tqdm
 
 from . import logger
-from .utils.geometry import compute_epipolar_errors
-from .utils.io import get_keypoints, get_matches
-from .utils.parsers import parse_retrieval
+from .camera_triplets import image_ids_to_pair_id
+from .utils.geometry import (
+    compute_epipolar_errors_batch,
+    essential_matrices_from_poses,
+)
+from .utils.io import (
+    get_keypoints_batch,
+    get_matches_batch,
+    iter_keypoints,
+    map_ordered,
+    prefetch,
+)
+from .utils.pair_sources import PairList, PairSource, as_pair_source
 
 
 class OutputCapture:
@@ -44,50 +60,233 @@ def create_db_from_model(
     return {image.name: image_id for image_id, image in reconstruction.images.items()}
 
 
+def read_database_contents(database_path: Path) -> Dict[str, Any]:
+    """The ids of the entities already in a database, read with plain SQL:
+    the images by name, the cameras, rigs and frames, the images with
+    keypoints, and the pair ids with matches or with a two-view geometry."""
+    db = sqlite3.connect(str(database_path))
+    contents = {
+        "images": dict(db.execute("SELECT name, image_id FROM images;")),
+        "cameras": {i for i, in db.execute("SELECT camera_id FROM cameras;")},
+        "rigs": {i for i, in db.execute("SELECT rig_id FROM rigs;")},
+        "frames": {i for i, in db.execute("SELECT frame_id FROM frames;")},
+        "keypoints": {i for i, in db.execute("SELECT image_id FROM keypoints;")},
+        "matches": {i for i, in db.execute("SELECT pair_id FROM matches;")},
+        "geometries": {
+            i for i, in db.execute("SELECT pair_id FROM two_view_geometries;")
+        },
+    }
+    db.close()
+    return contents
+
+
+def extend_db_from_model(
+    reconstruction: pycolmap.Reconstruction, database_path: Path
+) -> Tuple[Dict[str, int], Dict[str, Any]]:
+    """Add to an existing database the cameras, rigs, frames, and images of
+    the model that it does not contain yet. Returns the ids of all images
+    and the contents of the database before the update."""
+    contents = read_database_contents(database_path)
+    id_to_name = {i: n for n, i in contents["images"].items()}
+    for image_id, image in reconstruction.images.items():
+        if contents["images"].get(image.name, image_id) != image_id:
+            raise ValueError(
+                f"Image {image.name} has id {image_id} in the model but "
+                f"{contents['images'][image.name]} in the database {database_path}."
+            )
+        if id_to_name.get(image_id, image.name) != image.name:
+            raise ValueError(
+                f"Image id {image_id} is {image.name} in the model but "
+                f"{id_to_name[image_id]} in the database {database_path}."
+            )
+    with pycolmap.Database.open(database_path) as db:
+        for camera_id, camera in reconstruction.cameras.items():
+            if camera_id not in contents["cameras"]:
+                db.write_camera(camera, use_camera_id=True)
+        for rig_id, rig in reconstruction.rigs.items():
+            if rig_id not in contents["rigs"]:
+                db.write_rig(rig, use_rig_id=True)
+        for frame_id, frame in reconstruction.frames.items():
+            if frame_id not in contents["frames"]:
+                db.write_frame(frame, use_frame_id=True)
+        new_images = [
+            image
+            for image in reconstruction.images.values()
+            if image.name not in contents["images"]
+        ]
+        for image in new_images:
+            db.write_image(image, use_image_id=True)
+    logger.info(f"Added {len(new_images)} new images to the existing database.")
+    image_ids = {image.name: i for i, image in reconstruction.images.items()}
+    return image_ids, contents
+
+
+def register_new_images(
+    reconstruction: pycolmap.Reconstruction, reference: pycolmap.Reconstruction
+) -> List[int]:
+    """Add to a triangulated model the posed images of the reference model
+    that it does not contain yet. The images are added without 2D points,
+    which the triangulation then reads from the database."""
+    new_image_ids = []
+    for image_id, image in reference.images.items():
+        if reconstruction.exists_image(image_id):
+            if reconstruction.image(image_id).name != image.name:
+                raise ValueError(
+                    f"Image id {image_id} is {image.name} in the reference model "
+                    f"but {reconstruction.image(image_id).name} in the model."
+                )
+            continue
+        frame = reference.frame(image.frame_id)
+        if not reconstruction.exists_camera(image.camera_id):
+            reconstruction.add_camera(reference.camera(image.camera_id))
+        if not reconstruction.exists_rig(frame.rig_id):
+            reconstruction.add_rig(reference.rig(frame.rig_id))
+        if not reconstruction.exists_frame(image.frame_id):
+            frame = copy.copy(frame)
+            frame.reset_rig_ptr()  # it points to the rig of the reference
+            reconstruction.add_frame(frame)
+        new_image = pycolmap.Image(
+            name=image.name, camera_id=image.camera_id, image_id=image_id
+        )
+        new_image.frame_id = image.frame_id
+        reconstruction.add_image(new_image)
+        new_image_ids.append(image_id)
+    for frame_id in {reference.image(i).frame_id for i in new_image_ids}:
+        reconstruction.register_frame(frame_id)
+    return new_image_ids
+
+
+def find_new_pairs(
+    pairs: Union[Path, PairSource], image_ids: Dict[str, int], imported: Set[int]
+) -> PairList:
+    """The pairs whose pair id is not among the imported ones, once each."""
+    new_pairs = []
+    imported = set(imported)
+    for name0, name1 in as_pair_source(pairs):
+        pair_id = image_ids_to_pair_id(image_ids[name0], image_ids[name1])
+        if pair_id not in imported:
+            imported.add(pair_id)
+            new_pairs.append((name0, name1))
+    return PairList(new_pairs)
+
+
 def import_features(
-    image_ids: Dict[str, int], db: pycolmap.Database, features_path: Path
+    image_ids: Dict[str, int],
+    db: pycolmap.Database,
+    features_path: Path,
+    batch_size: int = 256,
 ):
+    """The keypoints are read from a single open file in a background thread
+    while the previous batch is written to the database in one transaction."""
     logger.info("Importing features into the database...")
-    for image_name, image_id in tqdm(image_ids.items()):
-        keypoints = get_keypoints(features_path, image_name)
-        keypoints += 0.5  # COLMAP origin
-        db.write_keypoints(image_id, keypoints)
+    start = time.time()
+    batches = prefetch(
+        partial(iter_keypoints, features_path, list(image_ids), batch_size)
+    )
+    with tqdm(total=len(image_ids)) as pbar:
+        for batch in batches:
+            with pycolmap.DatabaseTransaction(db):
+                for image_name, keypoints in batch:
+                    keypoints += 0.5  # COLMAP origin
+                    db.write_keypoints(image_ids[image_name], keypoints)
+            pbar.update(len(batch))
+    duration = time.time() - start
+    logger.info(
+        f"Imported the keypoints of {len(image_ids)} images in {duration:.1f}s "
+        f"({len(image_ids) / max(duration, 1e-6):.1f} images/s)."
+    )
+
+
+def iter_pair_batches(
+    pairs: PairSource, image_ids: Dict[str, int], batch_size: int
+) -> Iterator[Tuple[List[Tuple[str, str]], List[Tuple[int, int]]]]:
+    """Batches of the names and image ids of the pairs, without duplicates.
+    Duplicates, in either order, are tracked by their COLMAP pair id."""
+    imported = set()
+    names, ids = [], []
+    for name0, name1 in pairs:
+        id0, id1 = image_ids[name0], image_ids[name1]
+        # sources of unique pairs do not need to track the imported pairs
+        if not pairs.unique:
+            pair_id = image_ids_to_pair_id(id0, id1)
+            if pair_id in imported:
+                continue
+            imported.add(pair_id)
+        names.append((name0, name1))
+        ids.append((id0, id1))
+        if len(names) == batch_size:
+            yield names, ids
+            names, ids = [], []
+    if len(names) > 0:
+        yield names, ids
+
+
+def read_matches_batch(
+    matches_path: Path,
+    min_match_score: Optional[float],
+    batch: Tuple[List[Tuple[str, str]], List[Tuple[int, int]]],
+) -> Tuple[List[Tuple[int, int]], List[np.ndarray]]:
+    names, ids = batch
+    matches = []
+    for m, scores in get_matches_batch(matches_path, names):
+        if min_match_score:
+            m = m[scores > min_match_score]
+        matches.append(m)
+    return ids, matches
 
 
 def import_matches(
     image_ids: Dict[str, int],
     db: pycolmap.Database,
-    pairs_path: Path,
+    pairs_path: Union[Path, PairSource],
     matches_path: Path,
     min_match_score: Optional[float] = None,
     skip_geometric_verification: bool = False,
+    num_workers: int = 4,
+    batch_size: int = 1024,
 ):
+    """The matches are decoded by worker threads, each reading a batch of
+    pairs from a single open handle, while this thread alone writes the
+    decoded batches to the database, in order and one transaction each.
+    Threads suffice since h5py serializes the reads anyway."""
     logger.info("Importing matches into the database...")
-
-    with open(str(pairs_path), "r") as f:
-        pairs = [p.split() for p in f.readlines()]
-
-    matched = set()
-    for name0, name1 in tqdm(pairs):
-        id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
-            continue
-        matches, scores = get_matches(matches_path, name0, name1)
-        if min_match_score:
-            matches = matches[scores > min_match_score]
-        db.write_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
-
-        if skip_geometric_verification:
-            db.write_two_view_geometry(
-                id0, id1, pycolmap.TwoViewGeometry(inlier_matches=matches)
-            )
+    start = time.time()
+
+    pairs = as_pair_source(pairs_path)
+    results = map_ordered(
+        partial(read_matches_batch, matches_path, min_match_score),
+        iter_pair_batches(pairs, image_ids, batch_size),
+        num_workers,
+        use_threads=True,
+    )
+    num_imported = 0
+    with tqdm(total=len(pairs)) as pbar:
+        for ids, matches in results:
+            with pycolmap.DatabaseTransaction(db):
+                for (id0, id1), m in zip(ids, matches):
+                    db.write_matches(id0, id1, m)
+                    if skip_geometric_verification:
+                        db.write_two_view_geometry(
+                            id0, id1, pycolmap.TwoViewGeometry(inlier_matches=m)
+                        )
+            num_imported += len(ids)
+            pbar.update(len(ids))
+    duration = time.time() - start
+    logger.info(
+        f"Imported the matches of {num_imported} pairs in {duration:.1f}s "
+        f"({num_imported / max(duration, 1e-6):.1f} pairs/s)."
+    )
 
 
 def estimation_and_geometric_verification(
-    database_path: Path, pairs_path: Path, verbose: bool = False
+    database_path: Path, pairs_path: Union[Path, PairSource], verbose: bool = False
 ):
     logger.info("Performing geometric verification of the matches...")
+    if isinstance(pairs_path, PairSource):
+        # COLMAP reads the pairs to verify from a file
+        pairs_file = database_path.parent / "pairs-verification.txt"
+        pairs_path.write(pairs_file)
+        pairs_path = pairs_file
     with OutputCapture(verbose):
         pycolmap.verify_matches(
             database_path,
@@ -96,69 +295,157 @@ def estimation_and_geometric_verification(
         )
 
 
+class KeypointCache:
+    """Keypoints of the images in normalized camera coordinates, with the
+    threshold on their epipolar errors, computed once per image. The least
+    recently used images are evicted beyond max_size images."""
+
+    def __init__(
+        self,
+        reference: pycolmap.Reconstruction,
+        image_ids: Dict[str, int],
+        features_path: Path,
+        max_error: float,
+        max_size: int = 4096,
+    ):
+        self.reference = reference
+        self.image_ids = image_ids
+        self.features_path = features_path
+        self.max_error = max_error
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def undistort(self, name: str, kps: np.ndarray, noise: Optional[float]):
+        image = self.reference.images[self.image_ids[name]]
+        cam = self.reference.cameras[image.camera_id]
+        noise = 1.0 if noise is None else noise
+        if len(kps) > 0:
+            kps = np.stack(cam.cam_from_img(kps))
+        else:
+            kps = np.zeros((0, 2))
+        return kps, cam.cam_from_img_threshold(noise * self.max_error)
+
+    def get(self, names: List[str]) -> Dict[str, Tuple[np.ndarray, float]]:
+        entries = {}
+        with self.lock:
+            for name in names:
+                if name in self.entries:
+                    self.entries.move_to_end(name)
+                    entries[name] = self.entries[name]
+        missing = [n for n in dict.fromkeys(names) if n not in entries]
+        if len(missing) > 0:
+            keypoints = get_keypoints_batch(self.features_path, missing)
+            for name, (kps, noise) in zip(missing, keypoints):
+                entries[name] = self.undistort(name, kps, noise)
+            with self.lock:
+                for name in missing:
+                    self.entries[name] = entries[name]
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return entries
+
+
+class EpipolarVerifier:
+    """Find the inlier matches of batches of pairs from their epipolar errors
+    with respect to the known poses. The errors of all the matches of a batch
+    are computed at once. Thread-safe, so batches can be verified in parallel.
+    """
+
+    def __init__(
+        self,
+        reference: pycolmap.Reconstruction,
+        image_ids: Dict[str, int],
+        features_path: Path,
+        matches_path: Path,
+        max_error: float = 4.0,
+        cache_size: int = 4096,
+    ):
+        self.keypoints = KeypointCache(
+            reference, image_ids, features_path, max_error, cache_size
+        )
+        self.matches_path = matches_path
+        self.rotations, self.translations = {}, {}
+        for image_id, image in reference.images.items():
+            cam_from_world = image.cam_from_world()
+            self.rotations[image_id] = cam_from_world.rotation.matrix()
+            self.translations[image_id] = cam_from_world.translation
+
+    def __call__(
+        self, batch: Tuple[List[Tuple[str, str]], List[Tuple[int, int]]]
+    ) -> Tuple[List[Tuple[int, int]], List[np.ndarray], List[np.ndarray]]:
+        names, ids = batch
+        matches = [m for m, _ in get_matches_batch(self.matches_path, names)]
+        keypoints = self.keypoints.get([n for pair in names for n in pair])
+
+        ids0, ids1 = zip(*ids)
+        R0 = np.stack([self.rotations[i] for i in ids0])
+        R1 = np.stack([self.rotations[i] for i in ids1])
+        t0 = np.stack([self.translations[i] for i in ids0])
+        t1 = np.stack([self.translations[i] for i in ids1])
+        R_1from0 = R1 @ R0.transpose(0, 2, 1)
+        t_1from0 = t1 - np.einsum("nij,nj->ni", R_1from0, t0)
+        E = essential_matrices_from_poses(R_1from0, t_1from0)
+
+        counts = [len(m) for m in matches]
+        pair_idx = np.repeat(np.arange(len(ids)), counts)
+        kps0 = [keypoints[n0][0][m[:, 0]] for (n0, _), m in zip(names, matches)]
+        kps1 = [keypoints[n1][0][m[:, 1]] for (_, n1), m in zip(names, matches)]
+        thresh0 = np.array([keypoints[n0][1] for n0, _ in names])
+        thresh1 = np.array([keypoints[n1][1] for _, n1 in names])
+        errors0, errors1 = compute_epipolar_errors_batch(
+            E[pair_idx], np.concatenate(kps0), np.concatenate(kps1)
+        )
+        valid = np.logical_and(
+            errors0 <= thresh0[pair_idx], errors1 <= thresh1[pair_idx]
+        )
+        return ids, matches, np.split(valid, np.cumsum(counts)[:-1])
+
+
 def geometric_verification(
     image_ids: Dict[str, int],
     reference: pycolmap.Reconstruction,
     db: pycolmap.Database,
     features_path: Path,
-    pairs_path: Path,
+    pairs_path: Union[Path, PairSource],
     matches_path: Path,
     max_error: float = 4.0,
+    num_workers: int = 4,
+    batch_size: int = 128,
+    cache_size: int = 4096,
 ):
+    """Batches of pairs are verified by a pool of threads and their inlier
+    matches are written to the database by this thread, in order."""
     logger.info("Performing geometric verification of the matches...")
 
-    pairs = parse_retrieval(pairs_path)
-
+    pairs = as_pair_source(pairs_path)
+    verifier = EpipolarVerifier(
+        reference, image_ids, features_path, matches_path, max_error, cache_size
+    )
+    results = map_ordered(
+        verifier,
+        iter_pair_batches(pairs, image_ids, batch_size),
+        num_workers,
+        use_threads=True,
+    )
     inlier_ratios = []
-    matched = set()
-    for name0 in tqdm(pairs):
-        id0 = image_ids[name0]
-        image0 = reference.images[id0]
-        cam0 = reference.cameras[image0.camera_id]
-        kps0, noise0 = get_keypoints(features_path, name0, return_uncertainty=True)
-        noise0 = 1.0 if noise0 is None else noise0
-        if len(kps0) > 0:
-            kps0 = np.stack(cam0.cam_from_img(kps0))
-        else:
-            kps0 = np.zeros((0, 2))
-
-        for name1 in pairs[name0]:
-            id1 = image_ids[name1]
-            image1 = reference.images[id1]
-            cam1 = reference.cameras[image1.camera_id]
-            kps1, noise1 = get_keypoints(features_path, name1, return_uncertainty=True)
-            noise1 = 1.0 if noise1 is None else noise1
-            if len(kps1) > 0:
-                kps1 = np.stack(cam1.cam_from_img(kps1))
-            else:
-                kps1 = np.zeros((0, 2))
-
-            matches = get_matches(matches_path, name0, name1)[0]
-
-            if len({(id0, id1), (id1, id0)} & matched) > 0:
-                continue
-            matched |= {(id0, id1), (id1, id0)}
-
-            if matches.shape[0] == 0:
-                db.write_two_view_geometry(id0, id1, pycolmap.TwoViewGeometry())
-                continue
-
-            cam1_from_cam0 = image1.cam_from_world() * image0.cam_from_world().inverse()
-            errors0, errors1 = compute_epipolar_errors(
-                cam1_from_cam0, kps0[matches[:, 0]], kps1[matches[:, 1]]
-            )
-            valid_matches = np.logical_and(
-                errors0 <= cam0.cam_from_img_threshold(noise0 * max_error),
-                errors1 <= cam1.cam_from_img_threshold(noise1 * max_error),
-            )
-            # TODO: We could also add E to the database, but we need
-            # to reverse the transformations if id0 > id1 in utils/database.py.
-            db.write_two_view_geometry(
-                id0,
-                id1,
-                pycolmap.TwoViewGeometry(inlier_matches=matches[valid_matches, :]),
-            )
-            inlier_ratios.append(np.mean(valid_matches))
+    with tqdm(total=len(pairs)) as pbar:
+        for ids, matches, valid in results:
+            with pycolmap.DatabaseTransaction(db):
+                for (id0, id1), m, v in zip(ids, matches, valid):
+                    if m.shape[0] == 0:
+                        db.write_two_view_geometry(id0, id1, pycolmap.TwoViewGeometry())
+                        continue
+                    # TODO: We could also add E to the database, but we need
+                    # to reverse the transformations if id0 > id1.
+                    db.write_two_view_geometry(
+                        id0, id1, pycolmap.TwoViewGeometry(inlier_matches=m[v])
+                    )
+                    inlier_ratios.append(np.mean(v))
+            pbar.update(len(ids))
+    if len(inlier_ratios) == 0:
+        logger.warning("No pair has any match.")
+        return
     logger.info(
         "mean/med/min/max valid matches %.2f/%.2f/%.2f/%.2f%%.",
         np.mean(inlier_ratios) * 100,
@@ -175,14 +462,22 @@ def run_triangulation(
     reference_model: pycolmap.Reconstruction,
     verbose: bool = False,
     options: Optional[Dict[str, Any]] = None,
+    clear_points: bool = True,
 ) -> pycolmap.Reconstruction:
+    """With clear_points=False, the 3D points of the reference model are kept
+    and only extended or completed with the new observations."""
     model_path.mkdir(parents=True, exist_ok=True)
     logger.info("Running 3D triangulation...")
     if options is None:
         options = {}
     with OutputCapture(verbose):
         reconstruction = pycolmap.triangulate_points(
-            reference_model, database_path, image_dir, model_path, options=options
+            reference_model,
+            database_path,
+            image_dir,
+            model_path,
+            clear_points=clear_points,
+            options=options,
         )
     return reconstruction
 
@@ -191,7 +486,7 @@ def main(
     sfm_dir: Path,
     reference_model: Path,
     image_dir: Path,
-    pairs: Path,
+    pairs: Union[Path, PairSource],
     features: Path,
     matches: Path,
     skip_geometric_verification: bool = False,
@@ -199,19 +494,39 @@ def main(
     min_match_score: Optional[float] = None,
     verbose: bool = False,
     mapper_options: Optional[Dict[str, Any]] = None,
+    incremental: bool = False,
 ) -> pycolmap.Reconstruction:
+    """With incremental=True, an existing database is extended with the new
+    images, keypoints, and pairs of the reference model instead of being
+    recreated, and only the new pairs are geometrically verified. The new
+    images are then registered in the model previously triangulated in
+    sfm_dir, whose 3D points are kept and extended."""
     assert reference_model.exists(), reference_model
     assert features.exists(), features
-    assert pairs.exists(), pairs
+    assert isinstance(pairs, PairSource) or pairs.exists(), pairs
     assert matches.exists(), matches
 
     sfm_dir.mkdir(parents=True, exist_ok=True)
     database = sfm_dir / "database.db"
     reference = pycolmap.Reconstruction(reference_model)
 
-    image_ids = create_db_from_model(reference, database)
+    if incremental and database.exists():
+        image_ids, contents = extend_db_from_model(reference, database)
+        new_image_ids = {
+            n: i for n, i in image_ids.items() if i not in contents["keypoints"]
+        }
+        # pairs that were imported but not verified yet are verified again
+        unverified = find_new_pairs(pairs, image_ids, contents["geometries"])
+        pairs = find_new_pairs(pairs, image_ids, contents["matches"])
+        logger.info(
+            f"Importing {len(new_image_ids)} new images and {len(pairs)} new pairs."
+        )
+    else:
+        image_ids = create_db_from_model(reference, database)
+        new_image_ids = image_ids
+        unverified = pairs
     with pycolmap.Database.open(database) as db:
-        import_features(image_ids, db, features)
+        import_features(new_image_ids, db, features)
         import_matches(
             image_ids,
             db,
@@ -221,16 +536,26 @@ def main(
             skip_geometric_verification,
         )
     if not skip_geometric_verification:
-        if estimate_two_view_geometries:
-            estimation_and_geometric_verification(database, pairs, verbose)
+        if isinstance(unverified, PairSource) and len(unverified) == 0:
+            logger.info("All the pairs are already verified.")
+        elif estimate_two_view_geometries:
+            estimation_and_geometric_verification(database, unverified, verbose)
         else:
             with pycolmap.Database.open(database) as db:
                 geometric_verification(
-                    image_ids, reference, db, features, pairs, matches
+                    image_ids, reference, db, features, unverified, matches
                 )
-    reconstruction = run_triangulation(
-        sfm_dir, database, image_dir, reference, verbose, mapper_options
-    )
+    if incremental and (sfm_dir / "images.bin").exists():
+        model = pycolmap.Reconstruction(sfm_dir)
+        new_image_ids = register_new_images(model, reference)
+        logger.info(f"Registered {len(new_image_ids)} new images in the model.")
+        reconstruction = run_triangulation(
+            sfm_dir, database, image_dir, model, verbose, mapper_options, False
+        )
+    else:
+        reconstruction = run_triangulation(
+            sfm_dir, database, image_dir, reference, verbose, mapper_options
+        )
     logger.info(
         "Finished the triangulation with statistics:\n%s", reconstruction.summary()
     )
@@ -272,6 +597,11 @@ if __name__ == "__main__":
     parser.add_argument("--skip_geometric_verification", action="store_true")
     parser.add_argument("--min_match_score", type=float)
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Extend an existing database with the new images and pairs.",
+    )
     args = parser.parse_args().__dict__
 
     mapper_options = parse_option_args(
@@ -0,0 +1,253 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def assign_to_centroids(
+    x: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536
+) -> np.ndarray:
+    """Index of the centroid with the highest inner product for each vector."""
+    ids = np.empty(len(x), dtype=np.int64)
+    for i in range(0, len(x), chunk_size):
+        ids[i : i + chunk_size] = np.argmax(x[i : i + chunk_size] @ centroids.T, 1)
+    return ids
+
+
+def kmeans(
+    x: np.ndarray,
+    k: int,
+    num_iters: int = 20,
+    spherical: bool = True,
+    seed: int = 0,
+) -> np.ndarray:
+    """Lloyd's k-means, optionally on the unit sphere (for cosine similarity).
+    Empty clusters are re-seeded with random training vectors."""
+    rng = np.random.default_rng(seed)
+    x = x.astype(np.float32, copy=False)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(num_iters):
+        if spherical:
+            ids = assign_to_centroids(x, centroids)
+        else:
+            # argmin |x-c|^2 = argmax x.c - |c|^2/2
+            sq_norms = (centroids**2).sum(1) / 2
+            ids = np.argmax(x @ centroids.T - sq_norms, 1)
+        counts = np.bincount(ids, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, ids, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+class ProductQuantizer:
+    """Split vectors into num_subspaces chunks, each quantized with its own
+    codebook of 2**num_bits centroids. Inner products with a query are then
+    computed from per-subspace lookup tables (asymmetric distance)."""
+
+    def __init__(self, codebooks: np.ndarray):
+        # the codes are stored as uint8
+        if not 1 < codebooks.shape[1] <= 256:
+            raise ValueError(
+                f"PQ needs between 2 and 256 codes, got {codebooks.shape[1]}."
+            )
+        self.codebooks = codebooks  # num_subspaces x num_codes x subdim
+
+    @classmethod
+    def train(cls, x: np.ndarray, num_subspaces: int, num_bits: int = 8, **kwargs):
+        dim = x.shape[1]
+        if dim % num_subspaces != 0:
+            raise ValueError(
+                f"Dimension {dim} is not divisible by {num_subspaces} subspaces."
+            )
+        if not 1 <= num_bits <= 8:
+            raise ValueError(f"PQ codes have 1 to 8 bits, got {num_bits}.")
+        num_codes = 2**num_bits
+        if len(x) < num_codes:
+            raise ValueError(f"Need at least {num_codes} vectors to train PQ.")
+        x = x.reshape(len(x), num_subspaces, -1)
+        codebooks = np.stack(
+            [
+                kmeans(x[:, m], num_codes, spherical=False, **kwargs)
+                for m in range(num_subspaces)
+            ]
+        )
+        return cls(codebooks)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        x = x.reshape(len(x), len(self.codebooks), -1)
+        codes = np.empty(x.shape[:2], dtype=np.uint8)
+        for m, codebook in enumerate(self.codebooks):
+            sq_norms = (codebook**2).sum(1) / 2
+            codes[:, m] = np.argmax(x[:, m] @ codebook.T - sq_norms, 1)
+        return codes
+
+    def lookup_tables(self, query: np.ndarray) -> np.ndarray:
+        query = query.reshape(len(self.codebooks), -1)
+        return np.einsum("md,mcd->mc", query, self.codebooks)
+
+    def inner_products(self, tables: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return tables[np.arange(len(tables)), codes].sum(-1)
+
+
+class IVFIndex:
+    """Inverted-file index for approximate maximum inner-product search.
+
+    The database vectors are partitioned by a coarse k-means quantizer and
+    stored per list, either as float16 vectors or as PQ codes of their
+    residuals to the list centroid. A query only scores the vectors of the
+    nprobe lists with the closest centroids.
+    """
+
+    def __init__(
+        self,
+        names: np.ndarray,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_ids: np.ndarray,
+        vectors: Optional[np.ndarray] = None,
+        codes: Optional[np.ndarray] = None,
+        pq: Optional[ProductQuantizer] = None,
+    ):
+        self.names = names
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.vectors = vectors
+        self.codes = codes
+        self.pq = pq
+
+    @classmethod
+    def build(
+        cls,
+        desc: np.ndarray,
+        names: List[str],
+        num_lists: int = 1024,
+        num_subspaces: Optional[int] = None,
+        num_bits: int = 8,
+        num_train: int = 256,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Train the quantizers on at most num_train vectors per centroid
+        and index all the descriptors. PQ is used if num_subspaces is set."""
+        desc = desc.astype(np.float32, copy=False)
+        num_lists = min(num_lists, len(desc))
+        rng = np.random.default_rng(seed)
+        train = desc
+        if len(desc) > num_train * num_lists:
+            train = desc[rng.choice(len(desc), num_train * num_lists, replace=False)]
+        centroids = kmeans(train, num_lists, seed=seed)
+
+        pq = None
+        if num_subspaces is not None:
+            train_ids = assign_to_centroids(train, centroids)
+            pq = ProductQuantizer.train(
+                train - centroids[train_ids], num_subspaces, num_bits, seed=seed
+            )
+
+        index = cls(
+            np.array([], dtype=str),
+            centroids,
+            np.zeros(num_lists + 1, dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            vectors=None if pq else np.zeros((0, desc.shape[1]), np.float16),
+            codes=np.zeros((0, num_subspaces), np.uint8) if pq else None,
+            pq=pq,
+        )
+        index.add(desc, names)
+        return index
+
+    def add(self, desc: np.ndarray, names: List[str]):
+        """Append new database vectors to the inverted lists."""
+        desc = desc.astype(np.float32, copy=False)
+        assignment = assign_to_centroids(desc, self.centroids)
+        ids = np.arange(len(self.names), len(self.names) + len(desc))
+        self.names = np.concatenate([self.names, np.array(names)])
+
+        # merge into the lists, keeping them contiguous
+        old_lists = np.repeat(np.arange(self.num_lists), np.diff(self.list_offsets))
+        lists = np.concatenate([old_lists, assignment])
+        order = np.argsort(lists, kind="stable")
+        self.list_ids = np.concatenate([self.list_ids, ids])[order]
+        counts = np.bincount(lists, minlength=self.num_lists)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        if self.pq is None:
+            new = desc.astype(np.float16)
+            self.vectors = np.concatenate([self.vectors, new])[order]
+        else:
+            new = self.pq.encode(desc - self.centroids[assignment])
+            self.codes = np.concatenate([self.codes, new])[order]
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def search(
+        self, query: np.ndarray, k: int, nprobe: int = 16
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the scores and database indices of the top-k results for
+        each query, padded with -inf and -1 if fewer candidates are found."""
+        query = np.atleast_2d(query).astype(np.float32, copy=False)
+        nprobe = min(nprobe, self.num_lists)
+        scores = np.full((len(query), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(query), k), -1, dtype=np.int64)
+        coarse = query @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        for i, (q, lists) in enumerate(zip(query, probes)):
+            starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+            sizes = ends - starts
+            if sizes.sum() == 0:
+                continue
+            pos = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            if self.pq is None:
+                sim = self.vectors[pos].astype(np.float32) @ q
+            else:
+                tables = self.pq.lookup_tables(q)
+                sim = self.pq.inner_products(tables, self.codes[pos])
+                sim += np.repeat(coarse[i, lists], sizes)
+            n = min(k, len(sim))
+            top = np.argpartition(-sim, n - 1)[:n]
+            top = top[np.argsort(-sim[top])]
+            scores[i, :n] = sim[top]
+            indices[i, :n] = self.list_ids[pos[top]]
+        return scores, indices
+
+    def save(self, path: Path):
+        arrays = dict(
+            names=self.names,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_ids=self.list_ids,
+        )
+        if self.pq is None:
+            arrays["vectors"] = self.vectors
+        else:
+            arrays["codes"] = self.codes
+            arrays["codebooks"] = self.pq.codebooks
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> "IVFIndex":
+        with np.load(path) as data:
+            pq = ProductQuantizer(data["codebooks"]) if "codebooks" in data else None
+            return cls(
+                data["names"],
+                data["centroids"],
+                data["list_offsets"],
+                data["list_ids"],
+                data["vectors"] if "vectors" in data else None,
+                data["codes"] if "codes" in data else None,
+                pq,
+            )
@@ -14,3 +14,69 @@ def compute_epipolar_errors(j_from_i: pycolmap.Rigid3d, p2d_i, p2d_j):
     errors_i = dist / np.linalg.norm(l2d_i[:, :2], axis=1)
     errors_j = dist / np.linalg.norm(l2d_j[:, :2], axis=1)
     return errors_i, errors_j
+
+
+def essential_matrices_from_poses(j_R_i: np.ndarray, j_t_i: np.ndarray) -> np.ndarray:
+    """pycolmap.essential_matrix_from_pose for a batch of relative poses,
+    given as rotation matrices (N, 3, 3) and translations (N, 3)."""
+    t = j_t_i / np.maximum(np.linalg.norm(j_t_i, axis=-1, keepdims=True), 1e-12)
+    zero = np.zeros(len(t))
+    t_x = np.stack(
+        [zero, -t[:, 2], t[:, 1], t[:, 2], zero, -t[:, 0], -t[:, 1], t[:, 0], zero],
+        -1,
+    ).reshape(-1, 3, 3)
+    return t_x @ j_R_i
+
+
+def compute_epipolar_errors_batch(j_E_i: np.ndarray, p2d_i, p2d_j):
+    """compute_epipolar_errors for the matches of many pairs at once, given
+    the essential matrix (N, 3, 3) of the pair of each match."""
+    p2d_i, p2d_j = to_homogeneous(p2d_i), to_homogeneous(p2d_j)
+    l2d_j = np.einsum("nkl,nl->nk", j_E_i, p2d_i)
+    l2d_i = np.einsum("nlk,nl->nk", j_E_i, p2d_j)
+    dist = np.abs(np.sum(p2d_i * l2d_i, axis=1))
+    errors_i = dist / np.linalg.norm(l2d_i[:, :2], axis=1)
+    errors_j = dist / np.linalg.norm(l2d_j[:, :2], axis=1)
+    return errors_i, errors_j
+
+
+def umeyama_alignment(src: np.ndarray, dst: np.ndarray):
+    """Similarity (scale, R, t) that minimizes |dst - (scale * R @ src + t)|²
+    for corresponding 3D points (N, 3), following Umeyama (1991)."""
+    mean_src, mean_dst = src.mean(0), dst.mean(0)
+    src_c, dst_c = src - mean_src, dst - mean_dst
+    U, S, Vt = np.linalg.svd(dst_c.T @ src_c / len(src))
+    D = np.eye(3)
+    if np.linalg.det(U) * np.linalg.det(Vt) < 0:
+        D[2, 2] = -1
+    R = U @ D @ Vt
+    var_src = np.mean(np.sum(src_c**2, axis=1))
+    scale = np.trace(np.diag(S) @ D) / max(var_src, 1e-12)
+    t = mean_dst - scale * R @ mean_src
+    return scale, R, t
+
+
+def ransac_umeyama_alignment(
+    src: np.ndarray,
+    dst: np.ndarray,
+    max_error: float,
+    num_iterations: int = 200,
+    seed: int = 0,
+):
+    """Robust umeyama_alignment with minimal samples of 3 points, refined on
+    the inliers of the best sample. Returns the similarity and the inliers,
+    or None and no inliers if no sample has at least 3 inliers."""
+    rng = np.random.default_rng(seed)
+    best_inliers = np.zeros(len(src), dtype=bool)
+    best_count = 0
+    for _ in range(num_iterations if len(src) > 3 else len(src) // 3):
+        sample = rng.choice(len(src), 3, replace=False)
+        scale, R, t = umeyama_alignment(src[sample], dst[sample])
+        errors = np.linalg.norm(dst - (scale * src @ R.T + t), axis=1)
+        inliers = errors < max_error
+        if inliers.sum() > best_count:
+            best_inliers, best_count = inliers, inliers.sum()
+    if best_count < 3:
+        return None, best_inliers
+    scale, R, t = umeyama_alignment(src[best_inliers], dst[best_inliers])
+    return (scale, R, t), best_inliers
@@ -1,5 +1,10 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Mapping, Tuple
+from queue import Queue
+from typing import Callable, Iterable, Iterator, List, Mapping, Optional, Tuple
 
 import cv2
 import h5py
@@ -46,6 +51,97 @@ def get_keypoints(
     return p
 
 
+def get_keypoints_batch(
+    path: Path, names: List[str]
+) -> List[Tuple[np.ndarray, Optional[float]]]:
+    """The keypoints and uncertainty of many images, read from one handle."""
+    with h5py.File(str(path), "r", libver="latest") as hfile:
+        dsets = [hfile[name]["keypoints"] for name in names]
+        return [(d.__array__(), d.attrs.get("uncertainty")) for d in dsets]
+
+
+def prefetch(generator_fn: Callable[[], Iterator], maxsize: int = 4) -> Iterator:
+    """Run a generator in a background thread and yield its items, keeping at
+    most maxsize of them in advance. Exceptions are re-raised in the caller."""
+    queue = Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def run():
+        try:
+            for item in generator_fn():
+                queue.put(item)
+                if stop.is_set():
+                    return
+            queue.put(done)
+        except BaseException as error:
+            queue.put(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # unblock the thread if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get()
+            thread.join(0.01)
+
+
+def map_ordered(
+    fn: Callable,
+    items: Iterable,
+    num_workers: int,
+    max_pending: Optional[int] = None,
+    use_threads: bool = False,
+) -> Iterator:
+    """Apply fn to the items in worker processes, or threads, and yield the
+    results in the order of the items, with at most max_pending items in
+    flight so that the items can be generated lazily. num_workers=0 runs in
+    the calling thread. The processes are spawned rather than forked, since
+    the caller may hold threads and HDF5 handles that a fork would copy in an
+    inconsistent state, so fn must be picklable and scripts that start
+    worker processes need an if __name__ == "__main__" guard."""
+    if num_workers == 0:
+        yield from map(fn, items)
+        return
+    max_pending = max_pending or 2 * num_workers
+    if use_threads:
+        executor = ThreadPoolExecutor(num_workers)
+    else:
+        executor = ProcessPoolExecutor(
+            num_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    with executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def iter_keypoints(
+    path: Path, names: List[str], batch_size: int = 256
+) -> Iterator[List[Tuple[str, np.ndarray]]]:
+    """Read the keypoints of many images in batches from a single handle."""
+    with h5py.File(str(path), "r", libver="latest") as hfile:
+        for i in range(0, len(names), batch_size):
+            yield [
+                (name, hfile[name]["keypoints"].__array__())
+                for name in names[i : i + batch_size]
+            ]
+
+
 def find_pair(hfile: h5py.File, name0: str, name1: str):
     pair = names_to_pair(name0, name1)
     if pair in hfile:
@@ -66,11 +162,10 @@ def find_pair(hfile: h5py.File, name0: str, name1: str):
     )
 
 
-def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
-    with h5py.File(str(path), "r", libver="latest") as hfile:
-        pair, reverse = find_pair(hfile, name0, name1)
-        matches = hfile[pair]["matches0"].__array__()
-        scores = hfile[pair]["matching_scores0"].__array__()
+def read_matches(hfile: h5py.File, name0: str, name1: str) -> Tuple[np.ndarray]:
+    pair, reverse = find_pair(hfile, name0, name1)
+    matches = hfile[pair]["matches0"].__array__()
+    scores = hfile[pair]["matching_scores0"].__array__()
     idx = np.where(matches != -1)[0]
     matches = np.stack([idx, matches[idx]], -1)
     if reverse:
@@ -79,6 +174,19 @@ def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
     return matches, scores
 
 
+def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
+    with h5py.File(str(path), "r", libver="latest") as hfile:
+        return read_matches(hfile, name0, name1)
+
+
+def get_matches_batch(
+    path: Path, pairs: List[Tuple[str, str]]
+) -> List[Tuple[np.ndarray]]:
+    """The matches and scores of many pairs, read from a single handle."""
+    with h5py.File(str(path), "r", libver="latest") as hfile:
+        return [read_matches(hfile, name0, name1) for name0, name1 in pairs]
+
+
 def write_poses(
     poses: Mapping[str, pycolmap.Rigid3d], path: str, prepend_camera_name: bool
 ):
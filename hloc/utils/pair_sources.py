@@ -0,0 +1,178 @@
+from itertools import chain, islice
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+from .parsers import parse_retrieval
+
+Pair = Tuple[str, str]
+
+
+class PairSource:
+    """A collection of image pairs that is generated lazily, block by block,
+    instead of being parsed from a text file. Consecutive pairs share their
+    images as much as possible so that features, images or encoder outputs
+    stay in the caches of the consumers. Sources with unique=True never
+    contain a pair twice, in either order, and do not need deduplication."""
+
+    unique = True
+
+    def blocks(self) -> Iterator[List[Pair]]:
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[Pair]:
+        return chain.from_iterable(self.blocks())
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def names(self) -> List[str]:
+        """All the images involved in at least one pair."""
+        raise NotImplementedError
+
+    def shard(self, index: int, num: int) -> Iterator[List[Pair]]:
+        """Every num-th block from the index-th one, e.g. for each of num
+        workers. Subclasses only generate the blocks of the shard."""
+        return islice(self.blocks(), index, None, num)
+
+    def write(self, path: Path, start: int = 0):
+        """Export the pairs, from the start-th one, to a retrieval file."""
+        with open(path, "w") as f:
+            for i, pair in enumerate(islice(self, start, None)):
+                f.write(("\n" if i > 0 else "") + " ".join(pair))
+
+
+def tiles(num: int, block_size: int) -> List[range]:
+    return [range(i, min(i + block_size, num)) for i in range(0, num, block_size)]
+
+
+def is_unique(*groups: Sequence[str]) -> bool:
+    """Whether the groups of names are free of duplicates and disjoint."""
+    num = sum(len(g) for g in groups)
+    return len(set(chain.from_iterable(groups))) == num
+
+
+class ExhaustivePairs(PairSource):
+    """All pairs of images, or all pairs between images and references.
+    The pair matrix is traversed in tiles of block_size x block_size. The
+    pairs are unique only if the names are, and, with references, if the
+    images and references are disjoint."""
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        ref_names: Optional[Sequence[str]] = None,
+        block_size: int = 64,
+    ):
+        self.names_q = list(names)
+        self.names_ref = None if ref_names is None else list(ref_names)
+        self.block_size = block_size
+        if self.names_ref is None:
+            self.unique = is_unique(self.names_q)
+        else:
+            self.unique = is_unique(self.names_q, self.names_ref)
+
+    def tiles(self) -> List[Tuple[range, range]]:
+        blocks_q = tiles(len(self.names_q), self.block_size)
+        if self.names_ref is None:
+            return [(bi, bj) for i, bi in enumerate(blocks_q) for bj in blocks_q[i:]]
+        blocks_ref = tiles(len(self.names_ref), self.block_size)
+        return [(bi, bj) for bi in blocks_q for bj in blocks_ref]
+
+    def tile_pairs(self, tile: Tuple[range, range]) -> List[Pair]:
+        block_i, block_j = tile
+        names_q = self.names_q
+        if self.names_ref is None:
+            return [(names_q[i], names_q[j]) for i in block_i for j in block_j if j > i]
+        names_ref = self.names_ref
+        return [(names_q[i], names_ref[j]) for i in block_i for j in block_j]
+
+    def blocks(self) -> Iterator[List[Pair]]:
+        return self.shard(0, 1)
+
+    def shard(self, index: int, num: int, offset: int = 0) -> Iterator[List[Pair]]:
+        # offset is the number of tiles that precede this source
+        for k, tile in enumerate(self.tiles()):
+            if (offset + k) % num == index:
+                pairs = self.tile_pairs(tile)
+                if len(pairs) > 0:
+                    yield pairs
+
+    def __len__(self) -> int:
+        num = len(self.names_q)
+        if self.names_ref is None:
+            return num * (num - 1) // 2
+        return num * len(self.names_ref)
+
+    def names(self) -> List[str]:
+        return list(dict.fromkeys(self.names_q + (self.names_ref or [])))
+
+
+class BlockExhaustivePairs(PairSource):
+    """Exhaustive pairs within groups of images (e.g. sequences or scenes),
+    and optionally across some pairs of groups, given by their indices.
+    The pairs are unique only if the groups are disjoint and free of
+    duplicates, and the pairs of groups are unique."""
+
+    def __init__(
+        self,
+        groups: Sequence[Sequence[str]],
+        cross_groups: Sequence[Tuple[int, int]] = (),
+        block_size: int = 64,
+    ):
+        self.groups = [list(g) for g in groups]
+        self.cross_groups = [(i, j) for i, j in cross_groups if i != j]
+        self.block_size = block_size
+        cross = {(min(i, j), max(i, j)) for i, j in self.cross_groups}
+        self.unique = is_unique(*self.groups) and len(cross) == len(self.cross_groups)
+
+    def sources(self) -> List[ExhaustivePairs]:
+        return [ExhaustivePairs(g, block_size=self.block_size) for g in self.groups] + [
+            ExhaustivePairs(self.groups[i], self.groups[j], self.block_size)
+            for i, j in self.cross_groups
+        ]
+
+    def blocks(self) -> Iterator[List[Pair]]:
+        return self.shard(0, 1)
+
+    def shard(self, index: int, num: int) -> Iterator[List[Pair]]:
+        offset = 0
+        for source in self.sources():
+            yield from source.shard(index, num, offset)
+            offset += len(source.tiles())
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self.sources())
+
+    def names(self) -> List[str]:
+        return list(dict.fromkeys(chain.from_iterable(self.groups)))
+
+
+class PairList(PairSource):
+    """Explicit pairs, e.g. parsed from a retrieval file."""
+
+    unique = False
+
+    def __init__(self, pairs: Union[Path, Sequence[Pair]], block_size: int = 4096):
+        if isinstance(pairs, (str, Path)):
+            pairs = [(q, r) for q, rs in parse_retrieval(pairs).items() for r in rs]
+        self.pairs = list(pairs)
+        self.block_size = block_size
+
+    def blocks(self) -> Iterator[List[Pair]]:
+        for i in range(0, len(self.pairs), self.block_size):
+            yield self.pairs[i : i + self.block_size]
+
+    def __iter__(self) -> Iterator[Pair]:
+        return iter(self.pairs)
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def names(self) -> List[str]:
+        return list(dict.fromkeys(chain.from_iterable(self.pairs)))
+
+
+def as_pair_source(pairs: Union[Path, PairSource, Sequence[Pair]]) -> PairSource:
+    if isinstance(pairs, PairSource):
+        return pairs
+    return PairList(pairs)
@@ -31,9 +31,12 @@
 
 import argparse
 import collections
+import gc
 import logging
+import mmap
 import os
 import struct
+import time
 
 import numpy as np
 
@@ -238,7 +241,7 @@ def read_images_text(path):
     return images
 
 
-def read_images_binary(path_to_model_file):
+def read_images_binary_reference(path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesBinary(const std::string& path)
@@ -284,6 +287,72 @@ def read_images_binary(path_to_model_file):
     return images
 
 
+def gather_records(buffer, offsets, dtype, chunk_size=65536):
+    """Parse fixed-size records at arbitrary byte offsets of a buffer into a
+    structured array, in chunks to bound the size of the gather indices."""
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    records = np.empty(len(offsets), dtype=dtype)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    for i in range(0, len(offsets), chunk_size):
+        idx = offsets[i : i + chunk_size, None] + np.arange(dtype.itemsize)
+        records[i : i + chunk_size] = data[idx].view(dtype)[:, 0]
+    return records
+
+
+IMAGE_HEADER_DTYPE = np.dtype(
+    [("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")]
+)
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+POINT3D_HEADER_DTYPE = np.dtype(
+    [("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8")]
+)
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def read_images_binary(path_to_model_file):
+    """Same as read_images_binary_reference but the file is memory-mapped:
+    only the record offsets are found with a Python loop, the fixed-size
+    headers are parsed at once and the 2D points with np.frombuffer."""
+    images = {}
+    with open(path_to_model_file, "rb") as fid, mmap.mmap(
+        fid.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        num_reg_images = struct.unpack_from("<Q", buffer, 0)[0]
+        header_offsets, names, point_offsets, num_points = [], [], [], []
+        offset = 8
+        for _ in range(num_reg_images):
+            header_offsets.append(offset)
+            name_end = buffer.find(b"\x00", offset + IMAGE_HEADER_DTYPE.itemsize)
+            names.append(
+                buffer[offset + IMAGE_HEADER_DTYPE.itemsize : name_end].decode("utf-8")
+            )
+            num_points2D = struct.unpack_from("<Q", buffer, name_end + 1)[0]
+            point_offsets.append(name_end + 9)
+            num_points.append(num_points2D)
+            offset = name_end + 9 + POINT2D_DTYPE.itemsize * num_points2D
+
+        headers = gather_records(buffer, header_offsets, IMAGE_HEADER_DTYPE)
+        qvecs, tvecs = headers["qvec"].copy(), headers["tvec"].copy()
+        for i, (image_id, camera_id) in enumerate(
+            zip(headers["id"].tolist(), headers["camera_id"].tolist())
+        ):
+            points = np.frombuffer(
+                buffer, POINT2D_DTYPE, num_points[i], point_offsets[i]
+            )
+            images[image_id] = Image(
+                id=image_id,
+                qvec=qvecs[i],
+                tvec=tvecs[i],
+                camera_id=camera_id,
+                name=names[i],
+                xys=points["xy"].copy(),
+                point3D_ids=points["point3D_id"].copy(),
+            )
+            del points  # release the view before the buffer is closed
+    return images
+
+
 def write_images_text(images, path):
     """
     see: src/base/reconstruction.cc
@@ -371,7 +440,7 @@ def read_points3D_text(path):
     return points3D
 
 
-def read_points3D_binary(path_to_model_file):
+def read_points3D_binary_reference(path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
@@ -409,6 +478,75 @@ def read_points3D_binary(path_to_model_file):
     return points3D
 
 
+def gather_blocks(buffer, offsets, counts, dtype, chunk_size=65536):
+    """Concatenate variable-length arrays of records stored at arbitrary byte
+    offsets of a buffer, in chunks to bound the size of the gather indices."""
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    blocks = []
+    for i in range(0, len(offsets), chunk_size):
+        sizes = counts[i : i + chunk_size] * dtype.itemsize
+        starts = np.cumsum(sizes) - sizes
+        idx = np.arange(sizes.sum()) + np.repeat(
+            offsets[i : i + chunk_size] - starts, sizes
+        )
+        blocks.append(data[idx].view(dtype))
+    return np.concatenate(blocks) if len(blocks) > 0 else np.empty(0, dtype)
+
+
+def read_points3D_binary(path_to_model_file):
+    """Same as read_points3D_binary_reference but the file is memory-mapped:
+    only the record offsets are found with a Python loop, while the headers
+    and the tracks are parsed at once into NumPy arrays."""
+    header_size = POINT3D_HEADER_DTYPE.itemsize + 8  # with the track length
+    with open(path_to_model_file, "rb") as fid, mmap.mmap(
+        fid.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        num_points = struct.unpack_from("<Q", buffer, 0)[0]
+        offsets, track_lengths = [], []
+        offset = 8
+        for _ in range(num_points):
+            offsets.append(offset)
+            track_length = struct.unpack_from(
+                "<Q", buffer, offset + POINT3D_HEADER_DTYPE.itemsize
+            )[0]
+            track_lengths.append(track_length)
+            offset += header_size + TRACK_ELEM_DTYPE.itemsize * track_length
+
+        headers = gather_records(buffer, offsets, POINT3D_HEADER_DTYPE)
+        tracks = gather_blocks(
+            buffer,
+            np.array(offsets, dtype=np.int64) + header_size,
+            track_lengths,
+            TRACK_ELEM_DTYPE,
+        )
+    bounds = np.cumsum([0] + track_lengths).tolist()
+    image_ids = tracks["image_id"].astype(np.int64)
+    point2D_idxs = tracks["point2D_idx"].astype(np.int64)
+    errors = headers["error"]
+    points3D = {}
+    # the objects are acyclic, pause the garbage collector that would
+    # otherwise repeatedly traverse the growing dictionary
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for values in zip(
+            headers["id"].tolist(),
+            headers["xyz"].copy(),
+            headers["rgb"].astype(np.int64),
+            [errors[i, ...] for i in range(len(errors))],  # 0-dimensional arrays
+            [image_ids[i:j] for i, j in zip(bounds[:-1], bounds[1:])],
+            [point2D_idxs[i:j] for i, j in zip(bounds[:-1], bounds[1:])],
+        ):
+            points3D[values[0]] = Point3D._make(values)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return points3D
+
+
 def write_points3D_text(points3D, path):
     """
     see: src/base/reconstruction.cc
@@ -552,6 +690,39 @@ def rotmat2qvec(R):
     return qvec
 
 
+def benchmark_binary_readers(path):
+    """Compare the fast binary readers to the reference ones on a model."""
+    results = {}
+    for name, fast, reference in [
+        ("images", read_images_binary, read_images_binary_reference),
+        ("points3D", read_points3D_binary, read_points3D_binary_reference),
+    ]:
+        model_file = os.path.join(path, name + ".bin")
+        start = time.time()
+        expected = reference(model_file)
+        reference_time = time.time() - start
+        start = time.time()
+        output = fast(model_file)
+        fast_time = time.time() - start
+        equal = expected.keys() == output.keys() and all(
+            all(
+                np.array_equal(x, y) if isinstance(x, np.ndarray) else x == y
+                for x, y in zip(expected[k], output[k])
+            )
+            for k in expected
+        )
+        logger.info(
+            "%s: reference %.3fs, fast %.3fs (%.1fx), %s.",
+            name,
+            reference_time,
+            fast_time,
+            reference_time / max(fast_time, 1e-9),
+            "identical" if equal else "DIFFERENT",
+        )
+        results[name] = (equal, reference_time, fast_time)
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Read and write COLMAP binary and text models"
@@ -570,8 +741,18 @@ def main():
         help="outut model format",
         default=".txt",
     )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compare the fast and reference binary readers",
+    )
     args = parser.parse_args()
 
+    if args.benchmark:
+        logging.basicConfig(level=logging.INFO)
+        benchmark_binary_readers(args.input_model)
+        return
+
     cameras, images, points3D = read_model(path=args.input_model, ext=args.input_format)
 
     print("num_cameras:", len(cameras))
@@ -0,0 +1,104 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .. import logger
+from .pair_sources import PairList, PairSource
+
+
+def file_fingerprint(path: Path, use_hash: bool = False) -> Dict:
+    """Size and modification time of a file, and optionally its SHA-1,
+    which is robust to copies that do not preserve the mtime."""
+    stat = Path(path).stat()
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if use_hash:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+    return fingerprint
+
+
+def pairs_fingerprint(pairs: PairSource) -> str:
+    """Explicit pairs are hashed, generated ones are defined by their images."""
+    sha1 = hashlib.sha1(type(pairs).__name__.encode())
+    if isinstance(pairs, PairList):
+        for pair in pairs:
+            sha1.update(" ".join(pair).encode() + b"\n")
+    else:
+        sha1.update(str(len(pairs)).encode())
+        sha1.update("\n".join(pairs.names()).encode())
+    return sha1.hexdigest()
+
+
+def fingerprint(inputs: Any, use_hash: bool = False) -> str:
+    """Hash of JSON-like inputs, where files are represented by their
+    fingerprint and other objects by their string representation."""
+
+    def encode(obj):
+        if isinstance(obj, Path):
+            return file_fingerprint(obj, use_hash) if obj.is_file() else str(obj)
+        if isinstance(obj, PairSource):
+            return pairs_fingerprint(obj)
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        return str(obj)
+
+    data = json.dumps(inputs, sort_keys=True, default=encode)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class StageTracker:
+    """Record in a JSON sidecar file the fingerprint of the inputs of each
+    completed stage of a pipeline, such that a re-run skips the stages whose
+    inputs did not change. The fingerprint of a stage includes that of the
+    previous one, so all the stages after a changed stage are run again."""
+
+    def __init__(self, path: Path, enabled: bool = True, use_hash: bool = False):
+        self.path = Path(path)
+        self.enabled = enabled
+        self.use_hash = use_hash
+        self.records = {}
+        if enabled and self.path.exists():
+            self.records = json.loads(self.path.read_text())
+        self.previous = None
+        self.pending = {}
+        self.seen = []  # the stages of this run, in order
+
+    def save(self):
+        if self.enabled:
+            self.path.write_text(json.dumps(self.records, indent=2))
+
+    def reset(self):
+        self.records = {}
+        self.save()
+
+    def needs_run(
+        self, stage: str, outputs: Optional[List[Path]] = None, **inputs
+    ) -> bool:
+        """Whether the stage should run, i.e. it did not complete with the
+        same inputs or some of its outputs are missing. If so, the stage
+        must call done() when it completes."""
+        key = fingerprint({"inputs": inputs, "previous": self.previous}, self.use_hash)
+        self.previous = key
+        earlier = list(self.seen)
+        self.seen.append(stage)
+        if not self.enabled:
+            return True
+        missing = [p for p in outputs or [] if not Path(p).exists()]
+        if self.records.get(stage) == key and len(missing) == 0:
+            logger.info(f"Skipping the {stage} stage, its inputs did not change.")
+            return False
+        # forget the stage and all the following ones until they complete again,
+        # since their records may match a run older than their current outputs
+        self.records = {k: v for k, v in self.records.items() if k in earlier}
+        self.save()
+        self.pending[stage] = key
+        return True
+
+    def done(self, stage: str):
+        if self.enabled:
+            self.records[stage] = self.pending.pop(stage)
+            self.save()
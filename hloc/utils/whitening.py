@@ -0,0 +1,77 @@
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional
+
+import h5py
+import numpy as np
+
+
+def int8_scale(dim: int) -> float:
+    # whitened unit-norm descriptors have entries with std 1/sqrt(dim),
+    # map +-4 std to the range of int8
+    return 127 * np.sqrt(dim) / 4
+
+
+def fit_whitening(
+    desc_chunks: Callable[[], Iterable[np.ndarray]], dim: int, eps: float = 1e-6
+) -> Dict[str, np.ndarray]:
+    """Fit a PCA-whitening on chunks of descriptors. desc_chunks returns a new
+    iterator over the chunks and is called twice, for the mean and for the
+    covariance, such that the descriptors never need to fit in memory."""
+    total, num = 0, 0
+    for desc in desc_chunks():
+        total = total + desc.astype(np.float64).sum(0)
+        num += len(desc)
+    mean = total / num
+    cov = 0
+    for desc in desc_chunks():
+        centered = desc.astype(np.float64) - mean
+        cov = cov + centered.T @ centered
+    cov /= num
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1][:dim]
+    projection = eigvecs[:, order] / np.sqrt(eigvals[order] + eps)
+    return {
+        "pca_mean": mean.astype(np.float32),
+        "pca_projection": projection.astype(np.float32),
+    }
+
+
+def apply_whitening(desc: np.ndarray, whitening: Dict[str, np.ndarray]):
+    desc = (desc - whitening["pca_mean"]) @ whitening["pca_projection"]
+    return desc / np.linalg.norm(desc, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def quantize(desc: np.ndarray, dtype: str) -> np.ndarray:
+    if np.dtype(dtype) == np.int8:
+        desc = np.round(desc * int8_scale(desc.shape[-1]))
+        return desc.clip(-127, 127).astype(np.int8)
+    return desc.astype(dtype)
+
+
+def dequantize(desc: np.ndarray) -> np.ndarray:
+    if desc.dtype == np.int8:
+        return desc.astype(np.float32) / int8_scale(desc.shape[-1])
+    return desc
+
+
+def write_whitening(path: Path, whitening: Dict[str, np.ndarray]):
+    """Store the whitening with the descriptors, as attributes of an HDF5
+    file (opened with libver="latest" for large attributes) or as a file
+    in a descriptor store directory."""
+    if Path(path).is_dir():
+        np.savez(Path(path) / "whitening.npz", **whitening)
+    else:
+        with h5py.File(str(path), "a", libver="latest") as fd:
+            fd.attrs.update(whitening)
+
+
+def read_whitening(path: Path) -> Optional[Dict[str, np.ndarray]]:
+    if Path(path).is_dir():
+        if not (Path(path) / "whitening.npz").exists():
+            return None
+        with np.load(Path(path) / "whitening.npz") as data:
+            return dict(data)
+    with h5py.File(str(path), "r", libver="latest") as fd:
+        if "pca_projection" not in fd.attrs:
+            return None
+        return {k: fd.attrs[k] for k in ("pca_mean", "pca_projection")}
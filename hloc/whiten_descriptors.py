@@ -0,0 +1,65 @@
+import argparse
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from . import logger
+from .pairs_from_retrieval import parse_names
+from .utils.io import list_h5_names
+from .utils.whitening import (
+    apply_whitening,
+    dequantize,
+    fit_whitening,
+    quantize,
+    write_whitening,
+)
+
+
+def main(
+    descriptors: Path,
+    output: Path,
+    dim: int = 256,
+    dtype: str = "float16",
+    db_prefix=None,
+    db_list=None,
+    key: str = "global_descriptor",
+    batch_size: int = 10000,
+):
+    """Fit a PCA-whitening on the database descriptors and write all the
+    descriptors of the input file, projected and quantized, to output."""
+    logger.info(f"Reducing global descriptors to {dim} dimensions ({dtype}).")
+    names = list_h5_names(descriptors)
+    db_names = parse_names(db_prefix, db_list, names)
+
+    with h5py.File(str(descriptors), "r", libver="latest") as fd:
+
+        def read_chunks(names):
+            for i in range(0, len(names), batch_size):
+                batch = names[i : i + batch_size]
+                yield batch, dequantize(np.stack([fd[n][key][()] for n in batch]))
+
+        whitening = fit_whitening(
+            lambda: (desc for _, desc in read_chunks(db_names)), dim
+        )
+        output.parent.mkdir(exist_ok=True, parents=True)
+        with h5py.File(str(output), "w", libver="latest") as fo:
+            for batch, desc in read_chunks(names):
+                desc = quantize(apply_whitening(desc, whitening), dtype)
+                for name, d in zip(batch, desc):
+                    fo.create_group(name).create_dataset(key, data=d)
+    write_whitening(output, whitening)
+    logger.info(f"Wrote {len(names)} descriptors to {output}.")
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--descriptors", type=Path, required=True)
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--dtype", type=str, default="float16")
+    parser.add_argument("--db_prefix", type=str, nargs="+")
+    parser.add_argument("--db_list", type=Path)
+    args = parser.parse_args()
+    main(**args.__dict__)